@@ -0,0 +1,216 @@
+import os
+import re
+import csv
+import sys
+import json
+import time
+import argparse
+import warnings
+import numpy as np
+
+from perf_model import StagePerfModel, get_config_pairs, eq_vcpu_alloc
+from perf_model_dist import DistPerfModel
+from perf_model_analytic import AnaPerfModel
+
+'''
+Offline benchmark of the stage performance models over the profiles in profiles/.
+For each profile, stage and model, it runs leave-one-config-out cross-validation: the model
+is fitted on all config pairs but one and predicts the 50-tile and 95-tile latency of the
+held-out config, which are compared with the profiled ones (epochs except the first).
+The p50/p95 errors are the mean absolute relative errors over the held-out configs.
+Each model is checked against the latency it is trained on, i.e., the sum of the per-function
+average step times for jolteon and analytic, and the sum of the 95-tile ones for dist (Orion).
+'''
+
+model_names = ['jolteon', 'dist', 'analytic']
+fields = ['profile', 'model', 'stage', 'num_folds', 'p50_err', 'p95_err',
+          'train_ms', 'predict_per_s']
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+code_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Map each workflow name to its config file, e.g., 'tpcds-dsq95' -> 'tpcds-dsq95.json'
+def workflow_configs():
+    res = {}
+    for file_name in sorted(os.listdir(code_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        config = json.load(open(os.path.join(code_dir, file_name), 'r'))
+        if not isinstance(config, dict) or 'workflow_name' not in config:
+            continue
+        res[config['workflow_name'].replace('/', '-')] = config
+    return res
+
+# Stage names, allow_parallel and has_parent of a workflow, without creating the stages
+def stage_specs(config):
+    specs = []
+    for i in range(config['num_stages']):
+        stage_config = config[str(i)]
+        allow_parallel = stage_config.get('allow_parallel', 'true') not in ['false', 'False']
+        specs.append((stage_config['stage_name'], allow_parallel,
+                      len(stage_config['parents']) > 0))
+    return specs
+
+# The config pairs of a profile, e.g., the no_9878 variant drops the configs with 9878MB
+def profile_config_pairs(prof_name, workflow_name, num_configs):
+    pairs = get_config_pairs(workflow_name)
+    for mem in re.findall(r'no_(\d+)', prof_name):
+        pairs = [pair for pair in pairs if pair[0] != int(mem)]
+    if len(pairs) != num_configs:
+        return None
+    return pairs
+
+def drop_config(stage_profile, idx):
+    res = {}
+    for key, val in stage_profile.items():
+        arr = np.array(val)
+        if key == 'input_size' and arr.ndim == 1:
+            res[key] = val
+        else:
+            res[key] = np.delete(arr, idx, axis=1).tolist()
+    return res
+
+def actual_latency(stage_profile, idx, model_name):
+    col = 1 if model_name == 'dist' else 0
+    res = 0
+    for step in ['cold', 'read', 'compute', 'write']:
+        res = res + np.array(stage_profile[step])[1:, idx, col]
+    return res
+
+def new_model(model_name, stage_id, stage_name, allow_parallel, has_parent):
+    if model_name == 'jolteon':
+        model = StagePerfModel(stage_id, stage_name)
+        model.update_has_parent(has_parent)
+    elif model_name == 'dist':
+        model = DistPerfModel(stage_id, stage_name)
+    elif model_name == 'analytic':
+        model = AnaPerfModel(stage_id, stage_name)
+    else:
+        raise ValueError('Invalid model name: %s' % model_name)
+    model.update_allow_parallel(allow_parallel)
+    return model
+
+def fit_model(model, model_name, stage_profile, pairs, num_samples):
+    if model_name == 'dist':
+        model.fit(stage_profile, pairs)
+        return None
+    model.fit(stage_profile, pairs, verbose=False)
+    if model_name == 'jolteon':
+        return model.sample_offline(num_samples)
+    return None
+
+# Predict the 50-tile and 95-tile latency of a stage under the config
+def predict_tiles(model, model_name, config, samples):
+    mem, num_func = config
+    if model_name == 'jolteon':
+        # All the stages share the config in profiling, so the parent has num_func functions
+        preds = model.predict_samples(samples, mem / 1792, num_func, parent_d=num_func)
+        return np.percentile(preds, 50), np.percentile(preds, 95)
+    # Both models are indexed by the equivalent vCPU allocation
+    func_size = eq_vcpu_alloc(mem, num_func if model.allow_parallel else 1)
+    if model_name == 'dist':
+        dist = model.interpolation(func_size)
+        return dist.tail_value(0.5), dist.tail_value(0.95)
+    pred = model.predict(mem / 1792, func_size)
+    return pred, pred
+
+def cross_validate(prof_name, profile, config, model_name, num_samples, num_repeats):
+    workflow_name = config['workflow_name']
+    num_configs = np.array(profile[stage_specs(config)[0][0]]['cold']).shape[1]
+    pairs = profile_config_pairs(prof_name, workflow_name, num_configs)
+    if pairs is None:
+        print('Skip %s: cannot align %d configs with %s' % (prof_name, num_configs, workflow_name),
+              file=sys.stderr)
+        return []
+
+    rows = []
+    for stage_id, (stage_name, allow_parallel, has_parent) in enumerate(stage_specs(config)):
+        stage_profile = profile[stage_name]
+        errs = []
+        train_time = 0
+        predict_time = 0
+        for idx, held_out in enumerate(pairs):
+            train_pairs = pairs[:idx] + pairs[idx+1:]
+            model = new_model(model_name, stage_id, stage_name, allow_parallel, has_parent)
+            t0 = time.time()
+            samples = fit_model(model, model_name, drop_config(stage_profile, idx),
+                                train_pairs, num_samples)
+            t1 = time.time()
+            for _ in range(num_repeats):
+                pred50, pred95 = predict_tiles(model, model_name, held_out, samples)
+            t2 = time.time()
+            train_time += t1 - t0
+            predict_time += t2 - t1
+
+            actuals = actual_latency(stage_profile, idx, model_name)
+            act50 = np.percentile(actuals, 50)
+            act95 = np.percentile(actuals, 95)
+            errs.append([abs(pred50 - act50) / act50, abs(pred95 - act95) / act95])
+        errs = np.array(errs)
+        rows.append({'profile': prof_name, 'model': model_name, 'stage': stage_name,
+                     'num_folds': len(pairs),
+                     'p50_err': float(np.mean(errs[:, 0])),
+                     'p95_err': float(np.mean(errs[:, 1])),
+                     'train_ms': train_time / len(pairs) * 1000,
+                     'predict_per_s': len(pairs) * num_repeats / max(predict_time, 1e-9)})
+    return rows
+
+def run(prof_dir, models, num_samples=1000, num_repeats=10, prof_filter=''):
+    configs = workflow_configs()
+    rows = []
+    for prof_file in sorted(os.listdir(prof_dir)):
+        if not prof_file.endswith('_profile.json') or prof_filter not in prof_file:
+            continue
+        prof_name = prof_file[:-len('_profile.json')]
+        matched = [name for name in configs if prof_name == name or prof_name.endswith('_' + name)]
+        if len(matched) == 0:
+            print('Skip %s: no workflow config' % prof_file, file=sys.stderr)
+            continue
+        config = configs[max(matched, key=len)]
+        profile = json.load(open(os.path.join(prof_dir, prof_file), 'r'))
+        for model_name in models:
+            rows += cross_validate(prof_name, profile, config, model_name,
+                                   num_samples, num_repeats)
+    return rows
+
+def write_rows(rows, out_path):
+    if out_path.endswith('.json'):
+        with open(out_path, 'w') as f:
+            json.dump(rows, f, indent=1)
+        return
+    f = sys.stdout if out_path == '-' else open(out_path, 'w', newline='')
+    writer = csv.DictWriter(f, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: ('%.6g' % v if isinstance(v, float) else v) for k, v in row.items()})
+    if f is not sys.stdout:
+        f.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-d', '--profile_dir', type=str, default=os.path.join(base_dir, 'profiles'), help='directory of the profiles')
+    parser.add_argument('-m', '--models', type=str, default=','.join(model_names), help='comma-separated models, e.g., jolteon,dist,analytic')
+    parser.add_argument('-pf', '--profile_filter', type=str, default='', help='only benchmark the profiles whose file name contains it')
+    parser.add_argument('-ss', '--sample_size', type=int, default=1000, help='sample size of the jolteon model')
+    parser.add_argument('-nr', '--num_repeats', type=int, default=10, help='repeats of each prediction for timing')
+    parser.add_argument('-o', '--output', type=str, default='-', help='output .csv or .json file, - for csv to stdout')
+
+    args = parser.parse_args()
+
+    models = args.models.split(',')
+    for model_name in models:
+        assert model_name in model_names, 'Invalid model name: %s' % model_name
+    assert args.sample_size > 0 and args.num_repeats > 0
+    # Folds of degenerate steps (e.g., no output to write) make the fitters warn
+    warnings.simplefilter('ignore')
+
+    t0 = time.time()
+    rows = run(args.profile_dir, models, args.sample_size, args.num_repeats, args.profile_filter)
+    t1 = time.time()
+    write_rows(rows, args.output)
+    print('Benchmark time:', t1 - t0, 's', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
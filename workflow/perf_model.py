@@ -3,7 +3,9 @@ import matplotlib.pyplot as plt
 import math
 import time
 import json
+import warnings
 import scipy.optimize as scipy_opt
+from scipy.stats import qmc, norm
 
 # A config example in profiling, should be decided later
 config_pairs = [[1024, 8], [1024, 16], [1024, 32], 
@@ -76,6 +78,48 @@ def io_func2(x, a, b, c):   # io_func2 is for parent relavent read
 def comp_func(x, a, b, c, d):
     return a / x + b * np.log(x) / x + c / x**2 + d
 
+# Input-size-aware variants, x[-1] is the input size relative to the default input size.
+# The work terms scale with the input size, the constant (e.g., connection setup) does not, 
+# and e captures the remaining overhead linear in the input size
+def io_func_s(x, a, b, e):
+    return a * x[1] / x[0] + b + e * x[1]
+
+def io_func2_s(x, a, b, c, e):
+    return a * x[2] / x[0] + b * x[1] + c + e * x[2]
+
+def comp_func_s(x, a, b, c, d, e):
+    return x[1] * (a / x[0] + b * np.log(x[0]) / x[0] + c / x[0]**2) + d + e * x[1]
+
+size_funcs = {io_func: io_func_s, io_func2: io_func2_s, comp_func: comp_func_s}
+
+# The coefficient form of a stage: cold, x, kd/d, log(x)/x, 1/x**2, const, size
+num_coeffs = 7
+
+sample_methods = ['mc', 'sobol', 'halton']
+
+# Scrambled low-discrepancy points in [0, 1)^dim
+def qmc_uniform(method, dim, num_samples, seed=0):
+    assert method in ['sobol', 'halton']
+    if method == 'sobol':
+        engine = qmc.Sobol(d=dim, scramble=True, seed=seed)
+    else:
+        engine = qmc.Halton(d=dim, scramble=True, seed=seed)
+    with warnings.catch_warnings():
+        # Sobol prefers 2^m points, other sizes are still valid but less balanced
+        warnings.simplefilter('ignore')
+        return engine.random(num_samples)
+
+# Transform uniform points to N(mean, cov) through the Cholesky factor of cov
+def gaussian_from_uniform(mean, cov, u):
+    z = norm.ppf(np.clip(u, 1e-10, 1 - 1e-10))
+    try:
+        L = np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        # Positive semi-definite, e.g., an exactly fitted step
+        w, V = np.linalg.eigh(cov)
+        L = V * np.sqrt(np.clip(w, 0, None))
+    return np.asarray(mean) + z @ L.T
+
 '''
 StagePerfModel records the parameter distributions of a stage's performance model
 '''
@@ -91,8 +135,13 @@ class StagePerfModel:
 
         assert isinstance(default_input_size, int) and default_input_size > 0
         self.default_input_size = default_input_size  # MB
+        self.multi_size = False  # whether the profile covers multiple input sizes
+        self.input_sizes = None  # relative input sizes of the training data
 
-        self.cold_params_avg = []  # random variable
+        self.cold_params_avg = []  # random variable, the residual of the cold start trend
+        # Scheduling delay and cold start grow with the number of functions (invocation ramp
+        # and scale-out) and depend on the memory size: cold = r + b*d + c/k, r is random
+        self.cold_coeffs = [0, 0]  # [b, c]
         self.read_params_avg = []  # A/d + B, d is the equivalent vCPU allocation
         self.compute_params_avg = []  # A/d - B*log(d)/d + C/d**2 + D
         self.write_params_avg = []  # A/d + B
@@ -112,6 +161,7 @@ class StagePerfModel:
         self.logx_coeff = 0  # the coefficient of log(x)/x in the stage, x can be d or kd
         self.x2_coeff = 0  # the coefficient of 1/x**2 in the stage, x can be d or kd
         self.const_coeff = 0  # the constant coefficient in the stage
+        self.size_coeff = 0  # the coefficient of the relative input size in the stage
 
     def update_allow_parallel(self, allow_parallel) -> None:
         assert isinstance(allow_parallel, bool)
@@ -128,19 +178,37 @@ class StagePerfModel:
             profile = json.load(f)
         assert isinstance(profile, dict) and self.stage_name in profile
         stage_profile = profile[self.stage_name]
+        self.fit(stage_profile)
+
+    '''
+    Fit the model to a stage profile, i.e., profile[stage_name], whose columns are aligned with
+    pairs (default to config_pairs). Fitting again starts from scratch.
+    '''
+    def fit(self, stage_profile, pairs=None, verbose=True) -> None:
         assert isinstance(stage_profile, dict) and 'cold' in stage_profile and \
             'read' in stage_profile and 'compute' in stage_profile and \
             'write' in stage_profile
+        if pairs is None:
+            pairs = config_pairs
+        self.cold_coeffs = [0, 0]
+        self.x_coeff = 0
+        self.kd_d_coeff = 0
+        self.logx_coeff = 0
+        self.x2_coeff = 0
+        self.const_coeff = 0
+        self.size_coeff = 0
 
         # print('Training performance model for %s' % self.stage_name)
 
-        # For scheduling delay and cold start, just a random variable
+        # For scheduling delay and cold start, a linear trend in d and 1/k plus a random variable
         y_s = np.array(stage_profile['cold'])
         num_epochs = y_s.shape[0]
         assert num_epochs >= 2  
         num_epochs -= 1  # Remove the first cold start epoch
         y_s = y_s[1:][:,:,0].reshape(-1)  # Only consider warm start
-        self.cold_params_avg = y_s
+        self.fit_cold(y_s, num_epochs, pairs)
+        self.load_input_sizes(stage_profile, num_epochs, pairs)
+        s = self.input_sizes
 
         y_r = np.array(stage_profile['read'])[1:][:,:,0].reshape(-1)  # Only use the average time data
         y_c = np.array(stage_profile['compute'])[1:][:,:,0].reshape(-1)
@@ -148,16 +216,14 @@ class StagePerfModel:
 
         if self.allow_parallel:
             # kd is the equivalent vCPU allocation, d is the number of functions
-            d = np.array([num_func for mem, num_func in config_pairs] * num_epochs)
-            kd = np.array([eq_vcpu_alloc(mem, num_func) for mem, num_func in config_pairs] * num_epochs)
+            d = np.array([num_func for mem, num_func in pairs] * num_epochs)
+            kd = np.array([eq_vcpu_alloc(mem, num_func) for mem, num_func in pairs] * num_epochs)
 
             # Use non-linear least squares to fit the parameters for average time
             # Read
-            popt1, pcov1 = scipy_opt.curve_fit(io_func, d, y_r)
-            y_ = io_func(d, popt1[0], popt1[1])
+            popt1, pcov1, y_ = self.fit_step(io_func, d, y_r)
             err1 = (y_ - y_r) / y_r
-            popt2, pcov2 = scipy_opt.curve_fit(io_func, kd, y_r)
-            y_ = io_func(kd, popt2[0], popt2[1])
+            popt2, pcov2, y_ = self.fit_step(io_func, kd, y_r)
             err2 = (y_ - y_r) / y_r
             # Choose the better one
             s_err1 = np.mean(np.abs(err1))  # abs mean error
@@ -182,11 +248,9 @@ class StagePerfModel:
             # print('--------------------------------')
 
             # Compute
-            popt1, pcov1 = scipy_opt.curve_fit(comp_func, d, y_c)
-            y_ = comp_func(d, popt1[0], popt1[1], popt1[2], popt1[3])
+            popt1, pcov1, y_ = self.fit_step(comp_func, d, y_c)
             err1 = (y_ - y_c) / y_c
-            popt2, pcov2 = scipy_opt.curve_fit(comp_func, kd, y_c)
-            y_ = comp_func(kd, popt2[0], popt2[1], popt2[2], popt2[3])
+            popt2, pcov2, y_ = self.fit_step(comp_func, kd, y_c)
             err2 = (y_ - y_c) / y_c
             # Choose the better one
             s_err1 = np.mean(np.abs(err1))
@@ -211,11 +275,9 @@ class StagePerfModel:
             # print('--------------------------------')
             
             # Write
-            popt1, pcov1 = scipy_opt.curve_fit(io_func, d, y_w)
-            y_ = io_func(d, popt1[0], popt1[1])
+            popt1, pcov1, y_ = self.fit_step(io_func, d, y_w)
             err1 = (y_ - y_w) / y_w
-            popt2, pcov2 = scipy_opt.curve_fit(io_func, kd, y_w)
-            y_ = io_func(kd, popt2[0], popt2[1])
+            popt2, pcov2, y_ = self.fit_step(io_func, kd, y_w)
             err2 = (y_ - y_w) / y_w
             # Choose the better one
             s_err1 = np.mean(np.abs(err1))
@@ -258,34 +320,36 @@ class StagePerfModel:
             self.x2_coeff += self.compute_params_avg[2]
             self.const_coeff += self.read_params_avg[1] + self.compute_params_avg[3] + \
                                 self.write_params_avg[1]
+            self.sum_size_coeff()
             
             # Compute the error for the stage
             y_actual = y_r + y_c + y_w + y_s
-            y_pred = self.x_coeff / d + self.kd_d_coeff / kd + self.const_coeff + np.mean(y_s)
+            y_pred = self.x_coeff / d + self.kd_d_coeff / kd
             if self.can_intra_parallel[1]:
                 y_pred += self.logx_coeff * np.log(kd) / kd + self.x2_coeff / kd**2
             else:
                 y_pred += self.logx_coeff * np.log(d) / d + self.x2_coeff / d**2
+            y_pred = y_pred * s + self.const_coeff + self.size_coeff * s + \
+                    np.mean(self.cold_params_avg) + self.cold_trend(kd / d, d)
             err = (y_pred - y_actual) / y_actual
             s_err = np.mean(np.abs(err))
             m_err = np.mean(err)
             # print('Stage Error:', err)
-            print('Stage {} mean abs error:'.format(self.stage_id), '%.2f'%(s_err*100), '%')
-            print('Stage {} mean error:'.format(self.stage_id), '%.2f'%(m_err*100), '%')
+            if verbose:
+                print('Stage {} mean abs error:'.format(self.stage_id), '%.2f'%(s_err*100), '%')
+                print('Stage {} mean error:'.format(self.stage_id), '%.2f'%(m_err*100), '%')
             
         else:
             # k is the vCPU allocation
             # k_d means the read time may be related to the parent stage's number of functions
-            k = np.array([eq_vcpu_alloc(mem, 1) for mem, num_func in config_pairs] * num_epochs)
-            k_d = np.array([[eq_vcpu_alloc(mem, 1), num_func] for mem, num_func in config_pairs] * num_epochs)
+            k = np.array([eq_vcpu_alloc(mem, 1) for mem, num_func in pairs] * num_epochs)
+            k_d = np.array([[eq_vcpu_alloc(mem, 1), num_func] for mem, num_func in pairs] * num_epochs)
 
             # Use non-linear least squares to fit the parameters for average time
             # Read
-            popt1, pcov1 = scipy_opt.curve_fit(io_func, k, y_r)
-            y_ = io_func(k, popt1[0], popt1[1])
+            popt1, pcov1, y_ = self.fit_step(io_func, k, y_r)
             err1 = (y_ - y_r) / y_r
-            popt2, pcov2 = scipy_opt.curve_fit(io_func2, k_d.T, y_r)
-            y_ = io_func2(k_d.T, popt2[0], popt2[1], popt2[2])
+            popt2, pcov2, y_ = self.fit_step(io_func2, k_d.T, y_r)
             err2 = (y_ - y_r) / y_r
             # # Choose the better one
             s_err1 = np.mean(np.abs(err1))  # abs mean error
@@ -312,8 +376,7 @@ class StagePerfModel:
             # print('--------------------------------')
 
             # Compute, directly use k to fit
-            popt1, pcov1 = scipy_opt.curve_fit(comp_func, k, y_c)
-            y_ = comp_func(k, popt1[0], popt1[1], popt1[2], popt1[3])
+            popt1, pcov1, y_ = self.fit_step(comp_func, k, y_c)
             err1 = (y_ - y_c) / y_c
             s_err1 = np.mean(np.abs(err1))  # abs mean error
             m_err1 = np.mean(err1)
@@ -326,8 +389,7 @@ class StagePerfModel:
             # print('--------------------------------')
 
             # Write, directly use k to fit
-            popt1, pcov1 = scipy_opt.curve_fit(io_func, k, y_w)
-            y_ = io_func(k, popt1[0], popt1[1])
+            popt1, pcov1, y_ = self.fit_step(io_func, k, y_w)
             if y_w[0] > 1e-6:  # Avoid divide by zero, typically happens at the last stage's write
                 err1 = (y_ - y_w) / y_w
                 s_err1 = np.mean(np.abs(err1))  # abs mean error
@@ -355,45 +417,155 @@ class StagePerfModel:
             self.logx_coeff += self.compute_params_avg[1]
             self.x2_coeff += self.compute_params_avg[2]
             self.const_coeff += self.compute_params_avg[3] + self.write_params_avg[1]
+            self.sum_size_coeff()
 
             # Compute the error for the stage
             y_actual = y_r + y_c + y_w + y_s
-            y_pred = self.x_coeff / k + self.kd_d_coeff * k_d.T[1] + self.const_coeff + np.mean(y_s) + \
-                    self.logx_coeff * np.log(k) / k + self.x2_coeff / k**2
+            y_pred = (self.x_coeff / k + self.logx_coeff * np.log(k) / k + \
+                      self.x2_coeff / k**2) * s + self.kd_d_coeff * k_d.T[1] + \
+                    self.const_coeff + self.size_coeff * s + \
+                    np.mean(self.cold_params_avg) + self.cold_trend(k, 1)
             err = (y_pred - y_actual) / y_actual
             s_err = np.mean(np.abs(err))
             m_err = np.mean(err)
             # print('Stage Error:', err)
-            print('Stage {} mean abs error:'.format(self.stage_id), '%.2f'%(s_err*100), '%')
-            print('Stage {} mean error:'.format(self.stage_id), '%.2f'%(m_err*100), '%')
+            if verbose:
+                print('Stage {} mean abs error:'.format(self.stage_id), '%.2f'%(s_err*100), '%')
+                print('Stage {} mean error:'.format(self.stage_id), '%.2f'%(m_err*100), '%')
         
-        print()
-
-    def predict(self, num_vcpu, num_func, mode='latency', parent_d=0, cold_percent=60, input_size = 1024) -> float:
-        # input_size uses MB as unit
-        assert num_vcpu > 0 and num_vcpu <= 10
-        assert num_func > 0
-        assert mode in ['latency', 'cost']
+        if verbose:
+            print()
 
+    def fit_cold(self, y_s, num_epochs, pairs):
+        # Least squares fit of y_s = a + b*d + c/k, not allow_parallel stages always have d = 1
+        k = np.array([eq_vcpu_alloc(mem, 1) for mem, num_func in pairs] * num_epochs)
+        d = np.array([num_func for mem, num_func in pairs] * num_epochs)
+        if self.allow_parallel:
+            A = np.stack([np.ones(len(k)), d, 1.0/k], axis=1)
+        else:
+            A = np.stack([np.ones(len(k)), 1.0/k], axis=1)
+        coeffs = np.linalg.lstsq(A, y_s, rcond=None)[0]
+        # The cold start has rare but huge outliers (e.g., 20s+), so use a robust loss
+        coeffs = scipy_opt.least_squares(lambda w: A @ w - y_s, coeffs,
+                                         loss='soft_l1', f_scale=0.1).x
+        if self.allow_parallel:
+            self.cold_coeffs = [coeffs[1], coeffs[2]]
+        else:
+            self.cold_coeffs = [0, coeffs[1]]
+        # The intercept is kept in the random variable
+        self.cold_params_avg = y_s - self.cold_trend(k, d if self.allow_parallel else 1)
+
+    def cold_trend(self, num_vcpu, num_func):
+        return self.cold_coeffs[0] * num_func + self.cold_coeffs[1] / num_vcpu
+
+    def load_input_sizes(self, stage_profile, num_epochs, pairs):
+        # The optional 'input_size' of a stage profile records the input size (MB) of each epoch,
+        # with shape (num_epochs, ) or (num_epochs, num_config_pairs). Workflow.profile runs the
+        # input of the workflow config only, so profiles of multiple sizes are gathered offline
+        # by running the functions on inputs of those real sizes
+        if 'input_size' not in stage_profile:
+            sizes = np.ones((num_epochs + 1, len(pairs))) * self.default_input_size
+        else:
+            sizes = np.array(stage_profile['input_size'], dtype=float)
+            if sizes.ndim == 1:
+                sizes = np.repeat(sizes[:, None], len(pairs), axis=1)
+        assert sizes.shape == (num_epochs + 1, len(pairs)) and np.all(sizes > 0)
+        sizes = sizes[1:].reshape(-1)
+        self.multi_size = len(np.unique(sizes)) > 1
+        if not self.multi_size:
+            # The model is calibrated at the only profiled input size
+            self.default_input_size = int(sizes[0])
+        self.input_sizes = sizes / self.default_input_size
+
+    # Fit a step with func, or with its input-size-aware variant if there are multiple input sizes
+    def fit_step(self, func, x, y):
+        if self.multi_size:
+            func = size_funcs[func]
+            x = np.vstack([x, self.input_sizes])
+        popt, pcov = scipy_opt.curve_fit(func, x, y)
+        if not np.all(np.isfinite(pcov)):
+            # The covariance cannot be estimated for an exact fit, e.g., a stage without output
+            pcov = np.zeros(pcov.shape)
+        return popt, pcov, func(x, *popt)
+
+    def sum_size_coeff(self):
+        if self.multi_size:
+            self.size_coeff += self.read_params_avg[-1] + self.compute_params_avg[-1] + \
+                               self.write_params_avg[-1]
+
+    def relative_size(self, input_size):
+        if input_size is None:
+            return 1.0
+        assert input_size > 0
+        return input_size / self.default_input_size
+
+    # The basis features multiplied by params[1:], aligned with the coefficient form
+    def basis(self, num_vcpu, num_func, parent_d=0, input_size=None):
         k = eq_vcpu_alloc(num_vcpu*1792, 1)
         kd = eq_vcpu_alloc(num_vcpu*1792, num_func)
         d = num_func
-        x = [1.0/d, 1.0/kd, np.log(d)/d, 1.0/d**2, 1.0]
+        s = self.relative_size(input_size)
+        x = [s/d, s/kd, s*np.log(d)/d, s/d**2, 1.0, s]
         if self.allow_parallel:
             if self.can_intra_parallel[1]:
-                x[2] = np.log(kd)/kd
-                x[3] = 1.0/kd**2
+                x[2] = s*np.log(kd)/kd
+                x[3] = s/kd**2
         else:
-            x = [1.0/k, parent_d, np.log(k)/k, 1.0/k**2, 1.0]
+            x = [s/k, parent_d, s*np.log(k)/k, s/k**2, 1.0, s]
             if not self.parent_relavent:
                 x[1] = 0
-        
+        return np.array(x)
+
+    # The distinct basis features over a config grid, the parent's num_func ranges over parallel_configs
+    def grid_basis(self, vcpu_configs, parallel_configs, input_size=None):
+        res = []
+        for num_vcpu in vcpu_configs:
+            for d in parallel_configs:
+                num_func = d if self.allow_parallel else 1
+                res.append(self.basis(num_vcpu, num_func, parent_d=d, input_size=input_size))
+        return np.unique(np.array(res), axis=0)
+
+    '''
+    The basis features of candidate configs with arrays d, k and the parent's d, i.e., 
+    shape (num_candidates, num_coeffs-1), the same terms as generate_func_code (exact k*d, 
+    the size term only with multiple input sizes). input_size is the absolute size (MB).
+    '''
+    def basis_matrix(self, d, k, parent_d=None, input_size=None):
+        d = np.asarray(d, dtype=float)
+        k = np.asarray(k, dtype=float)
+        s = self.relative_size(input_size)
+        ones = np.ones(len(k))
+        size = s * ones if self.multi_size else 0 * ones
+        if self.allow_parallel:
+            x = k*d if self.can_intra_parallel[1] else d
+            cols = [s/d, s/(k*d), s*np.log(x)/x, s/x**2, ones, size]
+        else:
+            pd = 0 * ones
+            if self.parent_relavent and parent_d is not None:
+                pd = np.asarray(parent_d, dtype=float)
+            cols = [s/k, pd, s*np.log(k)/k, s/k**2, ones, size]
+        return np.stack(cols, axis=1)
+
+    # The cold start trend of candidate configs, the same terms as generate_func_code
+    def cold_trend_matrix(self, d, k):
+        res = self.cold_coeffs[1] / np.asarray(k, dtype=float)
+        if self.allow_parallel:
+            res = res + self.cold_coeffs[0] * np.asarray(d, dtype=float)
+        return res
+
+    def predict(self, num_vcpu, num_func, mode='latency', parent_d=0, cold_percent=60, input_size=None) -> float:
+        # input_size uses MB as unit, None means the default input size
+        assert num_vcpu > 0 and num_vcpu <= 10
+        assert num_func > 0
+        assert mode in ['latency', 'cost']
+
+        x = self.basis(num_vcpu, num_func, parent_d, input_size)
+
         params = self.params()
         pred = np.dot(params[1:], x)
-        if input_size != 1024:
-            pred *= input_size / self.default_input_size
         if mode == 'latency':
             pred += np.percentile(self.cold_params_avg, cold_percent)
+            pred += self.cold_trend(num_vcpu, num_func if self.allow_parallel else 1)
             return pred
         else:
             # 1792 / 1024 * 0.0000000167 * 1000
@@ -409,6 +581,26 @@ class StagePerfModel:
             return (pred * num_func * num_vcpu * 2.9225  + 0.02 * num_func) / 100000
             # <<< swkim
 
+    '''
+    Vectorized prediction over parameter samples in coefficient form, i.e., the output of
+    sample_offline with shape (num_samples, num_coeffs), returns an array with shape (num_samples, )
+    '''
+    def predict_samples(self, samples, num_vcpu, num_func, mode='latency', parent_d=0, 
+                        input_size=None):
+        assert num_vcpu > 0 and num_vcpu <= 10
+        assert num_func > 0
+        assert mode in ['latency', 'cost']
+        samples = np.asarray(samples)
+        assert samples.ndim == 2 and samples.shape[1] == num_coeffs
+
+        x = self.basis(num_vcpu, num_func, parent_d, input_size)
+        pred = samples[:, 1:] @ x
+        if mode == 'latency':
+            return pred + samples[:, 0] + \
+                self.cold_trend(num_vcpu, num_func if self.allow_parallel else 1)
+        else:
+            return (pred * num_func * num_vcpu * 2.9225  + 0.02 * num_func) / 100000
+
     def predict_tile(self, config, profile_path, num_samples, tile=95):
         mem, num_func = config  # Note that the config should be in config_pairs
         assert config in config_pairs
@@ -416,20 +608,9 @@ class StagePerfModel:
         assert num_vcpu > 0 and num_vcpu <= 10
         assert num_func > 0
 
-        kd = eq_vcpu_alloc(mem, num_func)
-        d = num_func
-        x = [1.0/d, 1.0/kd, np.log(d)/d, 1.0/d**2, 1.0]
-
-        # Only used for allow_parallel stages
-        if self.can_intra_parallel[1]:
-            x[2] = np.log(kd)/kd
-            x[3] = 1.0/kd**2
-        
         sample_params = self.sample_offline(num_samples)
-        preds = []
-        for i in range(num_samples):
-            preds.append(np.dot(sample_params[i][1:], x) + sample_params[i][0])
-        pred = np.percentile(np.array(preds), tile)
+        preds = self.predict_samples(sample_params, num_vcpu, num_func)
+        pred = np.percentile(preds, tile)
 
         with open(profile_path, 'r') as f:
             profile = json.load(f)
@@ -462,27 +643,55 @@ class StagePerfModel:
     def params(self, cold_percent=60):
         cold_coeff = np.percentile(self.cold_params_avg, cold_percent)
         res = np.array([cold_coeff, self.x_coeff, self.kd_d_coeff, self.logx_coeff,
-                        self.x2_coeff, self.const_coeff])
+                        self.x2_coeff, self.const_coeff, self.size_coeff])
         return res
 
-    def sample_offline(self, num_samples):
+    # The number of random variables of the stage, i.e., the dimension of a QMC point
+    def sample_dim(self):
+        return 1 + len(self.read_params_avg) + len(self.compute_params_avg) + \
+            len(self.write_params_avg)
+
+    '''
+    Sample the parameters in coefficient form.
+    @param method: 'mc' draws i.i.d. samples; 'sobol' or 'halton' transforms scrambled 
+                   low-discrepancy points u (shape (num_samples, sample_dim), generated if None),
+                   the cold start residual is resampled by the inverse empirical CDF (stratified
+                   in u[:, 0]) and the steps through the Cholesky factors of their covariances
+    '''
+    def sample_offline(self, num_samples, seed=0, method='mc', u=None):
         assert isinstance(num_samples, int) and num_samples > 0
+        assert method in sample_methods
         # Sample for num_samples times
         res = {'cold': [], 'read': [], 'compute': [], 'write': []}
-        # seed_val = int(time.time())
-        seed_val = 0
-        rng = np.random.default_rng(seed=seed_val)
-        res['cold'] = rng.choice(self.cold_params_avg, num_samples)
-        res['read'] = rng.multivariate_normal(self.read_params_avg, self.read_cov_avg, 
-                                              num_samples)
-        res['compute'] = rng.multivariate_normal(self.compute_params_avg, 
-                                                 self.compute_cov_avg, 
-                                                 num_samples)
-        res['write'] = rng.multivariate_normal(self.write_params_avg, 
-                                               self.write_cov_avg,
-                                               num_samples)
+        if method == 'mc':
+            # seed_val = int(time.time())
+            seed_val = seed
+            # Stages draw from independent streams, the same seed would correlate their samples
+            rng = np.random.default_rng(seed=[seed_val, self.stage_id])
+            res['cold'] = rng.choice(self.cold_params_avg, num_samples)
+            res['read'] = rng.multivariate_normal(self.read_params_avg, self.read_cov_avg, 
+                                                  num_samples)
+            res['compute'] = rng.multivariate_normal(self.compute_params_avg, 
+                                                     self.compute_cov_avg, 
+                                                     num_samples)
+            res['write'] = rng.multivariate_normal(self.write_params_avg, 
+                                                   self.write_cov_avg,
+                                                   num_samples)
+        else:
+            if u is None:
+                u = qmc_uniform(method, self.sample_dim(), num_samples, seed)
+            assert u.shape == (num_samples, self.sample_dim())
+            cold = np.sort(self.cold_params_avg)
+            idx = np.minimum((u[:, 0] * len(cold)).astype(int), len(cold) - 1)
+            res['cold'] = cold[idx]
+            pos = 1
+            for step in ['read', 'compute', 'write']:
+                mean = getattr(self, step + '_params_avg')
+                cov = getattr(self, step + '_cov_avg')
+                res[step] = gaussian_from_uniform(mean, cov, u[:, pos:pos+len(mean)])
+                pos += len(mean)
         # Organize into coefficient form
-        coeffs = np.zeros((num_samples, 6))
+        coeffs = np.zeros((num_samples, num_coeffs))
         coeffs[:, 0] = res['cold']
         if self.allow_parallel:
             if self.can_intra_parallel[0]:
@@ -509,28 +718,46 @@ class StagePerfModel:
                 coeffs[:, 5] += res['read'].T[1]
             coeffs[:, 3] += res['compute'].T[1]
             coeffs[:, 4] += res['compute'].T[2]
+        if self.multi_size:
+            coeffs[:, 6] += res['read'].T[-1] + res['compute'].T[-1] + res['write'].T[-1]
 
         return coeffs
 
-    def generate_func_code(self, mode, var, param, parent_id=-1, solver_type='scipy') -> str:
+    # Feed everything the parameters and samples depend on to a hashlib object
+    def update_hash(self, h):
+        for arr in [self.cold_params_avg, self.cold_coeffs, 
+                    self.read_params_avg, self.compute_params_avg, self.write_params_avg, 
+                    self.read_cov_avg, self.compute_cov_avg, self.write_cov_avg, 
+                    self.can_intra_parallel, 
+                    [self.allow_parallel, self.parent_relavent, self.multi_size, 
+                     self.default_input_size]]:
+            h.update(np.asarray(arr, dtype=np.float64).tobytes())
+
+    # The code of the parameters, variables and work (latency without the cold start) of the stage
+    def code_terms(self, var, param, parent_id=-1, solver_type='scipy', size_var='s') -> dict:
         assert isinstance(parent_id, int)
-        assert mode in ['latency', 'cost']
-        assert isinstance(var, str) and isinstance(param, str)
+        assert isinstance(var, str) and isinstance(param, str) and isinstance(size_var, str)
         assert solver_type == 'scipy'
 
-        # 6 param indices and 2 var indices for each stage
-        # 0: cold, 1: x, 2: kd/d, 3: log(x)/x, 4: 1/x**2, 5: const
+        # num_coeffs param indices and 2 var indices for each stage
+        # 0: cold, 1: x, 2: kd/d, 3: log(x)/x, 4: 1/x**2, 5: const, 6: size
         # 0: var d, 1: var k
+        # size_var is the input size (MB), the work terms scale with the relative input size
 
+        t = {}
         s = ''
         offset = 0 if solver_type == 'scipy' else 1
-        cold_param = param + '[%d]'%(self.stage_id*6 + offset)
-        x_param = param + '[%d]'%(self.stage_id*6 + 1 + offset)
-        kd_d_param = param + '[%d]'%(self.stage_id*6 + 2 + offset)
-        logx_param = param + '[%d]'%(self.stage_id*6 + 3 + offset)
-        x2_param = param + '[%d]'%(self.stage_id*6 + 4 + offset)
-        const_param = param + '[%d]'%(self.stage_id*6 + 5 + offset)
-
+        base = self.stage_id*num_coeffs + offset
+        t['cold'] = cold_param = param + '[%d]'%(base)
+        t['x'] = x_param = param + '[%d]'%(base + 1)
+        t['kd_d'] = kd_d_param = param + '[%d]'%(base + 2)
+        t['logx'] = logx_param = param + '[%d]'%(base + 3)
+        t['x2'] = x2_param = param + '[%d]'%(base + 4)
+        t['const'] = const_param = param + '[%d]'%(base + 5)
+        t['size'] = size_param = param + '[%d]'%(base + 6)
+
+        t['d_id'] = self.stage_id*2 + offset
+        t['k_id'] = self.stage_id*2 + 1 + offset
         var_d = var + '[%d]'%(self.stage_id*2 + offset)
         if not self.allow_parallel:
             var_d = '1'
@@ -541,25 +768,45 @@ class StagePerfModel:
         else:
             var_x = var_d
         var_x = '(' + var_x + ')'
+        var_s = '(%s/%r)' % (size_var, self.default_input_size)
+        t['d'], t['k'], t['X'], t['s'] = var_d, var_k, var_x, var_s
+        t['pd_id'] = None
 
         log_method = 'np.log'
 
         if self.allow_parallel:
-            s += x_param + '/' + var_d + ' + '
+            s += '(' + x_param + '/' + var_d + ' + '
             s += kd_d_param + '/' + '(' + var_k + '*' + var_d + ')' + ' + '
             s += logx_param + '*' + log_method + var_x + '/' + var_x + ' + '
-            s += x2_param + '/' + var_x + '**2' + ' + '
+            s += x2_param + '/' + var_x + '**2' + ')*' + var_s + ' + '
             s += const_param
         else:
-            s += x_param + '/' + var_k + ' + ' 
+            s += '(' + x_param + '/' + var_k + ' + ' 
+            s += logx_param + '*' + log_method + '(' + var_k + ')' + '/' + var_k + ' + '
+            s += x2_param + '/' + var_k + '**2' + ')*' + var_s + ' + '
             if self.parent_relavent and parent_id >= 0:
                 var_pd = var + '[%d]'%(parent_id*2)  # parent d
+                t['pd_id'] = parent_id*2
                 s += kd_d_param + '*' + var_pd + ' + '
-            s += logx_param + '*' + log_method + '(' + var_k + ')' + '/' + var_k + ' + '
-            s += x2_param + '/' + var_k + '**2' + ' + '
             s += const_param
+        if self.multi_size:
+            s += ' + ' + size_param + '*' + var_s
+        t['work'] = s
+        return t
+
+    def generate_func_code(self, mode, var, param, parent_id=-1, solver_type='scipy', 
+                           size_var='s') -> str:
+        assert mode in ['latency', 'cost']
+        t = self.code_terms(var, param, parent_id, solver_type, size_var)
+        s = t['work']
+        cold_param, var_d, var_k = t['cold'], t['d'], t['k']
         if mode == 'latency':
-            s = cold_param + ' + ' + s
+            cold = cold_param
+            if self.allow_parallel and self.cold_coeffs[0] != 0:
+                cold += ' + %r*%s' % (float(self.cold_coeffs[0]), var_d)
+            if self.cold_coeffs[1] != 0:
+                cold += ' + %r/%s' % (float(self.cold_coeffs[1]), var_k)
+            s = cold + ' + ' + s
         else:
             # 1792 / 1024 * 0.0000000167 * 1000 = 0.000029225 
             # 1000 is to convert from ms to s
@@ -577,6 +824,54 @@ class StagePerfModel:
             # <<< swkim
         return s
 
+    '''
+    Generate the partial derivatives of the stage latency or cost code, as a list of 
+    (variable index, code), including the parent's d for a stage that reads from its parent.
+    The work terms are differentiated one by one in X = k*d (or d): 
+    d(log(X)/X)/dX = (1 - log(X))/X**2 and d(1/X**2)/dX = -2/X**3.
+    '''
+    def generate_grad_code(self, mode, var, param, parent_id=-1, solver_type='scipy', 
+                           size_var='s') -> list:
+        assert mode in ['latency', 'cost']
+        t = self.code_terms(var, param, parent_id, solver_type, size_var)
+        d, k, X, S = t['d'], t['k'], t['X'], t['s']
+        intra = self.can_intra_parallel[1]
+
+        grad_d = None
+        grad_pd = None
+        if self.allow_parallel:
+            dX = '(%s*(1 - np.log%s)/%s**2 - 2*%s/%s**3)' % (t['logx'], X, X, t['x2'], X)
+            grad_d = '(-%s/%s**2 - %s/(%s*%s**2) + %s*%s)*%s' % (
+                t['x'], d, t['kd_d'], k, d, dX, k if intra else '1', S)
+            grad_k = '(-%s/(%s**2*%s)%s)*%s' % (
+                t['kd_d'], k, d, (' + %s*%s' % (dX, d)) if intra else '', S)
+        else:
+            grad_k = '(-%s/%s**2 + %s*(1 - np.log(%s))/%s**2 - 2*%s/%s**3)*%s' % (
+                t['x'], k, t['logx'], k, k, t['x2'], k, S)
+            if t['pd_id'] is not None:
+                grad_pd = t['kd_d']
+
+        if mode == 'latency':
+            if self.allow_parallel and self.cold_coeffs[0] != 0:
+                grad_d += ' + %r' % float(self.cold_coeffs[0])
+            if self.cold_coeffs[1] != 0:
+                grad_k += ' - %r/%s**2' % (float(self.cold_coeffs[1]), k)
+        else:
+            # cost = work * k * d * 2.9225 + 0.02 * d
+            work = '(' + t['work'] + ')'
+            grad_k = '(%s + %s*(%s))*%s*2.9225' % (work, k, grad_k, d)
+            if grad_d is not None:
+                grad_d = '(%s + %s*(%s))*%s*2.9225 + 0.02' % (work, d, grad_d, k)
+            if grad_pd is not None:
+                grad_pd = '%s*%s*2.9225' % (grad_pd, k)
+
+        res = [(t['k_id'], grad_k)]
+        if grad_d is not None:
+            res.append((t['d_id'], grad_d))
+        if grad_pd is not None:
+            res.append((t['pd_id'], grad_pd))
+        return res
+
     def __str__(self):
         return self.stage_name
     
@@ -4,7 +4,8 @@ import json
 import time
 import scipy.optimize as scipy_opt
 
-from perf_model import config_pairs, eq_vcpu_alloc
+import perf_model
+from perf_model import eq_vcpu_alloc
 
 step_names = ['read', 'compute', 'write']
 
@@ -62,11 +63,19 @@ class AnaPerfModel:
             profile = json.load(f)
         assert isinstance(profile, dict) and self.stage_name in profile
         stage_profile = profile[self.stage_name]
+        self.fit(stage_profile)
+
+    # Fit the model to profile[stage_name] whose columns are aligned with pairs
+    def fit(self, stage_profile, pairs=None, verbose=True) -> None:
         assert isinstance(stage_profile, dict) and \
             'read' in stage_profile and 'compute' in stage_profile and \
             'write' in stage_profile
+        if pairs is None:
+            # Look up at call time, get_config_pairs() rebinds the module-level config_pairs
+            pairs = perf_model.config_pairs
 
-        print('Training Analytical performance model for %s' % self.stage_name)
+        if verbose:
+            print('Training Analytical performance model for %s' % self.stage_name)
         
         read_arr = np.array(stage_profile['read'])[1:,:,0]
         comp_arr = np.array(stage_profile['compute'])[1:,:,0]
@@ -79,7 +88,7 @@ class AnaPerfModel:
         size2points_comp = {}
         size2points_write = {}
         
-        for idx, config in enumerate(config_pairs):
+        for idx, config in enumerate(pairs):
             mem = config[0]
             num_func = config[1]
             # adapt to parallel mode
@@ -142,6 +151,7 @@ class AnaPerfModel:
 
     def predict_tile(self, config, profile_path, num_samples, tile=95):
         mem, num_func = config  # Note that the config should be in config_pairs
+        config_pairs = perf_model.config_pairs
         assert config in config_pairs
         num_vcpu = mem / 1792
         assert num_vcpu > 0 and num_vcpu <= 10
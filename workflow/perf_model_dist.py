@@ -2,6 +2,8 @@ import numpy as np
 import math
 import json
 import time
+import itertools
+from collections import OrderedDict
 
 from utils import Distribution
 
@@ -55,6 +57,18 @@ def get_config_pairs_dist(wf_name):
     config_pairs = pairs
     return config_pairs
 
+# Ids of the memoized results and trained states of all the models, never reused so a cleared 
+# memo upstream cannot match a stale key downstream
+state_ids = itertools.count()
+max_memo_size = 1024
+
+# Put val in the LRU memo, dropping the least recently used entries over max_memo_size
+def memo_put(memo, key, val):
+    memo[key] = val
+    memo.move_to_end(key)
+    while len(memo) > max_memo_size:
+        memo.popitem(last=False)
+
 def eq_vcpu_alloc(mem, num_func):
     num_vcpu = mem / 1792
     # num_vcpu = math.ceil(mem / 1792)
@@ -86,6 +100,14 @@ class DistPerfModel:
         
         self.func_size = 1.0
         
+        # Memo of calculate: (func_size, state ids of the up models) -> (state id, Distribution),
+        # i.e., a stage is only recomputed when its func_size or an upstream result changes
+        self.memo = OrderedDict()
+        self.state_id = None
+        self.interp_memo = OrderedDict()  # func_size -> Distribution
+        # Changed whenever the memo is cleared (train, add_up_model), for the caches built on it
+        self.version = next(state_ids)
+        
     def update_allow_parallel(self, allow_parallel) -> None:
         assert isinstance(allow_parallel, bool)
         self.allow_parallel = allow_parallel
@@ -104,6 +126,12 @@ class DistPerfModel:
             profile = json.load(f)
         assert isinstance(profile, dict) and self.stage_name in profile
         stage_profile = profile[self.stage_name]
+        self.fit(stage_profile)
+
+    # Fit the model to profile[stage_name] whose columns are aligned with pairs
+    def fit(self, stage_profile, pairs=None) -> None:
+        if pairs is None:
+            pairs = config_pairs
         check_1 = isinstance(stage_profile, dict) and 'cold' in stage_profile and \
             'read' in stage_profile and 'compute' in stage_profile and \
             'write' in stage_profile
@@ -121,8 +149,9 @@ class DistPerfModel:
         else:
             stage_arr = np.array(stage_profile['e2e'])[1:,:]
         size2points = {}
+        self.distributions = {}
         
-        for idx, config in enumerate(config_pairs):
+        for idx, config in enumerate(pairs):
             # if idx == 14 or idx == 17:
             #     continue
             mem = config[0]
@@ -142,24 +171,33 @@ class DistPerfModel:
             self.distributions[func_size] = Distribution(size2points[func_size])
             
         self.max_func_size = max(self.distributions.keys())
+        self.clear_memo()
+        
+    def clear_memo(self) -> None:
+        self.memo = OrderedDict()
+        self.state_id = None
+        self.interp_memo = OrderedDict()
+        self.version = next(state_ids)
     
-    # recursive function
+    # recursive function, the result is shared with the memo, copy it before combining
     def calculate(self):
-        cur_dist = self.interpolation(self.func_size)
-        
-        if len(self.up_models) == 0:
+        sub_dists = [sub_model.calculate() for sub_model in self.up_models]
+        key = (self.func_size, tuple(sub_model.state_id for sub_model in self.up_models))
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            self.state_id, cur_dist = self.memo[key]
             return cur_dist
         
-        sub_dist = None
+        cur_dist = self.interpolation(self.func_size)
         
-        for sub_model in self.up_models:
-            dist = sub_model.calculate()
-            if sub_dist is None:
-                sub_dist = dist
-            else:
+        if len(sub_dists) > 0:
+            sub_dist = sub_dists[0].copy()
+            for dist in sub_dists[1:]:
                 sub_dist.combine(dist, 1)
-        cur_dist.combine(sub_dist, 0)
+            cur_dist.combine(sub_dist, 0)
         
+        self.state_id = next(state_ids)
+        memo_put(self.memo, key, (self.state_id, cur_dist))
         return cur_dist
         
     
@@ -167,6 +205,13 @@ class DistPerfModel:
     def interpolation(self, func_size):
         assert func_size >= 0
         
+        if func_size in self.interp_memo:
+            self.interp_memo.move_to_end(func_size)
+        else:
+            memo_put(self.interp_memo, func_size, self.interpolate(func_size))
+        return self.interp_memo[func_size].copy()
+    
+    def interpolate(self, func_size):
         if func_size in self.distributions:
             return self.distributions[func_size].copy()
         
@@ -190,19 +235,16 @@ class DistPerfModel:
         
         # y1 + (y2 - y1) * (x - x1) / (x2 - x1)
         slope = (func_size - lower_size) / (upper_size - lower_size)
-        new_data = []
-        new_prob = []
-        
-        for i in range(len(lower_dist.data)):
-            for j in range(len(upper_dist.data)):
-                new_data.append(lower_dist.data[i] + (upper_dist.data[j] - lower_dist.data[i]) * slope)
-                new_prob.append(lower_dist.prob[i] * upper_dist.prob[j])
+        # Over all pairs of a lower point i and an upper point j
+        new_data = lower_dist.data[:, None] + (upper_dist.data[None, :] - lower_dist.data[:, None]) * slope
+        new_prob = np.outer(lower_dist.prob, upper_dist.prob)
                 
-        return Distribution(new_data, new_prob)
+        return Distribution(new_data.ravel(), new_prob.ravel())
     
     def add_up_model(self, model):
         assert isinstance(model, DistPerfModel)
         self.up_models.append(model)
+        self.clear_memo()
     
 if __name__ == '__main__':
     perfmodel0 = DistPerfModel(0, 'stage0')
@@ -6,16 +6,23 @@ import time
 import json
 import math
 import argparse
+import hashlib
+import functools
 import numpy as np
+import scipy.stats.qmc as scipy_qmc
+from collections import OrderedDict
 
 from workflow import Workflow
 from perf_model import config_pairs
-from perf_model_dist import eq_vcpu_alloc
-from utils import PriorityQueue, MyQueue, PCPSolver, extract_info_from_log, clear_data, orca_extract_info_from_log, orca_save_result
+from perf_model_dist import eq_vcpu_alloc, memo_put
+from utils import PriorityQueue, MyQueue, PCPSolver, ParetoFrontier, DecisionCache, extract_info_from_log, clear_data, orca_extract_info_from_log, orca_save_result
+
+decision_caches = {}  # Path -> DecisionCache loaded in the process
 
 # scheduler is responsible for tuning the launch time,
 # number of function invocation and resource configuration
 # for each stage
+
 class Scheduler(ABC):
     def __init__(self, workflow: Workflow):
         self.workflow = workflow
@@ -106,7 +113,7 @@ class Scheduler(ABC):
 class Jolteon(Scheduler):
     def __init__(self, workflow: Workflow, storage_mode='s3', max_sample_size=10000, ftol=1, 
                  vcpu_configs=[0.6, 1, 1.5, 2, 2.5, 3, 4], parallel_configs=[1, 4, 6, 8, 16, 32], 
-                 need_probe=None, probe_depth=4):
+                 need_probe=None, probe_depth=4, temperature=0.1):
         super().__init__(workflow)
         self.storage_mode = storage_mode
         self.num_funcs = []
@@ -119,6 +126,11 @@ class Jolteon(Scheduler):
         self.max_sample_size = max_sample_size
 
         self.solver = None
+        self.solver_res = None
+        self.objective_func = None
+        self.constraint_func = None
+        self.objective_jac = None
+        self.constraint_jac = None
         self.obj_params = None
         self.cons_params = None
         self.ftol = ftol
@@ -126,6 +138,29 @@ class Jolteon(Scheduler):
         self.parallel_configs = parallel_configs
         self.need_probe = need_probe  # List of configs that need to be probed, None means all
         self.probe_depth = probe_depth
+        self.probe_budget = 10000  # Max number of positions expanded by a probe over all its searches
+        self.temperature = temperature  # Temperature of the smooth maximum over paths
+        self.input_size = None  # MB, None means the default input size of the performance models
+        self.sample_method = 'mc'  # 'mc' for i.i.d. samples, 'sobol' or 'halton' for QMC samples
+        self.qmc_reduction = False  # Cut the QMC sample size by a heuristic without the guarantee
+        self.num_scenarios = 0  # Reduce the samples to weighted scenarios if > 0
+        self.cons_weights = None
+        self.prune = False  # Prune the samples dominated by more than risk * N samples
+        self.sample_cache = True  # Reuse the samples of the same models, size and seed
+        self.num_dominated = 0
+        self.cons_formulation = 'saa'  # 'saa' for per-sample constraints, 'cvar' for the CVaR bound
+        self.num_starts = 0  # Solve from this many initial points and keep the best if > 0
+        self.num_workers = os.cpu_count()
+        self.parallel_probe = False  # Probe over a pool of num_workers processes
+        self.search_mode = 'relax'  # 'relax' rounds and probes the relaxed solution, 'bnb' also runs branch-and-bound
+        self.bnb_time_budget = 10  # s
+        self.time_budget = None  # s, search_config returns the best found so far after it if not None
+        self.sequential = False  # Grow the sample size until the config is validated, see sequential_search
+        self.seq_margin = 0.2  # The validation margin as a fraction of the risk
+        self.timed_out = False  # Whether the time budget cut the last search short
+        self.decision_cache = False  # Reuse the decisions of identical requests on local disk
+        self.max_decisions = 256
+        self.pred_vals = None  # Predicted latency and cost of the searched config
 
     def set_bound(self, bound_type, bound, service_level):
         # service_level is the probability that the latencty or cost is less than the bound
@@ -146,36 +181,233 @@ class Jolteon(Scheduler):
         self.vcpu_configs = vcpu_configs
         self.parallel_configs = parallel_configs
 
-    def set_probe(self, need_probe, probe_depth):
+    def set_sample_method(self, sample_method, qmc_reduction=None):
+        assert sample_method in ['mc', 'sobol', 'halton']
+        self.sample_method = sample_method
+        if qmc_reduction is not None:
+            assert isinstance(qmc_reduction, bool)
+            self.qmc_reduction = qmc_reduction
+
+    def set_sample_cache(self, sample_cache):
+        assert isinstance(sample_cache, bool)
+        self.sample_cache = sample_cache
+
+    def set_decision_cache(self, decision_cache, max_decisions=None):
+        assert isinstance(decision_cache, bool)
+        self.decision_cache = decision_cache
+        if max_decisions is not None:
+            assert isinstance(max_decisions, int) and max_decisions > 0
+            self.max_decisions = max_decisions
+
+    def set_scenario_reduction(self, num_scenarios):
+        assert isinstance(num_scenarios, int) and num_scenarios >= 0
+        self.num_scenarios = num_scenarios
+
+    def set_pruning(self, prune):
+        assert isinstance(prune, bool)
+        self.prune = prune
+
+    def set_cons_formulation(self, cons_formulation):
+        assert cons_formulation in ['saa', 'cvar']
+        self.cons_formulation = cons_formulation
+
+    def set_multi_start(self, num_starts, num_workers=None):
+        assert isinstance(num_starts, int) and num_starts >= 0
+        self.num_starts = num_starts
+        if num_workers is not None:
+            assert isinstance(num_workers, int) and num_workers > 0
+            self.num_workers = num_workers
+
+    def set_parallel_probe(self, parallel_probe, num_workers=None):
+        assert isinstance(parallel_probe, bool)
+        self.parallel_probe = parallel_probe
+        if num_workers is not None:
+            assert isinstance(num_workers, int) and num_workers > 0
+            self.num_workers = num_workers
+
+    def set_search_mode(self, search_mode, time_budget=None):
+        assert search_mode in ['relax', 'bnb']
+        self.search_mode = search_mode
+        if time_budget is not None:
+            assert time_budget > 0
+            self.bnb_time_budget = time_budget
+
+    def set_sequential(self, sequential, seq_margin=None):
+        assert isinstance(sequential, bool)
+        self.sequential = sequential
+        if seq_margin is not None:
+            assert seq_margin > 0 and seq_margin < 1
+            self.seq_margin = seq_margin
+
+    def set_time_budget(self, time_budget):
+        assert time_budget is None or time_budget > 0
+        self.time_budget = time_budget
+
+    # The candidate values of each x, i.e., the configs within its bound (allow_parallel is 
+    # False means 1 function)
+    def config_grids(self, X_bounds):
+        grids = []
+        for i, stage in enumerate(self.workflow.stages):
+            parallel_grid = self.parallel_configs if stage.allow_parallel else [1]
+            for j, grid in enumerate([parallel_grid, self.vcpu_configs]):
+                low, high = X_bounds[2*i+j]
+                in_bound = [v for v in sorted(grid) if (low is None or v >= low) and 
+                            (high is None or v <= high)]
+                if len(in_bound) == 0:
+                    in_bound = [float(np.clip(min(grid), low, high))]
+                grids.append(in_bound)
+        return grids
+
+    '''
+    Initial points for multi-start solving: init_vals, the smallest, middle and largest 
+    configs, and a Latin hypercube over the config grids for the rest.
+    '''
+    def initial_points(self, init_vals, X_bounds, num_starts):
+        grids = self.config_grids(X_bounds)
+        x0s = []
+        if isinstance(init_vals, (int, float)):
+            x0s.append(np.ones(len(grids)) * init_vals)
+        elif init_vals is not None:
+            x0s.append(np.array(init_vals, dtype=float))
+        for pos in [0, 0.5, 1]:
+            x0s.append(np.array([grid[int(pos * (len(grid) - 1))] for grid in grids]))
+        x0s = x0s[:num_starts]
+        if len(x0s) < num_starts:
+            lhs = scipy_qmc.LatinHypercube(d=len(grids), seed=0).random(num_starts - len(x0s))
+            for u in lhs:
+                x0s.append(np.array([grid[int(u[i] * len(grid))] for i, grid in enumerate(grids)]))
+        return x0s
+
+    # Pick the multi-start result whose probed config has the lowest objective (with the mean 
+    # parameters, as the solver minimizes) and a (1-risk)-tile of the constraint within ftol, 
+    # or the lowest constraint tile if none is. Like iter_solve, the samples within ftol of the 
+    # bound do not count as violations
+    def select_start(self, res_list):
+        X = []
+        for res in res_list:
+            num_funcs, num_vcpus = self.check_config(*[list(c) for c in res['probed']])
+            X.append(np.ravel(np.column_stack([num_funcs, num_vcpus])).astype(float))
+        objs, conss = self.solver.eval_configs(np.array(X), 100 * (1 - self.risk))
+        for i, res in enumerate(res_list):
+            print('Start %d:' % i, 'status', res['status'], 'obj', objs[i], 
+                  'cons', conss[i] + self.solver.bound)
+        feasible = np.where(conss <= self.solver.ftol)[0]
+        if len(feasible) == 0:
+            return res_list[int(np.argmin(conss))]
+        return res_list[int(feasible[np.argmin(objs[feasible])])]
+
+    # Drop the samples that cannot affect the (1-risk)-tile over the config grid
+    def prune_samples(self):
+        t0 = time.time()
+        num_samples = len(self.cons_params)
+        self.cons_params, self.num_dominated = self.workflow.prune_samples(
+            self.cons_params, self.risk, self.vcpu_configs, self.parallel_configs, self.input_size)
+        t1 = time.time()
+        print('Pruned samples:', num_samples, '->', len(self.cons_params), 
+              '(reduction %.2f%%)' % (100 * self.num_dominated / num_samples))
+        print('Prune time:', t1-t0, 's\n')
+
+    # Reduce the samples to weighted scenarios, clustered on the stage values at the config x
+    def reduce_scenarios(self, x):
+        t0 = time.time()
+        x = np.ones(2*len(self.workflow.stages)) * x if np.isscalar(x) else np.array(x)
+        stages = self.workflow.stages
+        old_config = ([stage.config['memory'] for stage in stages], 
+                      [stage.num_func for stage in stages])
+        self.workflow.update_workflow_config([x[2*i+1]*1792 for i in range(len(stages))], 
+                                             [x[2*i] for i in range(len(stages))], real=False)
+        num_samples = len(self.cons_params)
+        self.cons_params, self.cons_weights, err = self.workflow.reduce_samples(
+            self.cons_params, self.num_scenarios, self.risk, self.bound_type, self.input_size)
+        self.workflow.update_workflow_config(old_config[0], old_config[1], real=False)
+        t1 = time.time()
+        print('Scenarios:', num_samples, '->', len(self.cons_params))
+        print('Reduction error: Wasserstein %.4f, %.1f-tile %.4f' % 
+              (err[0], 100 * (1 - self.risk), err[1]))
+        print('Reduction time:', t1-t0, 's\n')
+
+    def set_input_size(self, input_size):
+        # Right-size the configuration for a request with the given input size
+        assert input_size is None or input_size > 0
+        self.input_size = input_size
+
+    # Bind the input size to the generated functions
+    def bind_input_size(self, *funcs):
+        if self.input_size is None:
+            return funcs
+        return tuple(functools.partial(func, s=self.input_size) for func in funcs)
+
+    # Batched objective and constraint over candidate configs for probing and prediction
+    def batch_funcs(self):
+        return self.workflow.batch_evaluator(self.bound_type, self.temperature, self.input_size)
+
+    def set_probe(self, need_probe, probe_depth, probe_budget=None):
         assert isinstance(need_probe, list)
         self.need_probe = need_probe
         self.probe_depth = probe_depth
+        if probe_budget is not None:
+            assert isinstance(probe_budget, int) and probe_budget > 0
+            self.probe_budget = probe_budget
 
     def store_params_and_samples(self):
         param_path = self.workflow.store_params()
-        sample_path = self.workflow.sample_offline(self.max_sample_size)
+        sample_path = self.workflow.sample_offline(self.max_sample_size, method=self.sample_method)
         return param_path, sample_path
     
-    def get_params_and_samples(self, sample_size=None):
-        t0 = time.time()
-        self.obj_params = self.workflow.get_params()
-        num_samples = PCPSolver.sample_size(len(self.workflow.stages), 
-                                            self.risk, 0, self.confidence_error)
+    def x_bounds(self, x_bound=None):
+        return PCPSolver.x_bounds(2*len(self.workflow.stages), x_bound)
+
+    '''
+    The number of configs the search can return: the probed x (need_probe, None means all) 
+    move over the whole config lists, and the other x are rounded from within x_bound. 
+    Stages with allow_parallel False have one parallelism config.
+    '''
+    def search_space_size(self, x_bound=None):
+        X_bounds = self.x_bounds(x_bound)
+        lows = [low if low is not None else 0 for low, _ in X_bounds]
+        highs = [high if high is not None else np.inf for _, high in X_bounds]
+        (d_lows, k_lows), (d_highs, k_highs) = self.round_config(lows), self.round_config(highs)
+        size = 1
+        for i, stage in enumerate(self.workflow.stages):
+            parallel_configs = self.parallel_configs if stage.allow_parallel else [1]
+            for j, (configs, low, high) in enumerate([(parallel_configs, d_lows[i], d_highs[i]), 
+                                                      (self.vcpu_configs, k_lows[i], k_highs[i])]):
+                if self.need_probe is None or not any(self.need_probe) or self.need_probe[2*i+j]:
+                    size *= len(configs)
+                else:
+                    size *= max(1, len([v for v in configs if v >= low and v <= high]))
+        return size
+
+    def num_samples(self, sample_size=None, x_bound=None, confidence_error=None):
         if sample_size is not None:
             assert isinstance(sample_size, int) and sample_size > 0
-            num_samples = sample_size
-        self.cons_params = self.workflow.sample_online(num_samples)
+            return sample_size
+        if confidence_error is None:
+            confidence_error = self.confidence_error
+        return PCPSolver.sample_size(len(self.workflow.stages), self.risk, 0, 
+                                     confidence_error, self.sample_method, 
+                                     self.search_space_size(x_bound), self.qmc_reduction)
+
+    def get_params_and_samples(self, sample_size=None, x_bound=None):
+        t0 = time.time()
+        self.obj_params = self.workflow.get_params()
+        num_samples = self.num_samples(sample_size, x_bound)
+        self.cons_params = self.workflow.sample_online(num_samples, method=self.sample_method, 
+                                                       cache=self.sample_cache)
         t1 = time.time()
         print('Sample size:', num_samples)
         print('Sample time:', t1-t0, 's\n')
-
-    # Generate the objective and constraint functions code at './funcs.py'
-    def generate_func_code(self, func_path='./funcs.py'):
-        if func_path != './funcs.py' and func_path != 'funcs.py':
-            raise ValueError('The function path must be ./funcs.py')
-        self.workflow.generate_func_code(func_path, self.workflow.critical_path, 
-                                         self.workflow.secondary_path, 
-                                         cons_mode=self.bound_type)
+        self.num_dominated = 0
+        if self.prune:
+            self.prune_samples()
+
+    # Generate and compile the objective and constraint functions, optionally write the code to func_path
+    def generate_func_code(self, func_path=None):
+        self.objective_func, self.constraint_func, self.objective_jac, self.constraint_jac = \
+            self.workflow.compile_funcs(cons_mode=self.bound_type, temperature=self.temperature)
+        if func_path is not None:
+            self.workflow.generate_func_code(func_path, cons_mode=self.bound_type, 
+                                             temperature=self.temperature)
 
     def round_config(self, x):
         # x is a list of the number of functions and vcpus for each stage, aligned with res['x']
@@ -205,44 +437,63 @@ class Jolteon(Scheduler):
             num_vcpus.append(num_vcpu)
         return num_funcs, num_vcpus
 
+    '''
+    With time_budget, the solves and probes stop at time_budget seconds after the call and the 
+    config is the best found so far. If it is infeasible, it falls back to the rounded solution 
+    if feasible, otherwise to the (rounded) initial point. timed_out records whether the budget 
+    cut the search short.
+    '''
     def search_config(self, param_path=None, sample_path=None, 
                       init_vals=None, x_bound=None, load=False):
+        deadline = None
+        if self.time_budget is not None:
+            deadline = time.time() + self.time_budget
         # Assume the functions have been generated
-        from funcs import objective_func, constraint_func
-        if self.workflow.secondary_path is not None:
-            from funcs import constraint_func_2 
+        assert self.objective_func is not None and self.constraint_func is not None
+        objective_func, constraint_func, objective_jac, constraint_jac = self.bind_input_size(
+            self.objective_func, self.constraint_func, self.objective_jac, self.constraint_jac)
 
         if load:
             t0 = time.time()
             assert param_path is not None and sample_path is not None
             self.obj_params = self.workflow.load_params(param_path)
-            num_samples = PCPSolver.sample_size(len(self.workflow.stages), self.risk, 0, 
-                                                self.confidence_error)
+            num_samples = self.num_samples(x_bound=x_bound)
             print('Sample size:', num_samples, '\n')
             self.cons_params = self.workflow.load_samples(sample_path, num_samples)
             t1 = time.time()
             print('Load time:', t1-t0, 's\n')
+            self.num_dominated = 0
+            if self.prune:
+                self.prune_samples()
+
+        self.cons_weights = None
+        if self.num_scenarios > 0:
+            self.reduce_scenarios(init_vals if init_vals is not None else 2)
 
         t0 = time.time()
-        # <<< swkim
-        if self.workflow.secondary_path is not None:
-            self.solver = PCPSolver(2*len(self.workflow.stages), objective_func, constraint_func, 
-                                    self.bound, self.obj_params, self.cons_params, 
-                                    risk=self.risk, confidence_error=self.confidence_error, constraint_2=constraint_func_2,
-                                    ftol=self.ftol, k_configs=self.vcpu_configs, d_configs=self.parallel_configs, 
-                                    bound_type=self.bound_type, 
-                                    need_probe=self.need_probe, probe_depth=self.probe_depth)
-        else:
-            self.solver = PCPSolver(2*len(self.workflow.stages), objective_func, constraint_func, 
-                                    self.bound, self.obj_params, self.cons_params, 
-                                    risk=self.risk, confidence_error=self.confidence_error,
-                                    ftol=self.ftol, k_configs=self.vcpu_configs, d_configs=self.parallel_configs, 
-                                    bound_type=self.bound_type, 
-                                    need_probe=self.need_probe, probe_depth=self.probe_depth)
-        # <<< swkim
+        self.solver = PCPSolver(2*len(self.workflow.stages), objective_func, constraint_func, 
+                                self.bound, self.obj_params, self.cons_params, 
+                                risk=self.risk, confidence_error=self.confidence_error,
+                                ftol=self.ftol, k_configs=self.vcpu_configs, d_configs=self.parallel_configs, 
+                                bound_type=self.bound_type, 
+                                need_probe=self.need_probe, probe_depth=self.probe_depth, 
+                                probe_budget=self.probe_budget, 
+                                cons_weights=self.cons_weights, num_dominated=self.num_dominated, 
+                                objective_jac=objective_jac, constraint_jac=constraint_jac, 
+                                batch_funcs=self.batch_funcs(), 
+                                cons_formulation=self.cons_formulation, deadline=deadline)
  
-        res = self.solver.iter_solve(init_vals, x_bound)
+        if self.num_starts > 0:
+            x0s = self.initial_points(init_vals, self.x_bounds(x_bound), self.num_starts)
+            res_list = self.solver.multi_start(x0s, x_bound, self.num_workers, 
+                                               self.workflow.func_code(self.bound_type, 
+                                                                       temperature=self.temperature), 
+                                               self.input_size, self.round_config)
+            res = self.select_start(res_list)
+        else:
+            res = self.solver.iter_solve(init_vals, x_bound)
         t1 = time.time()
+        self.solver_res = res
         # print('Final bound:', self.solver.bound)
         print('Solver res:', res)
         print('Solve time:', t1-t0, 's\n')
@@ -251,14 +502,56 @@ class Jolteon(Scheduler):
         
         self.num_funcs, self.num_vcpus = self.round_config(res['x'])
         print('[after round] num_func:', self.num_funcs, 'num_vcpu', self.num_vcpus)
+        rounded = self.check_config(self.num_funcs, self.num_vcpus)
 
         t0 = time.time()
-        self.num_funcs, self.num_vcpus = self.solver.probe(self.num_funcs, self.num_vcpus)
+        if 'probed' in res:
+            # Probed by multi-start
+            self.num_funcs, self.num_vcpus = [list(c) for c in res['probed']]
+        elif self.parallel_probe:
+            self.num_funcs, self.num_vcpus = self.solver.probe_parallel(
+                self.num_funcs, self.num_vcpus, self.num_workers, 
+                self.workflow.func_code(self.bound_type, temperature=self.temperature), 
+                self.input_size)
+        else:
+            self.num_funcs, self.num_vcpus = self.solver.probe(self.num_funcs, self.num_vcpus)
         t1 = time.time()
         print('[after probe] num_func:', self.num_funcs, 'num_vcpu', self.num_vcpus)
         print('Probe time:', t1-t0, 's\n')
 
+        # The workers of multi-start and the parallel probe do not report their cuts
+        self.solver.expired()
+        if self.search_mode == 'bnb' and not self.solver.timed_out:
+            # Search the grid within x_bound for the configs that check_config keeps, with the 
+            # checked probed config as the incumbent
+            leaf_check = lambda d, k: self.check_config(list(d), list(k)) == (list(d), list(k))
+            t0 = time.time()
+            time_budget = self.bnb_time_budget
+            if deadline is not None:
+                time_budget = min(time_budget, deadline - t0)
+            bnb_res = self.solver.branch_and_bound(self.config_grids(self.x_bounds(x_bound)), 
+                                                   self.check_config(self.num_funcs, self.num_vcpus), 
+                                                   time_budget, leaf_check)
+            t1 = time.time()
+            self.solver.expired()
+            if bnb_res['d'] is not None:
+                self.num_funcs, self.num_vcpus = bnb_res['d'], bnb_res['k']
+            print('[after B&B] num_func:', self.num_funcs, 'num_vcpu', self.num_vcpus)
+            print('B&B nodes:', bnb_res['nodes'], 'obj:', bnb_res['obj_val'], 
+                  'gap:', bnb_res['gap'])
+            print('B&B time:', t1-t0, 's\n')
+
         self.num_funcs, self.num_vcpus = self.check_config(self.num_funcs, self.num_vcpus)
+        self.timed_out = self.solver.timed_out
+        if self.timed_out and not self.config_feasible(self.num_funcs, self.num_vcpus):
+            if self.config_feasible(*rounded):
+                print('Fall back to the rounded solution')
+                self.num_funcs, self.num_vcpus = rounded
+            else:
+                print('Fall back to the initial point')
+                self.num_funcs, self.num_vcpus = self.initial_config(init_vals)
+        if self.time_budget is not None:
+            print('Time budget exceeded:', self.timed_out)
         
         print('num_funcs:', self.num_funcs)
         print('num_vcpus:', self.num_vcpus)
@@ -270,10 +563,235 @@ class Jolteon(Scheduler):
         print()
 
         lat, cost = self.solver.get_vals(self.num_funcs, self.num_vcpus)
+        self.pred_vals = (float(lat), float(cost))
         print('Predicted latency:', lat)
         print('Predicted cost:', cost)
         print()
 
+    '''
+    Sequential sample size: search with 1/8, 1/4 and 1/2 of the full sample size in turn, at 
+    the risk minus a margin, and stop once the violation ratio of the config over independent 
+    i.i.d. validation samples plus the margin is within the risk. Otherwise search with the 
+    full sample size at the risk. The validation size makes the margin a one-sided Hoeffding 
+    bound with confidence_error / 2 split over the validations, and the full sample size is 
+    computed with the other half, so the config violates the bound for at most risk with 
+    probability at least 1 - confidence_error either way. A validation evaluates one config, 
+    so its samples are much cheaper than those of the search.
+    @return: whether a smaller sample size was validated
+    '''
+    def sequential_search(self, init_vals=None, x_bound=None):
+        full_size = self.num_samples(None, x_bound, self.confidence_error / 2)
+        sizes = []
+        size = math.ceil(full_size / 8)
+        while size < full_size:
+            sizes.append(size)
+            size *= 2
+        risk = self.risk
+        margin = self.seq_margin * risk
+        num_val = math.ceil(math.log(len(sizes) / (self.confidence_error / 2)) / (2 * margin**2))
+        t0 = time.time()
+        val_params = self.workflow.sample_online(num_val, seed=1, method='mc', 
+                                                 cache=self.sample_cache)
+        t1 = time.time()
+        print('Validation size:', num_val, 'margin:', margin)
+        print('Validation sample time:', t1-t0, 's\n')
+
+        for size in sizes:
+            self.get_params_and_samples(size)
+            self.risk = risk - margin
+            try:
+                self.search_config(init_vals=init_vals, x_bound=x_bound)
+            finally:
+                self.risk = risk
+            ratio = self.violation_ratio(self.num_funcs, self.num_vcpus, val_params)
+            print('Validation ratio:', ratio, 'sample size:', size)
+            if ratio + margin <= risk:
+                print('Validated sample size:', size, 'of', full_size, '\n')
+                return True
+            init_vals = self.solver_res['x']
+        self.get_params_and_samples(full_size)
+        self.search_config(init_vals=init_vals, x_bound=x_bound)
+        print('Validated sample size: None, full size', full_size, '\n')
+        return False
+
+    # The ratio of the samples (parameters by rows, as cons_params) where the config exceeds the bound
+    def violation_ratio(self, num_funcs, num_vcpus, samples):
+        x = np.ravel(np.column_stack([num_funcs, num_vcpus])).astype(float)
+        vals = self.batch_funcs().constraint(x, np.ascontiguousarray(np.asarray(samples).T), 
+                                             self.bound)
+        return float(np.mean(np.asarray(vals).ravel() > 0))
+
+    # Whether the (1-risk)-tile of the bounded value of the config is within the bound
+    def config_feasible(self, num_funcs, num_vcpus):
+        x = np.ravel(np.column_stack([num_funcs, num_vcpus])).astype(float)
+        return self.solver.eval_conss(x, 100 * (1 - self.risk))[0] <= 0
+
+    # The rounded and checked config of init_vals, a number for all or one per x as in PCPSolver.solve
+    def initial_config(self, init_vals=None):
+        x0 = np.broadcast_to(np.asarray(2 if init_vals is None else init_vals, dtype=float), 
+                             (2*len(self.workflow.stages), ))
+        return self.check_config(*self.round_config(x0))
+
+    # The searched config as a frontier point, with the percentile of the bounded value and the objective
+    def frontier_point(self):
+        x = np.ravel(np.column_stack([self.num_funcs, self.num_vcpus])).astype(float)
+        objs, conss = self.solver.eval_configs(x, 100 * (1 - self.risk))
+        return {'bound': float(conss[0] + self.solver.bound), 'obj': float(objs[0]), 
+                'num_funcs': np.array(self.num_funcs).tolist(), 
+                'num_vcpus': np.array(self.num_vcpus).tolist()}
+
+    # What the searched config depends on besides the bound and the samples
+    def search_settings(self, x_bound=None):
+        return {'workflow': self.workflow.workflow_name, 'model_hash': self.workflow.model_hash(), 
+                'bound_type': self.bound_type, 'risk': self.risk, 
+                'confidence_error': self.confidence_error, 'sample_method': self.sample_method, 'num_scenarios': self.num_scenarios, 
+                'prune': self.prune, 'temperature': self.temperature, 'input_size': self.input_size, 
+                'vcpu_configs': self.vcpu_configs, 'parallel_configs': self.parallel_configs, 
+                'need_probe': self.need_probe, 'probe_depth': self.probe_depth, 
+                'search_mode': self.search_mode, 'num_starts': self.num_starts, 
+                'cons_formulation': self.cons_formulation, 'sequential': self.sequential, 
+                'seq_margin': self.seq_margin, 'x_bound': x_bound}
+
+    # What the frontier depends on besides the bound, normalized by json to compare with a stored one
+    def frontier_meta(self, x_bound=None, sample_size=None):
+        meta = self.search_settings(x_bound)
+        meta['num_samples'] = self.num_samples(sample_size, x_bound)
+        return json.loads(json.dumps(meta))
+
+    def frontier_path(self, meta):
+        key = hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()[:16]
+        frontier_dir = os.path.join(os.path.dirname(self.workflow.metadata_path('samples')), 'frontier')
+        file_name = '%s_%s_%s.json' % (self.workflow.workflow_name.replace('/', '-'), 
+                                       self.bound_type, key)
+        return os.path.join(frontier_dir, file_name)
+
+    '''
+    Compute the Pareto frontier of the current bound type and service level by searching the 
+    configs under the current bound and num_points bounds from the loosest to the tightest, 
+    each warm-started from the previous solution. The bounds are spread geometrically between 
+    the bounded values of the smallest and largest configs within x_bound.
+    '''
+    def build_frontier(self, num_points=16, init_vals=None, x_bound=None):
+        assert isinstance(num_points, int) and num_points > 0
+        bound_type, bound, service_level = self.bound_type, self.bound, 1 - self.risk
+        frontier = ParetoFrontier(bound_type, service_level)
+
+        self.search_config(init_vals=init_vals, x_bound=x_bound)
+        # The searches cut by the time budget are not Pareto optimal
+        if not self.timed_out:
+            frontier.insert(self.frontier_point())
+        grids = self.config_grids(self.x_bounds(x_bound))
+        X = np.array([[grid[0] for grid in grids], [grid[-1] for grid in grids]], dtype=float)
+        vals = self.solver.eval_conss(X, 100 * (1 - self.risk)) + self.solver.bound
+        warm = self.solver_res['x']
+        for b in np.geomspace(np.max(vals), np.min(vals), num_points):
+            self.set_bound(bound_type, float(b), service_level)
+            self.search_config(init_vals=warm, x_bound=x_bound)
+            if not self.timed_out:
+                frontier.insert(self.frontier_point())
+            warm = self.solver_res['x']
+        self.set_bound(bound_type, bound, service_level)
+        return frontier
+
+    '''
+    Answer a bound query from the Pareto frontier of (bound_type, service_level), loaded by the 
+    model hash and the search settings, or computed once by build_frontier and saved. The 
+    config is the frontier point with the lowest objective within the bound, found by bisect. 
+    With exact, if the bound is more than rel_tol above the point (or below the frontier), the 
+    config is searched under the bound warm-started from the point and added to the frontier.
+    The functions are compiled and the samples drawn only to build the frontier or to search.
+    @return: the frontier point, None if no point is within the bound
+    '''
+    def query_frontier(self, bound_type, bound, service_level, exact=True, rel_tol=0.01, 
+                       num_points=16, init_vals=None, x_bound=None, sample_size=None):
+        self.set_bound(bound_type, bound, service_level)
+        meta = self.frontier_meta(x_bound, sample_size)
+        path = self.frontier_path(meta)
+
+        t0 = time.time()
+        frontier = ParetoFrontier.load(path, meta)
+        if frontier is None:
+            self.prepare_search(sample_size, x_bound)
+            frontier = self.build_frontier(num_points, init_vals, x_bound)
+            frontier.save(path, meta)
+            print('Frontier saved to', path)
+        else:
+            print('Frontier loaded from', path)
+        t1 = time.time()
+        print('Frontier points:', len(frontier))
+        print('Frontier time:', t1-t0, 's\n')
+
+        point = frontier.lookup(bound)
+        if exact and (point is None or bound - point['bound'] > rel_tol * bound):
+            if point is not None:
+                init_vals = np.ravel(np.column_stack([point['num_funcs'], 
+                                                      point['num_vcpus']])).astype(float)
+            self.prepare_search(sample_size, x_bound)
+            self.search_config(init_vals=init_vals, x_bound=x_bound)
+            new_point = self.frontier_point()
+            if not self.timed_out and new_point['bound'] <= bound and frontier.insert(new_point):
+                frontier.save(path, meta)
+            point = frontier.lookup(bound)
+        if point is not None:
+            self.num_funcs, self.num_vcpus = list(point['num_funcs']), list(point['num_vcpus'])
+        print('Frontier point:', point)
+        return point
+
+    # Compile the functions of the current bound type, and draw the samples unless drawn
+    def prepare_search(self, sample_size=None, x_bound=None):
+        self.generate_func_code()
+        if self.cons_params is None:
+            self.get_params_and_samples(sample_size, x_bound)
+
+    def decision_key(self, init_vals=None, x_bound=None, sample_size=None):
+        request = self.search_settings(x_bound)
+        request.update({'config_hash': self.workflow.config_hash, 'bound': self.bound, 
+                        'num_samples': self.num_samples(sample_size, x_bound), 
+                        'init_vals': None if init_vals is None else np.asarray(init_vals).tolist()})
+        return DecisionCache.key(request)
+
+    def open_decision_cache(self):
+        path = os.path.join(os.path.dirname(self.workflow.metadata_path('samples')), 'decisions', 
+                            self.workflow.workflow_name.replace('/', '-') + '.json')
+        if path not in decision_caches:
+            decision_caches[path] = DecisionCache(path, self.max_decisions)
+        cache = decision_caches[path]
+        cache.invalidate(self.workflow.model_hash())
+        return cache
+
+    '''
+    Look up the decision of an identical request, i.e., same workflow config, model hash, bound, 
+    service level, confidence, config ranges and search settings, before sampling and compiling.
+    @return: the decision with num_funcs, num_vcpus, latency and cost, None on a miss
+    '''
+    def lookup_decision(self, init_vals=None, x_bound=None, sample_size=None):
+        t0 = time.time()
+        cache = self.open_decision_cache()
+        decision = cache.get(self.decision_key(init_vals, x_bound, sample_size))
+        if decision is not None:
+            self.num_funcs, self.num_vcpus = list(decision['num_funcs']), list(decision['num_vcpus'])
+            self.pred_vals = (decision['latency'], decision['cost'])
+        t1 = time.time()
+        print('Decision cache hit:', decision is not None)
+        print('Decision cache time:', t1-t0, 's\n')
+        if decision is not None:
+            print('num_funcs:', self.num_funcs)
+            print('num_vcpus:', self.num_vcpus)
+            print('Predicted latency:', self.pred_vals[0])
+            print('Predicted cost:', self.pred_vals[1])
+            print()
+        return decision
+
+    # Store the searched config of the request, assume search_config has been called
+    def store_decision(self, init_vals=None, x_bound=None, sample_size=None):
+        assert self.pred_vals is not None
+        cache = self.open_decision_cache()
+        decision = {'model_hash': self.workflow.model_hash(), 
+                    'num_funcs': np.array(self.num_funcs).tolist(), 
+                    'num_vcpus': np.array(self.num_vcpus).tolist(), 
+                    'latency': self.pred_vals[0], 'cost': self.pred_vals[1]}
+        cache.put(self.decision_key(init_vals, x_bound, sample_size), decision)
+
     def set_config(self, real=True):
         # mem_list = [int(self.num_vcpus[i]*1792) for i in range(len(self.num_vcpus))]
         # <<< swkim
@@ -288,16 +806,18 @@ class Jolteon(Scheduler):
 
     def predict(self, file_path='./config.json'):
         # Assume the functions have been generated
-        from funcs import objective_func, constraint_func
-        if self.workflow.secondary_path is not None:
-            from funcs import constraint_func_2 
+        assert self.objective_func is not None and self.constraint_func is not None
+        objective_func, constraint_func = self.bind_input_size(self.objective_func, 
+                                                               self.constraint_func)
 
         self.solver = PCPSolver(2*len(self.workflow.stages), objective_func, constraint_func, 
                                 self.bound, self.obj_params, self.cons_params, 
                                 risk=self.risk, confidence_error=self.confidence_error,
                                 ftol=self.ftol, k_configs=self.vcpu_configs, d_configs=self.parallel_configs, 
                                 bound_type=self.bound_type, 
-                                need_probe=self.need_probe, probe_depth=self.probe_depth)
+                                need_probe=self.need_probe, probe_depth=self.probe_depth, 
+                                probe_budget=self.probe_budget, 
+                                num_dominated=self.num_dominated, batch_funcs=self.batch_funcs())
         
         with open(file_path, 'r') as f:
             config = json.load(f)
@@ -360,6 +880,12 @@ class Orion(Caerus):
         if init_mem is not None:
             self.init_mem = [init_mem for i in range(len(self.workflow.stages))]
         self.stage_threshold = 6
+        # Per-config LRU caches of the search, keyed by the func sizes of the stages:
+        # func sizes -> DAG distribution and (func sizes, confidence) -> cost, 
+        # valid for the versions of the stage models
+        self.dists = OrderedDict()
+        self.costs = OrderedDict()
+        self.model_versions = None
         
     def set_config(self, total_parallelism, latency, confidence, need_search=True):
         num_funcs = [int(item * total_parallelism) for item in self.parallelism_ratio]
@@ -489,22 +1015,42 @@ class Orion(Caerus):
                     if dist.probility(latency) >= confidence:
                         return new_val
 
-    def get_distribution(self, config_list):
+    # The func sizes of the stages under config_list, which key the caches
+    def set_func_sizes(self, config_list):
         vcpus = []
         for idx, memory in enumerate(config_list):
             vcpus.append(eq_vcpu_alloc(memory, self.num_funcs[idx]))
             
         for stage in self.workflow.stages:
             stage.perf_model.set_func_size(vcpus[stage.stage_id])
+        return vcpus
+    
+    # Clear the caches if a stage model was trained (or profiled and trained) since they were built
+    def check_cache(self):
+        versions = tuple(stage.perf_model.version for stage in self.workflow.stages)
+        if versions != self.model_versions:
+            self.dists = OrderedDict()
+            self.costs = OrderedDict()
+            self.model_versions = versions
+
+    # The result is shared with the cache, do not modify it
+    def get_distribution(self, config_list):
+        self.check_cache()
+        vcpus = self.set_func_sizes(config_list)
+        t = tuple(stage.perf_model.func_size for stage in self.workflow.stages)
+        if t in self.dists:
+            self.dists.move_to_end(t)
+            return self.dists[t]
             
         dist = None
         for stage in self.workflow.sinks:
             tmp_dist = stage.perf_model.calculate()
             if dist is None:
-                dist = tmp_dist
+                dist = tmp_dist.copy()
             else:
                 dist.combine(tmp_dist, 1)
                 
+        memo_put(self.dists, t, dist)
         return dist
     
     def get_latency(self, config_list, confidence):
@@ -512,17 +1058,18 @@ class Orion(Caerus):
         return dist.tail_value(confidence)
     
     def get_cost(self, config_list, confidence):
-        vcpus = []
-        for idx, memory in enumerate(config_list):
-            vcpus.append(eq_vcpu_alloc(memory, self.num_funcs[idx]))
-            
-        for stage in self.workflow.stages:
-            stage.perf_model.set_func_size(vcpus[stage.stage_id])
+        self.check_cache()
+        vcpus = self.set_func_sizes(config_list)
+        t = tuple(stage.perf_model.func_size for stage in self.workflow.stages)
+        if (t, confidence) in self.costs:
+            self.costs.move_to_end((t, confidence))
+            return self.costs[(t, confidence)]
             
         cost = 0
         for idx, stage in enumerate(self.workflow.stages):
             tmp_dist = stage.perf_model.interpolation(stage.perf_model.func_size)
             cost += tmp_dist.tail_value(confidence) * vcpus[idx]
+        memo_put(self.costs, (t, confidence), cost)
         return cost
 
     def predict_tile(self, config_list, tile):
@@ -831,6 +1378,20 @@ def main():
     parser.add_argument('-r', '--real_run', type=int, default=1, help='real run or not, 1 or 0')
     parser.add_argument('-ss', '--sample_size', type=int, default=0, help='sample size, used by jolteon')
     parser.add_argument('-sd', '--subdir', type=str, default='', help='subdir of result file, used by orca')
+    parser.add_argument('-is', '--input_size', type=float, default=0, help='input size (MB) of the request, 0 means the default, used by jolteon')
+    parser.add_argument('-sp', '--sample_method', type=str, default='mc', help='parameter sampling, mc, sobol or halton, used by jolteon')
+    parser.add_argument('-qr', '--qmc_reduction', type=int, default=0, help='cut the sample size of sobol or halton samples by a heuristic without the guarantee or not, 0 or 1, used by jolteon')
+    parser.add_argument('-rs', '--reduced_scenarios', type=int, default=0, help='reduce the samples to this many weighted scenarios, 0 means no reduction, used by jolteon')
+    parser.add_argument('-sc', '--sample_cache', type=int, default=1, help='reuse the cached samples or not, 0 or 1, used by jolteon')
+    parser.add_argument('-pr', '--prune', type=int, default=0, help='prune the dominated samples or not, 0 or 1, used by jolteon')
+    parser.add_argument('-ms', '--multi_start', type=int, default=0, help='solve from this many initial points in parallel, 0 means only x_init, used by jolteon')
+    parser.add_argument('-pp', '--parallel_probe', type=int, default=0, help='probe over a pool of one process per core or not, 0 or 1, used by jolteon')
+    parser.add_argument('-se', '--search_mode', type=str, default='relax', help='relax to round and probe the relaxed solution, bnb to also run branch-and-bound over the config grid, used by jolteon')
+    parser.add_argument('-pf', '--pareto_frontier', type=int, default=0, help='answer the bound from the cached latency-cost pareto frontier, 0 for no, 1 to re-solve between the frontier points, 2 for lookup only, used by jolteon')
+    parser.add_argument('-dc', '--decision_cache', type=int, default=0, help='reuse the decisions of identical requests on local disk or not, 0 or 1, not with -pf, used by jolteon')
+    parser.add_argument('-tb', '--time_budget', type=float, default=0, help='time budget (s) of the search, after which the best config found so far is returned, 0 means no budget, used by jolteon')
+    parser.add_argument('-sq', '--sequential', type=int, default=0, help='grow the sample size until the config is validated on independent samples or not, 0 or 1, not with -pf, used by jolteon')
+    parser.add_argument('-cf', '--cons_formulation', type=str, default='saa', help='chance constraint formulation, saa or cvar, used by jolteon')
 
     args = parser.parse_args()
 
@@ -869,6 +1430,7 @@ def main():
         wf.train_perf_model(wf.metadata_path('profiles'))
         if args.scheduler == 'jolteon':
             scheduler = Jolteon(wf)
+            scheduler.set_sample_method(args.sample_method, args.qmc_reduction == 1)
             scheduler.store_params_and_samples()
     elif args.accuracy_predict == 1:
         wf.train_perf_model(wf.metadata_path('profiles'))
@@ -876,6 +1438,11 @@ def main():
             scheduler = Jolteon(wf)
             scheduler.set_bound(args.bound_type, args.bound_value, args.service_level)
             scheduler.set_confidence(args.confidence)
+            scheduler.set_sample_method(args.sample_method, args.qmc_reduction == 1)
+            scheduler.set_scenario_reduction(args.reduced_scenarios)
+            scheduler.set_sample_cache(args.sample_cache == 1)
+            if args.input_size > 0:
+                scheduler.set_input_size(args.input_size)
             scheduler.generate_func_code()
 
             sample_size = args.sample_size
@@ -950,7 +1517,19 @@ def main():
             scheduler = Jolteon(wf)
             scheduler.set_bound(args.bound_type, args.bound_value, args.service_level)
             scheduler.set_confidence(args.confidence)
-            scheduler.generate_func_code()
+            scheduler.set_sample_method(args.sample_method, args.qmc_reduction == 1)
+            scheduler.set_scenario_reduction(args.reduced_scenarios)
+            scheduler.set_sample_cache(args.sample_cache == 1)
+            scheduler.set_pruning(args.prune == 1)
+            scheduler.set_cons_formulation(args.cons_formulation)
+            scheduler.set_multi_start(args.multi_start)
+            scheduler.set_parallel_probe(args.parallel_probe == 1)
+            scheduler.set_time_budget(args.time_budget if args.time_budget > 0 else None)
+            scheduler.set_sequential(args.sequential == 1 and args.pareto_frontier == 0)
+            scheduler.set_search_mode(args.search_mode)
+            scheduler.set_decision_cache(args.decision_cache == 1 and args.pareto_frontier == 0)
+            if args.input_size > 0:
+                scheduler.set_input_size(args.input_size)
 
             x_init = 2
             x_bound = [(4, None), (0.5, None)]
@@ -1008,13 +1587,31 @@ def main():
                 (para_min, para_max), (1.9, 5.6), (para_min, para_max), (1.4, 5.6), (para_min, para_max), (1.9, 5.6)]
             # <<< swkim
 
-            sample_size = args.sample_size
-            if sample_size == 0:
-                scheduler.get_params_and_samples()
-            else:
-                scheduler.get_params_and_samples(sample_size)
+            sample_size = None if args.sample_size == 0 else args.sample_size
             t0 = time.time()
-            scheduler.search_config(x_bound=x_bound, init_vals=x_init)
+            decision = None
+            if scheduler.decision_cache:
+                decision = scheduler.lookup_decision(x_init, x_bound, sample_size)
+            if decision is None:
+                # The frontier query compiles and samples only on a miss
+                if args.pareto_frontier == 0:
+                    scheduler.generate_func_code()
+                    if not scheduler.sequential:
+                        scheduler.get_params_and_samples(sample_size, x_bound)
+                t0 = time.time()
+                if args.pareto_frontier > 0:
+                    scheduler.query_frontier(args.bound_type, args.bound_value, args.service_level, 
+                                             exact=args.pareto_frontier == 1, 
+                                             x_bound=x_bound, init_vals=x_init, 
+                                             sample_size=sample_size)
+                elif scheduler.sequential:
+                    scheduler.sequential_search(x_init, x_bound)
+                    if scheduler.decision_cache and not scheduler.timed_out:
+                        scheduler.store_decision(x_init, x_bound, sample_size)
+                else:
+                    scheduler.search_config(x_bound=x_bound, init_vals=x_init)
+                    if scheduler.decision_cache and not scheduler.timed_out:
+                        scheduler.store_decision(x_init, x_bound, sample_size)
             t1 = time.time()
             print('Search time:', t1-t0, 's\n')
             scheduler.set_config(real_run)
@@ -1132,6 +1729,9 @@ def main():
             # <<< swkim
 
         
+    # Write the recency of the cache hits
+    for cache in decision_caches.values():
+        cache.flush()
     wf.close_pools()
 
 
@@ -0,0 +1,41 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from workflow import prune_threshold, dominated_samples
+from utils.solver import batch_percentile
+
+# The (1-risk)-tile of each column over the kept samples and the pruned count, as PCPSolver
+# evaluates it, against np.percentile over all the samples
+def check_pruned_percentile(vals, risk):
+    q = 100 * (1 - risk)
+    pruned = dominated_samples(vals, prune_threshold(len(vals), risk))
+    kept = vals[~pruned]
+    res = batch_percentile(kept.T, q, lower_weight=int(np.sum(pruned)))
+    assert np.array_equal(res, np.percentile(vals, q, axis=0))
+    return int(np.sum(pruned))
+
+def test_counterexample():
+    # frac(risk * N) > risk, a sample with floor(risk * N) + 1 dominators sits at the lower 
+    # interpolation point of the 93rd percentile of column 0
+    vals = np.array([(10, 10), (9, 9), (8, 8)] + [(0.1 * i, 20 - i) for i in range(17)], 
+                    dtype=float)
+    check_pruned_percentile(vals, 0.07)
+
+def test_random():
+    rng = np.random.default_rng(0)
+    num_pruned = 0
+    for _ in range(500):
+        n = int(rng.integers(2, 200))
+        risk = float(rng.choice([0.01, 0.05, 0.07, 0.1, 0.2]))
+        # Correlated columns so that many samples are dominated
+        base = rng.random((n, 1))
+        vals = base + 0.1 * rng.random((n, int(rng.integers(1, 4))))
+        num_pruned += check_pruned_percentile(vals, risk)
+    assert num_pruned > 0
+
+def test_default_size():
+    assert prune_threshold(6264, 0.05) == 314
+    vals = np.random.default_rng(1).random((6264, 1)) + np.zeros((1, 2))
+    check_pruned_percentile(vals, 0.05)
@@ -1,4 +1,6 @@
 from .basic_class import MyThread, MyProcess, MyQueue, Distribution, PriorityQueue
 from .log_analyze import extract_info_from_log, orca_extract_info_from_log, orca_save_result
 from .s3_api import get_dir_size, clear_data
-from .solver import PCPSolver
\ No newline at end of file
+from .solver import PCPSolver, weighted_percentile, batch_percentile
+from .frontier import ParetoFrontier
+from .decision_cache import DecisionCache
@@ -2,6 +2,7 @@ from multiprocessing import Process, Queue
 import threading
 import numpy as np
 import heapq
+from collections import deque
 
 class MyProcess(Process):
     def __init__(self, target, args, queue=None):
@@ -41,34 +42,42 @@ class MyThread(threading.Thread):
 
 class MyQueue:
     def __init__(self, init_list = None):
-        self.queue = [] if init_list is None else init_list
+        self.queue = deque() if init_list is None else deque(init_list)
 
     def push(self, item):
         self.queue.append(item)
 
     def pop(self):
         assert len(self.queue) > 0
-        return self.queue.pop(0)
+        return self.queue.popleft()
 
     def __len__(self):
         return len(self.queue)
 
     def __str__(self):
-        return str(self.queue)
+        return str(list(self.queue))
     
+'''
+Discrete latency distribution of sorted support points (data) and their probabilities (prob).
+The combinations compact the result to at most dim points of equal probability mass, i.e., a
+fixed-size quantile grid, so the cost of a combination does not grow along the DAG.
+'''
 class Distribution:
     def __init__(self, init_list, init_prob = None):
-        assert isinstance(init_list, list)
-        assert isinstance(init_prob, list) or init_prob is None
+        assert isinstance(init_list, (list, np.ndarray))
+        assert isinstance(init_prob, (list, np.ndarray)) or init_prob is None
         if len(init_list) == 0:
             raise ValueError('Empty list')
-        init_list.sort()
-        self.data = np.array(init_list)
+        data = np.asarray(init_list, dtype=float).ravel()
         if init_prob is None:
-            self.prob = np.ones(len(init_list)) / len(init_list)
+            prob = np.ones(len(data)) / len(data)
         else:
             assert len(init_list) == len(init_prob)
-            self.prob = np.array(init_prob)
+            prob = np.asarray(init_prob, dtype=float).ravel()
+        # Sort the probabilities along with the data
+        order = np.argsort(data, kind='stable')
+        self.data = data[order]
+        self.prob = prob[order]
         
         self.subset = []
         
@@ -77,49 +86,35 @@ class Distribution:
         assert isinstance(com_type, int)
         
         if com_type == 0:
-            new_data = []
-            for i in range(len(self.data)):
-                for j in range(len(dist.data)):
-                    new_data.append( (self.data[i] + dist.data[j], self.prob[i] * dist.prob[j]))
-                    
-            new_data.sort()
-            self.data = np.array([item[0] for item in new_data])
-            self.prob = np.array([item[1] for item in new_data])
+            # The sum of two independent variables, over all pairs of points
+            new_data = np.add.outer(self.data, dist.data).ravel()
+            new_prob = np.outer(self.prob, dist.prob).ravel()
+            order = np.argsort(new_data, kind='stable')
+            self.data = new_data[order]
+            self.prob = new_prob[order]
         elif com_type == 1:
-            cum_prob1 = np.cumsum(self.prob)
-            cum_prob2 = np.cumsum(dist.prob)
-            
-            new_data = np.concatenate((self.data, dist.data))
-            new_data.sort()
-            new_probs = []
-            prev = 0
-            for item in new_data:
-                index = np.sum(self.data <= item) - 1
-                prob1 = cum_prob1[index] if index >= 0 else 0
-                index = np.sum(dist.data <= item) - 1
-                prob2 = cum_prob2[index] if index >= 0 else 0
-                new_probs.append(prob1 * prob2 - prev)
-                prev = prob1 * prob2
-                
-            new_data = np.array(new_data)
-            new_prob = np.array(new_probs)
+            # The max of two independent variables, whose CDF is the product of their CDFs
+            new_data = np.union1d(self.data, dist.data)
+            cum_prob = self.cdf(new_data) * dist.cdf(new_data)
+            new_prob = np.diff(cum_prob, prepend=0)
             new_prob = new_prob / np.sum(new_prob)
             
-            self.data = np.array([])
-            self.prob = np.array([])
-            
-            for i in range(len(new_data)):
-                if new_prob[i] > 0:
-                    self.data = np.append(self.data, new_data[i])
-                    self.prob = np.append(self.prob, new_prob[i])
+            mask = new_prob > 0
+            self.data = new_data[mask]
+            self.prob = new_prob[mask]
             
         else:
             raise ValueError('Unknown combine type')
         
         self.reduce_dim()
         
+    # Step CDF at each of values, i.e., the probability of the points <= value
+    def cdf(self, values):
+        cum_prob = np.concatenate(([0], np.cumsum(self.prob)))
+        return cum_prob[np.searchsorted(self.data, values, side='right')]
+        
     def probility(self, value):
-        val = np.sum(np.array(self.data) <= value)
+        val = int(np.searchsorted(self.data, value, side='right'))
         if val == 0:
             return 0
         if val == len(self.data):
@@ -136,11 +131,9 @@ class Distribution:
     
     def tail_value(self, percentile):
         cum_prob = np.cumsum(self.prob)
-        index = None
-        for i in range(len(self.prob)):
-            if cum_prob[i] >= percentile:
-                index = i
-        if index is None:
+        # The first point whose cumulative probability reaches the percentile
+        index = int(np.searchsorted(cum_prob, percentile, side='left'))
+        if index == len(self.prob):
             return self.data[-1]
         if index == 0:
             lower_val = 0
@@ -156,31 +149,25 @@ class Distribution:
             
         return lower_val + add_val
     
+    # Merge the points into at most dim bins of equal probability mass, each point becomes
+    # the probability-weighted mean of its bin
     def reduce_dim(self, dim = 100):
         length = len(self.data)
         if length <= dim:
             return
-        split_data = np.array_split(self.data, dim)
-        split_prob = np.array_split(self.prob, dim)
-        
-        new_data = []
-        new_prob = []
+        cum_prob = np.cumsum(self.prob)
+        # Bin a point by the middle of its probability mass
+        bins = np.minimum(((cum_prob - self.prob / 2) / cum_prob[-1] * dim).astype(int), dim - 1)
+        starts = np.flatnonzero(np.diff(bins, prepend=-1))
         
-        for idx in range(dim):
-            probs = split_prob[idx]
-            prob = float(np.sum(split_prob[idx]))
-            probs = probs / prob
-            val = float(np.dot(split_data[idx], probs))
-            new_prob.append(prob)
-            new_data.append(val)
+        new_prob = np.add.reduceat(self.prob, starts)
+        new_data = np.add.reduceat(self.data * self.prob, starts) / new_prob
         
-        self.data = np.array(new_data)
-        self.prob = np.array(new_prob)
+        self.data = new_data
+        self.prob = new_prob
         
     def copy(self):
-        new_data = self.data.copy().tolist()
-        new_prob = self.prob.copy().tolist()
-        return Distribution(new_data, new_prob)
+        return Distribution(self.data.copy(), self.prob.copy())
     
     def __str__(self):
         return str(list(zip(self.data, self.prob)))
@@ -0,0 +1,97 @@
+import os
+import json
+import fcntl
+import hashlib
+from collections import OrderedDict
+
+'''
+Scheduling decisions on local disk, keyed by the sha1 of a json-normalized request (workflow
+config, model hash, bound, service level, search settings, ...) and evicted in LRU order. The
+file is read once per process, so a repeated request is a dict lookup. Decisions of other model
+hashes of the workflow are dropped on load, i.e., retraining on a new profile invalidates them.
+A flush merges the entries used or stored since the last one into the file under a lock file, so
+concurrent schedulers keep each other's decisions.
+'''
+class DecisionCache:
+    def __init__(self, path, max_entries=256):
+        assert isinstance(max_entries, int) and max_entries > 0
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = self.load()  # From the least to the most recently used
+        self.dirty = False
+        self.valid_hash = None  # All the entries are of this model hash if not None
+        self.recent = OrderedDict()  # The keys used or stored since the last flush, in order
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return OrderedDict()
+        with open(self.path, 'r') as f:
+            return OrderedDict(json.load(f)['entries'])
+
+    @staticmethod
+    def key(request):
+        return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    # Drop the decisions whose model hash is not model_hash
+    def invalidate(self, model_hash):
+        if model_hash == self.valid_hash:
+            return 0
+        stale = [k for k, v in self.entries.items() if v['model_hash'] != model_hash]
+        for k in stale:
+            del self.entries[k]
+        if len(stale) > 0:
+            self.dirty = True
+        self.valid_hash = model_hash
+        return len(stale)
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        # Only in memory, the order is written by the next put or flush
+        self.entries.move_to_end(key)
+        self.recent[key] = None
+        self.recent.move_to_end(key)
+        self.dirty = True
+        return self.entries[key]
+
+    def put(self, key, decision):
+        assert 'model_hash' in decision
+        if decision['model_hash'] != self.valid_hash:
+            self.valid_hash = None
+        self.entries[key] = decision
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.recent[key] = None
+        self.recent.move_to_end(key)
+        self.dirty = True
+        self.flush()
+
+    def flush(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            # Re-read under the lock, the file may have been updated by another scheduler
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.load()
+            if self.valid_hash is not None:
+                entries = OrderedDict((k, v) for k, v in entries.items() 
+                                      if v['model_hash'] == self.valid_hash)
+            for key in self.recent:
+                if key in self.entries:
+                    entries[key] = self.entries[key]
+                    entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            # Write then rename, concurrent schedulers never read a partial file
+            tmp_path = self.path + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': list(entries.items())}, f)
+            os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.recent = OrderedDict()
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,72 @@
+import os
+import json
+import bisect
+
+'''
+Pareto frontier of the configs for one bound type and service level: each point is a config
+with its bounded value (the percentile of latency or cost over the samples) and its objective.
+The points are sorted by the bounded value with strictly decreasing objective, so the best
+config under a bound is the last point within it.
+'''
+class ParetoFrontier:
+    def __init__(self, bound_type, service_level, points=None):
+        assert bound_type in ['latency', 'cost']
+        assert service_level > 0 and service_level < 1
+        self.bound_type = bound_type
+        self.service_level = service_level
+        self.points = []
+        self.bounds = []  # The bounded values of the points, for bisect
+        if points is not None:
+            for point in points:
+                self.insert(point)
+
+    '''
+    Insert a point {'bound': xx, 'obj': xx, 'num_funcs': [...], 'num_vcpus': [...]}
+    @return: False if it is dominated by (or equal to) an existing point
+    '''
+    def insert(self, point):
+        assert 'bound' in point and 'obj' in point
+        i = bisect.bisect_left(self.bounds, point['bound'])
+        if i > 0 and self.points[i-1]['obj'] <= point['obj']:
+            return False
+        if i < len(self.points) and self.bounds[i] == point['bound'] and \
+            self.points[i]['obj'] <= point['obj']:
+            return False
+        # Drop the points it dominates, i.e., no lower bound and no lower objective
+        j = i
+        while j < len(self.points) and self.points[j]['obj'] >= point['obj']:
+            j += 1
+        self.points[i:j] = [point]
+        self.bounds[i:j] = [point['bound']]
+        return True
+
+    # The point with the lowest objective within the bound, None if no point is within it
+    def lookup(self, bound):
+        i = bisect.bisect_right(self.bounds, bound)
+        if i == 0:
+            return None
+        return self.points[i-1]
+
+    def __len__(self):
+        return len(self.points)
+
+    def save(self, path, meta):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        res = {'meta': meta, 'bound_type': self.bound_type,
+               'service_level': self.service_level, 'points': self.points}
+        # Write then rename, concurrent schedulers never read a partial file
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(res, f, indent=1)
+        os.replace(tmp_path, path)
+
+    # Load the frontier from path, None if it does not exist or was computed for another meta
+    @staticmethod
+    def load(path, meta):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            res = json.load(f)
+        if res.get('meta') != meta:
+            return None
+        return ParetoFrontier(res['bound_type'], res['service_level'], res['points'])
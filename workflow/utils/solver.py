@@ -1,11 +1,92 @@
 import math
 import json
+import time
 import numpy as np
 import scipy.optimize as scipy_opt
+from scipy.special import expit
 from scipy.optimize import NonlinearConstraint
 from deprecation import deprecated
-from .basic_class import MyQueue, MyProcess
-from multiprocessing import Manager, Queue
+from .basic_class import PriorityQueue
+import multiprocessing as mp
+from multiprocessing import Pool
+from multiprocessing import shared_memory
+import functools
+import contextlib
+
+# The q-th percentile of vals, where vals[i] counts as weights[i] samples, 
+# and lower_weight samples are known to lie below all of vals (e.g., pruned by dominance)
+def weighted_percentile(vals, q, weights=None, lower_weight=0):
+    if weights is None:
+        if lower_weight == 0:
+            return np.percentile(vals, q)
+        return batch_percentile(vals, q, lower_weight=lower_weight)[0]
+    order = np.argsort(vals)
+    cum_weights = lower_weight + np.cumsum(weights[order])
+    i = np.searchsorted(cum_weights, q / 100 * cum_weights[-1])
+    return vals[order[min(i, len(vals) - 1)]]
+
+# The q-th percentile of each row of vals, the same as weighted_percentile but with np.partition 
+# (a linear-time selection) instead of a full sort unless the samples are weighted
+def batch_percentile(vals, q, weights=None, lower_weight=0):
+    vals = np.atleast_2d(vals)
+    n = vals.shape[1]
+    rows = np.arange(vals.shape[0])
+    if weights is None:
+        # Linear interpolation with the same arithmetic as np.percentile over the lower_weight 
+        # samples and vals, i.e., the percentile of the samples before pruning
+        h = (lower_weight + n - 1) * (q / 100)
+        lo = min(max(math.floor(h) - lower_weight, 0), n - 1)
+        hi = min(max(math.floor(h) - lower_weight + 1, 0), n - 1)
+        part = np.partition(vals, sorted({lo, hi}), axis=1)
+        a, b, t = part[:, lo], part[:, hi], h - math.floor(h)
+        return np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    order = np.argsort(vals, axis=1)
+    cum_weights = lower_weight + np.cumsum(weights[order], axis=1)
+    i = np.sum(cum_weights < q / 100 * cum_weights[:, -1:], axis=1)
+    return vals[rows, order[rows, np.minimum(i, n - 1)]]
+
+# The solver of a worker process, see PCPSolver.worker_pool
+ms_solver = None
+ms_shm = None
+ms_best = None
+ms_nodes = None
+
+def multi_start_init(shm_name, shape, func_code, input_size, solver_args, shared_best=None, 
+                     shared_nodes=None):
+    global ms_solver, ms_shm, ms_best, ms_nodes
+    ms_best, ms_nodes = shared_best, shared_nodes
+    ms_shm = shared_memory.SharedMemory(name=shm_name)
+    cons_matrix = np.ndarray(shape, dtype=np.float64, buffer=ms_shm.buf)
+    namespace = {}
+    exec(compile(func_code, '<multi-start funcs>', 'exec'), namespace)
+    funcs = [namespace[name] for name in ['objective_func', 'constraint_func', 
+                                          'objective_jac', 'constraint_jac']]
+    if input_size is not None:
+        funcs = [functools.partial(func, s=input_size) for func in funcs]
+    # cons_matrix.T is transposed back to the shared buffer without a copy
+    ms_solver = PCPSolver(objective=funcs[0], constraint=funcs[1], cons_params=cons_matrix.T, 
+                          objective_jac=funcs[2], constraint_jac=funcs[3], **solver_args)
+
+def multi_start_solve(args):
+    x0, x_bound = args
+    bound = ms_solver.bound
+    res = ms_solver.iter_solve(x0, x_bound)
+    ms_solver.bound = bound
+    return res
+
+def multi_start_probe(args):
+    d, k = args
+    return ms_solver.probe(list(d), list(k))
+
+# Search one part of the probe neighborhood, see PCPSolver.probe_parallel
+def probe_region(args):
+    start, moves, root, root_vals, budget, step_bound = args
+    memo = {'objs': {root: root_vals[0]}, 'conss': {root: root_vals[1]}, 'nodes': 0, 
+            'step_bound': step_bound}
+    best = ms_solver.probe_search(start, ms_solver.probe_depth, False, memo, moves, root, 
+                                  budget, ms_best, ms_nodes)
+    return best, memo['objs'][best], memo['conss'][best], memo['nodes'], len(memo['conss']) - 1
+
 
 '''
 PCP: Probabilistic (Chance) Constrained Programming
@@ -23,14 +104,23 @@ class PCPSolver:
                  bound_type='latency',
                  need_probe=None,
                  probe_depth=4, 
+                 probe_budget=10000,
+                 cons_weights=None,
+                 num_dominated=0,
+                 objective_jac=None, constraint_jac=None, constraint_2_jac=None,
+                 batch_funcs=None,
+                 cons_formulation='saa', cvar_smooth=None,
+                 deadline=None,
                  solver_info={'optlib': 'scipy', 'method': 'SLSQP'}):
         assert isinstance(num_X, int) and num_X > 0
         assert callable(objective) and callable(constraint)
         if constraint_2 is not None:
             assert callable(constraint_2)
+        for jac in [objective_jac, constraint_jac, constraint_2_jac]:
+            assert jac is None or callable(jac)
         # We consider bound as one positive number (SLO or budget)
         assert (isinstance(bound, float) or isinstance(bound, int)) and bound > 0
-        assert isinstance(obj_params, list) and isinstance(cons_params, list)
+        assert isinstance(obj_params, list) and isinstance(cons_params, (list, np.ndarray))
 
         assert isinstance(risk, float) and risk > 0 and risk < 1
         assert (isinstance(approx_risk, int) and approx_risk == 0 or approx_risk == 1) or \
@@ -45,9 +135,37 @@ class PCPSolver:
         self.objective = objective
         self.constraint = constraint
         self.constraint_2 = constraint_2
+        # Optional exact Jacobians with the same arguments, otherwise SLSQP uses finite differences
+        self.objective_jac = objective_jac
+        self.constraint_jac = constraint_jac
+        self.constraint_2_jac = constraint_2_jac
+        # 'saa' gives SLSQP one constraint per sample and loosens the bound in iter_solve, 
+        # 'cvar' bounds the smoothed CVaR of the samples instead, see cvar_constraint
+        assert cons_formulation in ['saa', 'cvar']
+        self.cons_formulation = cons_formulation
+        # Temperature of the softplus in the CVaR, default to 1% of the bound
+        self.cvar_smooth = cvar_smooth if cvar_smooth is not None else 0.01 * bound
+        assert self.cvar_smooth > 0
+        # Optional batched objective(X, p) and constraint(X, p, b) over candidate configs X with 
+        # shape (num_candidates, num_X), used by probe and get_vals
+        self.batch_funcs = batch_funcs
         self.bound = bound
         self.obj_params = obj_params
         self.cons_params = cons_params
+        # The functions index the parameters by rows, i.e., (num_coeffs*num_stages, num_samples)
+        self.cons_matrix = np.ascontiguousarray(np.asarray(cons_params, dtype=np.float64).T)
+        # Constraint values and Jacobians by x, shared by the solves of iter_solve
+        self.cons_cache = {}
+        self.cons_jac_cache = {}
+        self.max_cons_cache = 16
+        # Optional weights of the samples, e.g., representatives after scenario reduction
+        self.cons_weights = None
+        if cons_weights is not None:
+            self.cons_weights = np.asarray(cons_weights, dtype=float)
+            assert self.cons_weights.shape == (len(cons_params), )
+        # Number of samples pruned by dominance, they count in the ratio but are never violated
+        assert isinstance(num_dominated, int) and num_dominated >= 0
+        self.num_dominated = num_dominated
 
         # User-defined risk level (epsilon) for constraint satisfaction (e.g., 0.01 or 0.05)
         self.risk = risk 
@@ -67,22 +185,50 @@ class PCPSolver:
         self.bound_type = bound_type
         self.need_probe = need_probe
         self.probe_depth = probe_depth
+        self.probe_budget = probe_budget  # Max number of positions expanded by each probe search
+        # Optional time.time() after which the solves and probes stop with the best found so far
+        self.deadline = deadline
+        self.timed_out = False
 
         # Solver information for the sample approximation problem
         self.solver_info = solver_info
 
+    # Whether the deadline has passed, which is recorded in timed_out
+    def expired(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.timed_out = True
+        return self.timed_out
+
+    '''
+    The sample size follows the Hoeffding bounds of the paper, uniformly over the configs the 
+    search can return, which holds for any sampling method. search_space_size is the number of 
+    such configs, see Jolteon.search_space_size, default to 7 vcpu and 4 parallelism configs for 
+    half the stages.
+    With qmc_reduction, scrambled QMC samples ('sobol', 'halton') are cut to N^(d/(d+1)) with 
+    d = num_stages. It is a heuristic without the guarantee: the scrambled-net variance 
+    O(N^(-1-1/s)) of an indicator (Owen) is in the dimension s of the point set (all the stage 
+    parameters, not num_stages), and it is for one fixed config while SAA chooses the config 
+    on the same samples.
+    '''
     @staticmethod
-    def sample_size(num_stages, risk, approx_risk, confidence_error) -> int:
-        # {0.5, 1, 1.5, 2, 3, 4} as the intra-function resource space, so the size is 8
-        # {4, 8, 16, 32} as the parallelism space, so the size is 4
-        search_space_size = (7 * 4)**(num_stages // 2)  # num_X / 2 stages
+    def sample_size(num_stages, risk, approx_risk, confidence_error, method='mc', 
+                    search_space_size=None, qmc_reduction=False) -> int:
+        assert method in ['mc', 'sobol', 'halton']
+        if search_space_size is None:
+            # {0.5, 1, 1.5, 2, 3, 4} as the intra-function resource space, so the size is 8
+            # {4, 8, 16, 32} as the parallelism space, so the size is 4
+            search_space_size = (7 * 4)**(num_stages // 2)
+        assert search_space_size >= 1
         min_abs_tol = 1e-2
         if math.isclose(risk, approx_risk, abs_tol=min_abs_tol):
-            return math.ceil(0.5 / min_abs_tol**2 * math.log((1 + search_space_size) / confidence_error))
+            size = math.ceil(0.5 / min_abs_tol**2 * math.log((1 + search_space_size) / confidence_error))
         elif risk < approx_risk:
-            return math.ceil(0.5 / (approx_risk - risk)**2 * (-math.log(confidence_error)))
+            size = math.ceil(0.5 / (approx_risk - risk)**2 * (-math.log(confidence_error)))
         else: 
-            return math.ceil(0.5 / (risk - approx_risk)**2 * math.log(search_space_size / confidence_error))
+            size = math.ceil(0.5 / (risk - approx_risk)**2 * math.log(search_space_size / confidence_error))
+        if method != 'mc' and qmc_reduction:
+            size = math.ceil(size ** (num_stages / (num_stages + 1)))
+        return size
 
     '''
     Solve the sample approximation problem
@@ -106,174 +252,693 @@ class PCPSolver:
             elif isinstance(init_vals, np.ndarray) and init_vals.shape == (self.num_X, ):
                 x0 = init_vals
 
-        X_bounds = [(0.5, None) for _ in range(self.num_X)] # optional bounds for each x
-        if x_bound is not None:
-            if isinstance(x_bound, tuple) and len(x_bound) == 2:
-                X_bounds = [x_bound for _ in range(self.num_X)]
-            elif isinstance(x_bound, list) and len(x_bound) == self.num_X:
-                X_bounds = x_bound
-            elif isinstance(x_bound, list) and len(x_bound) == 2:
-                # [0] is for parallelism, [1] is for intra-function resource
-                X_bounds = []
-                for _ in range(self.num_X // 2):
-                    X_bounds.append(x_bound[0])
-                    X_bounds.append(x_bound[1])
+        X_bounds = self.x_bounds(self.num_X, x_bound)
 
         obj_params = np.array(self.obj_params)
-        cons_params = np.array(self.cons_params).T
-        nonlinear_constraints = NonlinearConstraint(lambda x: self.constraint(x, cons_params, self.bound), -np.inf, 0)
+        cons_params = self.cons_matrix
+        cvar = self.cons_formulation == 'cvar'
+        # With CVaR, the auxiliary variable t is appended to x and only used by the constraint
+        unpack = (lambda z: z[:-1]) if cvar else (lambda z: z)
+        pad = (lambda g: np.concatenate([g, np.zeros(g.shape[:-1] + (1, ))], axis=-1)) if cvar \
+            else (lambda g: g)
+
+        cons_jac = '2-point'
+        if cvar:
+            cons0 = self.cons_value(x0) - self.bound
+            x0 = np.append(x0, self.percentile(cons0, 100 * (1 - self.risk)))
+            X_bounds = X_bounds + [(None, None)]
+            if self.constraint_jac is not None:
+                cons_jac = lambda z: self.cvar_constraint(z, cons_params, True)[1]
+            nonlinear_constraints = NonlinearConstraint(lambda z: self.cvar_constraint(z, cons_params), 
+                                                        -np.inf, 0, jac=cons_jac)
+        else:
+            if self.constraint_jac is not None:
+                cons_jac = lambda x: self.cons_jac(x)
+            nonlinear_constraints = NonlinearConstraint(lambda x: self.cons_value(x) - self.bound, -np.inf, 0, 
+                                                        jac=cons_jac)
         if self.constraint_2 is not None:
             b = self.bound if self.bound_type == 'latency' else 0
-            nonlinear_constraints_2 = NonlinearConstraint(lambda x: self.constraint_2(x, obj_params, b), -np.inf, 0)
+            cons_2_jac = '2-point'
+            if self.constraint_2_jac is not None:
+                cons_2_jac = lambda z: pad(np.asarray(self.constraint_2_jac(unpack(z), obj_params, b)))
+            nonlinear_constraints_2 = NonlinearConstraint(lambda z: self.constraint_2(unpack(z), obj_params, b), -np.inf, 0, 
+                                                          jac=cons_2_jac)
             nonlinear_constraints = [nonlinear_constraints_2, nonlinear_constraints]
+        obj_jac = None
+        if self.objective_jac is not None:
+            obj_jac = lambda z: pad(np.asarray(self.objective_jac(unpack(z), obj_params)))
+
+        # Stop at the last iterate after the deadline, with status False. The StopIteration is 
+        # caught here, as scipy only handles it from 1.11
+        last = {'z': x0}
+        def callback(z):
+            last['z'] = np.copy(z)
+            if self.expired():
+                raise StopIteration
         
-        res = scipy_opt.minimize(lambda x: self.objective(x, obj_params), x0, 
-                                    method=self.solver_info['method'],
-                                    bounds=X_bounds, 
-                                    constraints=nonlinear_constraints,
-                                    options={'ftol': self.ftol, 'disp': False})
+        try:
+            res = scipy_opt.minimize(lambda z: self.objective(unpack(z), obj_params), x0, 
+                                        method=self.solver_info['method'],
+                                        jac=obj_jac,
+                                        bounds=X_bounds, 
+                                        constraints=nonlinear_constraints,
+                                        callback=callback if self.deadline is not None else None,
+                                        options={'ftol': self.ftol, 'disp': False})
+            success, z, obj = res.success, res.x, res.fun
+        except StopIteration:
+            success, z = False, last['z']
+            obj = self.objective(unpack(z), obj_params)
         
         solve_res = {}
-        solve_res['status'] = res.success
-        solve_res['obj_val'] = res.fun
-        solve_res['cons_val'] = self.constraint(res.x, cons_params, self.bound)
-        solve_res['x'] = res.x
+        solve_res['status'] = success
+        solve_res['obj_val'] = obj
+        solve_res['x'] = unpack(z)
+        solve_res['cons_val'] = self.cons_value(solve_res['x']) - self.bound
 
         return solve_res
 
+    # The (lower, upper) bound of each of the num_X x, given one for all, one per x, or a pair 
+    # for parallelism and intra-function resource
+    @staticmethod
+    def x_bounds(num_X, x_bound=None):
+        X_bounds = [(0.5, None) for _ in range(num_X)] # optional bounds for each x
+        if x_bound is not None:
+            if isinstance(x_bound, tuple) and len(x_bound) == 2:
+                X_bounds = [x_bound for _ in range(num_X)]
+            elif isinstance(x_bound, list) and len(x_bound) == num_X:
+                X_bounds = x_bound
+            elif isinstance(x_bound, list) and len(x_bound) == 2:
+                # [0] is for parallelism, [1] is for intra-function resource
+                X_bounds = []
+                for _ in range(num_X // 2):
+                    X_bounds.append(x_bound[0])
+                    X_bounds.append(x_bound[1])
+        return X_bounds
+
+    '''
+    CVaR (Rockafellar-Uryasev) form of the chance constraint, with the auxiliary variable t:
+        t + sum_i w_i * max(0, g_i(x) - t) / (risk * W) <= 0,
+    where g_i(x) = constraint(x, p_i, bound) and W is the total weight (with the dominated 
+    samples, whose terms are 0). Its minimum over t is the CVaR of g, which is no less than the 
+    (1-risk)-tile, so a feasible x violates the bound for at most risk of the samples. The max 
+    is smoothed by a softplus with temperature cvar_smooth to keep it differentiable, which 
+    only makes it more conservative. 
+    @return: the value, and its gradient w.r.t. (x, t) if need_jac
+    '''
+    def cvar_constraint(self, z, cons_params, need_jac=False):
+        x, t = z[:-1], z[-1]
+        weights = self.cons_weights if self.cons_weights is not None else \
+            np.ones(cons_params.shape[1])
+        scale = self.risk * (np.sum(weights) + self.num_dominated)
+        u = (self.cons_value(x) - self.bound - t) / self.cvar_smooth
+        val = t + np.sum(weights * self.cvar_smooth * np.logaddexp(0, u)) / scale
+        if not need_jac:
+            return val
+        ws = weights * expit(u) / scale
+        jac = np.append(ws @ self.cons_jac(x), 1 - np.sum(ws))
+        return val, jac
+
     '''
     Solve the sample approximation problem iteratively to tolerate a certain number of 
     constraint violations
     '''
     def iter_solve(self, init_vals=None, x_bound=None):
+        if self.cons_formulation == 'cvar':
+            # The CVaR constraint already tolerates the violations, solve it once
+            res = self.solve(init_vals=init_vals, x_bound=x_bound)
+            ratio_not_satisfied = self.violation_ratio(res['cons_val'] > self.ftol)
+            print('Violation ratio:', ratio_not_satisfied)
+            if (res['status'] and ratio_not_satisfied <= self.risk) or self.expired():
+                return res
+            print('CVaR solve failed, fall back to SAA')
+            self.cons_formulation = 'saa'
+            try:
+                return self.iter_solve(init_vals=init_vals, x_bound=x_bound)
+            finally:
+                self.cons_formulation = 'cvar'
+
+        # Search the smallest relaxed bound (to a resolution of the old step ftol*4) whose solve 
+        # succeeds or violates less than risk of the samples. Secant steps on the violation 
+        # ratio extrapolate from the rejected bounds (at most doubling the step) until one is 
+        # accepted, then narrow [lo, hi], warm-started from the solution at hi (the iterates 
+        # of the rejected bounds are poor starting points)
+        t0 = time.time()
+        tol = self.ftol * 4
+        step = tol
+        lo, lo_ratio = None, None  # the largest rejected bound
+        prev, prev_ratio = None, None  # the rejected bound before lo
+        hi, hi_res = None, None  # the smallest accepted bound
+        num_iters = 0
         while True:
             res = self.solve(init_vals=init_vals, x_bound=x_bound)
-            if res['status']:
+            num_iters += 1
+            ratio_not_satisfied = self.violation_ratio(np.array(res['cons_val']) > self.ftol)
+            if res['status'] or ratio_not_satisfied < self.risk:
+                hi, hi_ratio, hi_res = self.bound, ratio_not_satisfied, res
+            else:
+                print('bound:', self.bound, 'ratio:', ratio_not_satisfied)
+                prev, prev_ratio = lo, lo_ratio
+                lo, lo_ratio = self.bound, ratio_not_satisfied
+            if self.expired():
+                # The accepted solution if any, otherwise the last one
+                if hi_res is None:
+                    hi, hi_res = self.bound, res
+                break
+            if hi is None:
+                next_bound = lo + step
+                if prev is not None and prev_ratio > lo_ratio:
+                    next_bound = lo + (lo_ratio - self.risk) / (prev_ratio - lo_ratio) * (lo - prev)
+                self.bound = min(max(next_bound, lo + tol), lo + step)
+                step *= 2
+            elif lo is None or hi - lo <= tol * (1 + 1e-9):
                 break
             else:
-                cons_val = np.array(res['cons_val'])
-                ratio_not_satisfied = np.sum(cons_val > self.ftol) / len(cons_val)
-                if ratio_not_satisfied < self.risk:
+                next_bound = (lo + hi) / 2
+                if lo_ratio > hi_ratio:
+                    next_bound = lo + (lo_ratio - self.risk) / (lo_ratio - hi_ratio) * (hi - lo)
+                # Keep the step inside the middle half of the bracket so that it shrinks
+                quarter = (hi - lo) / 4
+                self.bound = min(max(next_bound, lo + quarter), hi - quarter)
+                init_vals = hi_res['x']
+        self.bound = hi
+        t1 = time.time()
+        print('Bound search iterations:', num_iters, 'time:', t1-t0, 's')
+
+        return hi_res
+
+    # The constraint values without the bound, i.e., constraint(x, p, b) + b, cached by x 
+    # since constraint is affine in b and iter_solve revisits the same x across the bounds
+    def cons_value(self, x):
+        key = np.asarray(x, dtype=float).tobytes()
+        if key not in self.cons_cache:
+            if len(self.cons_cache) >= self.max_cons_cache:
+                self.cons_cache.pop(next(iter(self.cons_cache)))
+            self.cons_cache[key] = self.constraint(x, self.cons_matrix, 0)
+        return self.cons_cache[key]
+
+    # The Jacobian of the constraints, which does not depend on the bound
+    def cons_jac(self, x):
+        key = np.asarray(x, dtype=float).tobytes()
+        if key not in self.cons_jac_cache:
+            if len(self.cons_jac_cache) >= self.max_cons_cache:
+                self.cons_jac_cache.pop(next(iter(self.cons_jac_cache)))
+            self.cons_jac_cache[key] = self.constraint_jac(x, self.cons_matrix, 0)
+        return self.cons_jac_cache[key]
+
+    '''
+    Solve from each of the initial points x0s with iter_solve, then round each solution with 
+    round_func (if given) to (d, k) and probe it, stored as res['probed']. With num_workers > 1, 
+    both are done by worker_pool.
+    @return: the results of the points, in order (only the solved ones after the deadline)
+    '''
+    def multi_start(self, x0s, x_bound=None, num_workers=1, func_code=None, input_size=None, 
+                    round_func=None):
+        assert len(x0s) > 0 and num_workers >= 1
+        bound = self.bound
+        num_workers = min(num_workers, len(x0s))
+        if num_workers == 1:
+            res_list = []
+            for x0 in x0s:
+                res_list.append(self.iter_solve(x0, x_bound))
+                self.bound = bound
+                if self.expired():
                     break
-                else:
-                    print('bound:', self.bound, 'ratio:', ratio_not_satisfied)
-                    self.bound += self.ftol * 4
+            if round_func is not None:
+                probed = {}
+                for res in res_list:
+                    d, k = round_func(res['x'])
+                    key = (tuple(d), tuple(k))
+                    if key not in probed:
+                        probed[key] = self.probe(d, k)
+                    res['probed'] = probed[key]
+            return res_list
+
+        with self.worker_pool(num_workers, func_code, input_size) as pool:
+            res_list = pool.map(multi_start_solve, [(x0, x_bound) for x0 in x0s], chunksize=1)
+            if round_func is not None:
+                keys = []
+                for res in res_list:
+                    d, k = round_func(res['x'])
+                    keys.append((tuple(d), tuple(k)))
+                distinct = list(dict.fromkeys(keys))
+                probed = dict(zip(distinct, pool.map(multi_start_probe, distinct, chunksize=1)))
+                for res, key in zip(res_list, keys):
+                    res['probed'] = probed[key]
+        return res_list
 
-        return res
+    '''
+    A process pool whose workers compile the functions from func_code (bound to input_size) 
+    and build a copy of the solver, with the constraint parameters in shared memory. 
+    shared_best and shared_nodes are passed to the workers for probe_parallel.
+    '''
+    @contextlib.contextmanager
+    def worker_pool(self, num_workers, func_code, input_size=None, shared_best=None, 
+                    shared_nodes=None):
+        assert func_code is not None and self.constraint_2 is None
+        shm = shared_memory.SharedMemory(create=True, size=self.cons_matrix.nbytes)
+        try:
+            np.ndarray(self.cons_matrix.shape, dtype=self.cons_matrix.dtype, 
+                       buffer=shm.buf)[:] = self.cons_matrix
+            solver_args = {'num_X': self.num_X, 'bound': self.bound, 'obj_params': self.obj_params, 
+                           'risk': self.risk, 'confidence_error': self.confidence_error, 
+                           'ftol': self.ftol, 'k_configs': self.k_configs, 
+                           'd_configs': self.d_configs, 'bound_type': self.bound_type, 
+                           'cons_weights': self.cons_weights, 
+                           'num_dominated': self.num_dominated, 
+                           'cons_formulation': self.cons_formulation, 
+                           'cvar_smooth': self.cvar_smooth, 'solver_info': self.solver_info, 
+                           'need_probe': self.need_probe, 'probe_depth': self.probe_depth, 
+                           'probe_budget': self.probe_budget, 'deadline': self.deadline, 
+                           'batch_funcs': self.batch_funcs}
+            with Pool(num_workers, initializer=multi_start_init, 
+                      initargs=(shm.name, self.cons_matrix.shape, func_code, input_size, 
+                                solver_args, shared_best, shared_nodes)) as pool:
+                yield pool
+        finally:
+            shm.close()
+            shm.unlink()
+
+    # The (weighted) ratio of the violated samples
+    def violation_ratio(self, violated):
+        if self.cons_weights is None:
+            return np.sum(violated) / (len(violated) + self.num_dominated)
+        return np.sum(self.cons_weights * violated) / \
+            (np.sum(self.cons_weights) + self.num_dominated)
+
+    def percentile(self, vals, q):
+        return weighted_percentile(vals, q, self.cons_weights, self.num_dominated)
 
+    '''
+    Evaluate the candidate configs X with shape (num_candidates, num_X).
+    @return: the objective values with the mean parameters and the q-th percentile of the 
+             constraint values over the samples, both with shape (num_candidates, )
+    '''
+    def eval_configs(self, X, q):
+        return self.eval_objs(X), self.eval_conss(X, q)
+
+    def eval_objs(self, X):
+        X = np.atleast_2d(X)
+        if self.batch_funcs is None:
+            return np.array([self.objective(x, self.obj_params) for x in X])
+        return self.batch_funcs.objective(X, self.obj_params)
+
+    def eval_conss(self, X, q):
+        X = np.atleast_2d(X)
+        if self.batch_funcs is None:
+            return np.array([self.percentile(self.constraint(x, self.cons_matrix, self.bound), q) 
+                             for x in X])
+        # Bound the (num_candidates, num_samples) matrices to ~4M values
+        chunk = max(1, 2**22 // self.cons_matrix.shape[1])
+        conss = np.concatenate([batch_percentile(self.batch_funcs.constraint(X[i:i+chunk], 
+                                                                             self.cons_matrix, 
+                                                                             self.bound), 
+                                                 q, self.cons_weights, self.num_dominated) 
+                                for i in range(0, len(X), chunk)])
+        return conss
+
+    '''
+    Search the config grid around (d_init, k_init), moving the need_probe positions by one 
+    config at a time, at most probe_depth moves away. If the start is infeasible, it first 
+    moves to the most feasible position of the neighborhood until one is feasible or none 
+    improves, then it finds the feasible position with the lowest objective. Both searches 
+    are best-first and share the evaluated positions and one budget of probe_budget expanded 
+    nodes in total. The second one skips the positions whose objective minus the most it can 
+    decrease in the remaining moves (see probe_step_bound) is no lower than the best found.
+    '''
     def probe(self, d_init, k_init):
         # assume init is within the feasible region
-        d_pos = []
-        k_pos = []
+        memo = self.probe_memo()
+        x_pos = self.probe_feasible(self.config_pos(d_init, k_init), memo)
+        
+        # find the best solution
+        best_pos = x_pos
+        if memo['conss'][x_pos] < 0:
+            best_pos = self.probe_search(x_pos, self.probe_depth, False, memo)
+        print('Probe nodes:', memo['nodes'], 'evaluated:', len(memo['conss']))
+        return self.pos_config(best_pos)
+
+    # The positions of (d, k) in d_configs and k_configs, aligned with x
+    def config_pos(self, d, k):
         d_config = np.array(self.d_configs)
         k_config = np.array(self.k_configs)
-        for d in d_init:
-            mask = (d_config == d)
-            if np.any(mask):
-                j = np.where(mask)[0][0]
-                d_pos.append(j)
-        for k in k_init:
-            mask = (k_config == k)
-            if np.any(mask):
-                j = np.where(mask)[0][0]
-                k_pos.append(j)
-        
-        d_pos = np.array(d_pos)
-        k_pos = np.array(k_pos)
         x_pos = np.zeros(self.num_X, dtype=int)
-        x_pos[0::2] = d_pos
-        x_pos[1::2] = k_pos
-
-        cons_params = np.array(self.cons_params).T
-
-        searched = set()
-
-        need_pos = []
-        if self.need_probe is not None:
-            need_pos = [i for i in range(self.num_X) if self.need_probe[i]]
-
-        def bfs(x_pos, max_depth=4):
-            q = MyQueue()
-            searched.add(tuple(x_pos))
-            q.push([x_pos, 0])
-
-            best_pos = x_pos.copy()
-            best_x = np.zeros(self.num_X)
-            best_x[0::2] = d_config[best_pos[0::2]]
-            best_x[1::2] = k_config[best_pos[1::2]]
-            best_obj = self.objective(best_x, self.obj_params)
-            best_cons = self.constraint(best_x, self.obj_params, self.bound)
-
-            steps = [-1, 1]
-
-            while len(q) > 0:
-                p = q.pop()
-
-                x = np.zeros(self.num_X)
-                x[0::2] = d_config[p[0][0::2]]
-                x[1::2] = k_config[p[0][1::2]]
-                cons = self.constraint(x, cons_params, self.bound)
-                cons = np.percentile(cons, 100 * (1 - self.risk))
-                obj = self.objective(x, self.obj_params)
-                # print('x:', x, 'obj:', obj, 'cons:', cons)
-
-                if best_cons < 0:  # tight bound
-                    if cons < 0 and cons > best_cons and obj < best_obj:
-                        best_pos = p[0].copy()
-                        best_obj = obj
-                        best_cons = cons
-                else:  # find a feasible solution first
-                    if cons < best_cons:
-                        best_pos = p[0].copy()
-                        best_obj = obj
-                        best_cons = cons
-
-                if p[1] < max_depth:
-                    for t in range(self.num_X):
-                        if len(need_pos) > 0 and t not in need_pos:
-                            continue
-                        if t % 2 == 0:  # d
-                            config = d_config
-                        else:  # k
-                            config = k_config
-                        for s in steps:
-                            new_x_pos = p[0].copy()
-                            new_x_pos[t] += s
-                            if new_x_pos[t] < 0 or new_x_pos[t] >= len(config) or (t % 2 == 0 and new_x_pos[t] == 0):
-                                continue
-                            if tuple(new_x_pos) in searched:
-                                continue
-                            searched.add(tuple(new_x_pos))
-                            q.push([new_x_pos, p[1] + 1])
-
-            return best_pos
+        x_pos[0::2] = [np.where(d_config == v)[0][0] for v in d]
+        x_pos[1::2] = [np.where(k_config == v)[0][0] for v in k]
+        return tuple(x_pos.tolist())
+
+    def pos_config(self, pos):
+        return np.array(self.d_configs)[list(pos[0::2])].tolist(), \
+            np.array(self.k_configs)[list(pos[1::2])].tolist()
+
+    # The positions of x that the probe moves
+    def probe_moves(self):
+        if self.need_probe is not None and any(self.need_probe):
+            return [i for i in range(self.num_X) if self.need_probe[i]]
+        return list(range(self.num_X))
+
+    # The evaluated objectives and constraint percentiles of the positions, and the expanded nodes
+    def probe_memo(self):
+        return {'objs': {}, 'conss': {}, 'nodes': 0, 
+                'step_bound': self.probe_step_bound(self.probe_moves())}
+
+    # Evaluate the positions not in memo[name], 'objs' or 'conss'
+    def probe_eval(self, positions, memo, name):
+        vals = memo[name]
+        new = [pos for pos in positions if pos not in vals]
+        if len(new) > 0:
+            P = np.array(new)
+            X = np.zeros((len(new), self.num_X))
+            X[:, 0::2] = np.array(self.d_configs)[P[:, 0::2]]
+            X[:, 1::2] = np.array(self.k_configs)[P[:, 1::2]]
+            if name == 'objs':
+                vals.update(zip(new, self.eval_objs(X)))
+            else:
+                vals.update(zip(new, self.eval_conss(X, 100 * (1 - self.risk))))
+
+    def probe_neighbors(self, pos, moves):
+        for t in moves:
+            num_configs = len(self.d_configs) if t % 2 == 0 else len(self.k_configs)
+            for step in [-1, 1]:
+                new = pos[t] + step
+                if new < 0 or new >= num_configs or (t % 2 == 0 and new == 0):
+                    continue
+                yield pos[:t] + (new, ) + pos[t+1:]
+
+    # Move to the most feasible position of the neighborhood until one is feasible or none improves
+    def probe_feasible(self, x_pos, memo):
+        self.probe_eval([x_pos], memo, 'conss')
+        while memo['conss'][x_pos] >= 0 and not self.expired():
+            new_pos = self.probe_search(x_pos, self.probe_depth, True, memo)
+            if new_pos == x_pos:  # no improvement
+                break
+            x_pos = new_pos
+        return x_pos
 
-        x = np.zeros(self.num_X)
-        x[0::2] = d_config[x_pos[0::2]]
-        x[1::2] = k_config[x_pos[1::2]]
-        cons = self.constraint(x, cons_params, self.bound)
-        cons = np.percentile(cons, 100 * (1 - self.risk))
-        feasible = cons < 0
-        old_x_pos = x_pos.copy()
-        while not feasible:  # find a feasible solution first
-            x_pos = bfs(x_pos, self.probe_depth)
-            if x_pos.tolist() == old_x_pos.tolist():  # no improvement
+    '''
+    Best-first search from start by the moves (default probe_moves), within max_depth moves of 
+    root (default start), until memo['nodes'] reaches budget (default probe_budget), where 
+    memo['nodes'] counts the nodes expanded by all the searches sharing memo. With 
+    feasible_first, it returns the position with the lowest constraint, otherwise the feasible 
+    one with the lowest objective, starting from root as the incumbent. shared_best, if given, 
+    is a multiprocessing.Value of the lowest feasible objective found by any process, to prune 
+    with and to update. shared_nodes, if given, is a multiprocessing.Value of the nodes expanded 
+    by all the processes, which is checked against budget instead of memo['nodes'].
+    '''
+    def probe_search(self, start, max_depth, feasible_first, memo, moves=None, root=None, 
+                     budget=None, shared_best=None, shared_nodes=None):
+        all_moves = self.probe_moves()
+        moves = all_moves if moves is None else moves
+        root = start if root is None else root
+        budget = self.probe_budget if budget is None else budget
+        assert not feasible_first or start == root
+        objs, conss = memo['objs'], memo['conss']
+        step_bound = memo['step_bound']
+
+        def lowest():
+            if shared_best is None:
+                return objs[best]
+            return min(objs[best], shared_best.value)
+
+        # Whether pos, depth moves from root, cannot lead to an objective lower than the best.
+        # Without a bound on the decrease (inf), nothing is pruned, as 0 * inf is nan
+        def pruned(pos, depth):
+            if np.isinf(step_bound):
+                return False
+            return objs[pos] - (max_depth - depth) * step_bound >= lowest()
+
+        def update(pos):
+            if shared_best is not None:
+                with shared_best.get_lock():
+                    shared_best.value = min(shared_best.value, objs[pos])
+            return pos
+
+        # Count a node to expand, or return False if the budget is spent
+        def expand():
+            if shared_nodes is None:
+                if memo['nodes'] >= budget:
+                    return False
+            else:
+                with shared_nodes.get_lock():
+                    if shared_nodes.value >= budget:
+                        return False
+                    shared_nodes.value += 1
+            memo['nodes'] += 1
+            return True
+
+        self.probe_eval([root, start], memo, 'objs')
+        self.probe_eval([root, start], memo, 'conss')
+        key = conss if feasible_first else objs
+        best = root
+        if not feasible_first and conss[start] < 0 and objs[start] < objs[best]:
+            best = update(start)
+        queue = PriorityQueue()  # max-heap, so the priority is the negative key
+        queue.push(start, -key[start])
+        visited = {start}
+        while len(queue) > 0 and not self.expired():
+            pos, _ = queue.pop()
+            depth = sum(abs(pos[t] - root[t]) for t in all_moves)
+            if depth >= max_depth:
+                continue
+            if not feasible_first and pruned(pos, depth):
+                continue
+            if not expand():
                 break
-            old_x_pos = x_pos.copy()
+            children = [c for c in self.probe_neighbors(pos, moves) if c not in visited]
+            visited.update(children)
+            if len(children) == 0:
+                continue
+            self.probe_eval(children, memo, 'objs')
+            if not feasible_first:
+                # A child may move back towards root, so its depth is not always depth + 1
+                children = [c for c in children 
+                            if not pruned(c, sum(abs(c[t] - root[t]) for t in all_moves))]
+            self.probe_eval(children, memo, 'conss')
+            for c in children:
+                if feasible_first:
+                    if conss[c] < conss[best]:
+                        best = c
+                elif conss[c] < 0 and objs[c] < objs[best]:
+                    best = update(c)
+                queue.push(c, -key[c])
+        return best
+
+    '''
+    probe with the second search over a process pool: the positions within probe_depth moves 
+    of the feasible start are partitioned by the first move (in probe_moves order) where they 
+    differ from it and its offset, e.g., (x[t] - 2, x[t+1:] free), and each part is searched 
+    from its nearest position by a worker, see probe and multi_start for the other arguments. 
+    The workers read the constraint parameters from shared memory, keep their own evaluated 
+    positions, prune with the lowest objective found by any of them, and share the budget 
+    left by the first search.
+    '''
+    def probe_parallel(self, d_init, k_init, num_workers, func_code=None, input_size=None):
+        if num_workers <= 1:
+            return self.probe(d_init, k_init)
+        memo = self.probe_memo()
+        x_pos = self.probe_feasible(self.config_pos(d_init, k_init), memo)
+        if memo['conss'][x_pos] >= 0 or self.expired():
+            print('Probe nodes:', memo['nodes'], 'evaluated:', len(memo['conss']))
+            return self.pos_config(x_pos)
+        self.probe_eval([x_pos], memo, 'objs')
+
+        moves = self.probe_moves()
+        tasks = []
+        for i, t in enumerate(moves):
+            num_configs = len(self.d_configs) if t % 2 == 0 else len(self.k_configs)
+            for v in range(1, self.probe_depth + 1):
+                for new in [x_pos[t] - v, x_pos[t] + v]:
+                    if new < 0 or new >= num_configs or (t % 2 == 0 and new == 0):
+                        continue
+                    tasks.append((x_pos[:t] + (new, ) + x_pos[t+1:], moves[i+1:], x_pos, 
+                                  (memo['objs'][x_pos], memo['conss'][x_pos]), 
+                                  self.probe_budget, memo['step_bound']))
+        if len(tasks) == 0:  # no neighbor in range, or probe_depth is 0
+            print('Probe nodes:', memo['nodes'], 'evaluated:', len(memo['conss']))
+            return self.pos_config(x_pos)
+        shared_best = mp.Value('d', memo['objs'][x_pos])
+        shared_nodes = mp.Value('i', memo['nodes'])
+        with self.worker_pool(min(num_workers, len(tasks)), func_code, input_size, 
+                              shared_best, shared_nodes) as pool:
+            # The largest parts first, the results are in task order so ties are deterministic
+            results = pool.map(probe_region, tasks, chunksize=1)
+        best_pos, best_obj = x_pos, memo['objs'][x_pos]
+        num_nodes, num_evaluated = memo['nodes'], len(memo['conss'])
+        for pos, obj, cons, nodes, evaluated in results:
+            if cons < 0 and obj < best_obj:
+                best_pos, best_obj = pos, obj
+            num_nodes += nodes
+            num_evaluated += evaluated
+        print('Probe nodes:', num_nodes, 'evaluated:', num_evaluated, 'parts:', len(tasks))
+        return self.pos_config(best_pos)
+
+    '''
+    The most the objective can decrease in one probe move of the positions in move_pos. A move 
+    of k changes the value of its stage, and a move of d may also change the children that 
+    depend on it. The total (cost) or the smooth maximum of the path sums (latency) changes no 
+    more than the sum of the stage changes. inf if there are no batched functions.
+    '''
+    def probe_step_bound(self, move_pos):
+        if self.batch_funcs is None:
+            return np.inf
+        evaluator = self.batch_funcs
+        obj_params = np.array(self.obj_params, dtype=float)
+        num_stages = self.num_X // 2
+        # Stage values over d x k x parent d, and the max change of each with one config step
+        d_steps = np.zeros(num_stages)
+        k_steps = np.zeros(num_stages)
+        pd_steps = np.zeros(num_stages)
+        for i in range(num_stages):
+            parent = evaluator.parent_ids[i]
+            grid = np.array(np.meshgrid(self.d_configs, self.k_configs, 
+                                        self.d_configs if parent >= 0 else [0], indexing='ij'), 
+                            dtype=float)
+            X = np.zeros(grid.shape[1:] + (self.num_X, ))
+            X[..., 2*i], X[..., 2*i+1] = grid[0], grid[1]
+            if parent >= 0:
+                X[..., 2*parent] = grid[2]
+            vals = evaluator.stage_value(i, X.reshape(-1, self.num_X), obj_params, 
+                                         evaluator.obj_mode).reshape(grid.shape[1:])
+            d_steps[i] = np.max(np.abs(np.diff(vals, axis=0)), initial=0)
+            k_steps[i] = np.max(np.abs(np.diff(vals, axis=1)), initial=0)
+            pd_steps[i] = np.max(np.abs(np.diff(vals, axis=2)), initial=0)
+        res = 0
+        for t in move_pos:
+            i = t // 2
+            if t % 2 == 1:
+                res = max(res, k_steps[i])
+            else:
+                children = [c for c in range(num_stages) if evaluator.parent_ids[c] == i]
+                res = max(res, d_steps[i] + sum(pd_steps[c] for c in children))
+        return res
+
+    '''
+    Branch-and-bound over the config grid: grids[i] lists the candidate values of x[i]. The 
+    stages are fixed one by one (parents first, since a stage may depend on its parent's d). 
+    A partial config is bounded by taking, per sample, the minimum value of each free stage 
+    over its candidates, which lower-bounds both the objective and the percentile of the 
+    constraint as the path sums, the smooth maximum and the percentile are all monotone. 
+    The search is depth-first with the children in ascending order of their bounds, starting 
+    from the incumbent (d, k) if given, and stops after time_budget seconds. Only the configs 
+    that pass leaf_check(d, k) (e.g., the resource requirements of the workflow) are accepted.
+    @return: a dict of the best config ('d', 'k', None if none is found), its 'obj_val' and 
+             'cons_val' (the percentile), the 'gap' to the lowest bound of the unexplored 
+             subtrees (0 means proven optimal over the grid), and the number of 'nodes'
+    '''
+    def branch_and_bound(self, grids, incumbent=None, time_budget=10, leaf_check=None):
+        assert self.batch_funcs is not None and len(grids) == self.num_X
+        t0 = time.time()
+        evaluator = self.batch_funcs
+        num_stages = self.num_X // 2
+        q = 100 * (1 - self.risk)
+        obj_params = np.array(self.obj_params, dtype=float)
+
+        order = []
+        while len(order) < num_stages:
+            for i in range(num_stages):
+                parent = evaluator.parent_ids[i]
+                if i not in order and (parent < 0 or parent in order):
+                    order.append(i)
+
+        # The candidate rows of each stage as indices into the grids of d, k and the parent's d 
+        # if the stage depends on it
+        rows = []
+        parent_ds = []
+        obj_vals = []
+        cons_vals = []
+        for i in range(num_stages):
+            model = evaluator.perf_models[i]
+            parent = evaluator.parent_ids[i]
+            coupled = parent >= 0 and not model.allow_parallel and model.parent_relavent
+            num_pds = len(grids[2*parent]) if coupled else 1
+            ids = np.array([[d, k, pd] for d in range(len(grids[2*i])) 
+                            for k in range(len(grids[2*i+1])) for pd in range(num_pds)])
+            X_full = np.zeros((len(ids), self.num_X))
+            X_full[:, 2*i] = np.array(grids[2*i], dtype=float)[ids[:, 0]]
+            X_full[:, 2*i+1] = np.array(grids[2*i+1], dtype=float)[ids[:, 1]]
+            if coupled:
+                X_full[:, 2*parent] = np.array(grids[2*parent], dtype=float)[ids[:, 2]]
+            rows.append(ids[:, :2])
+            parent_ds.append(ids[:, 2] if coupled else None)
+            obj_vals.append(evaluator.stage_value(i, X_full, obj_params, evaluator.obj_mode))
+            cons_vals.append(evaluator.stage_value(i, X_full, self.cons_matrix, 
+                                                   evaluator.cons_mode))
+
+        # Cost sums over all the stages, latency takes the smooth maximum over the paths
+        obj_paths = evaluator.paths if evaluator.obj_mode == 'latency' else [list(range(num_stages))]
+        cons_paths = evaluator.paths if evaluator.cons_mode == 'latency' else [list(range(num_stages))]
+        # rest_xxx[j][p]: the sum of the per-sample minimums of order[j:] on path p
+        def rest_sums(vals, paths):
+            mins = [np.min(v, axis=0) for v in vals]
+            res = [[0 for _ in paths]]
+            for i in reversed(order):
+                res.insert(0, [res[0][p] + (mins[i] if i in path else 0) 
+                               for p, path in enumerate(paths)])
+            return res
+        rest_obj = rest_sums(obj_vals, obj_paths)
+        rest_cons = rest_sums(cons_vals, cons_paths)
+
+        best = {'obj_val': np.inf, 'd': None, 'k': None}
+        if incumbent is not None:
             x = np.zeros(self.num_X)
-            x[0::2] = d_config[x_pos[0::2]]
-            x[1::2] = k_config[x_pos[1::2]]
-            cons = self.constraint(x, self.obj_params, self.bound)
-            cons = self.constraint(x, cons_params, self.bound)
-            cons = np.percentile(cons, 100 * (1 - self.risk))
-            feasible = cons < 0
-        
-        # find the best solution
-        best_pos = bfs(x_pos, self.probe_depth)
-        best_d = d_config[best_pos[0::2]].tolist()
-        best_k = k_config[best_pos[1::2]].tolist()
+            x[0::2], x[1::2] = incumbent
+            objs, conss = self.eval_configs(x, q)
+            if conss[0] < 0:
+                best = {'obj_val': objs[0], 'd': list(incumbent[0]), 'k': list(incumbent[1])}
+        lowest = [np.inf]  # the lowest bound of the subtrees left unexplored by the budget
+        num_nodes = [0]
+        chosen = np.zeros(num_stages, dtype=int)
+
+        def search(j, obj_sums, cons_sums):
+            i = order[j]
+            parent = evaluator.parent_ids[i]
+            cand = np.arange(len(rows[i]))
+            if parent_ds[i] is not None:
+                cand = cand[parent_ds[i] == rows[parent][chosen[parent], 0]]
+            on_obj = [i in path for path in obj_paths]
+            obj_lbs = evaluator.smooth_max([obj_sums[p] + rest_obj[j+1][p] + 
+                                            (obj_vals[i][cand] if on_obj[p] else np.zeros(len(cand))) 
+                                            for p in range(len(obj_paths))])
+            sorted_ids = np.argsort(obj_lbs, kind='stable')
+            for n, idx in enumerate(sorted_ids):
+                if obj_lbs[idx] >= best['obj_val']:
+                    return
+                if time.time() - t0 > time_budget:
+                    lowest[0] = min(lowest[0], obj_lbs[idx])
+                    return
+                num_nodes[0] += 1
+                r = cand[idx]
+                new_cons = [cons_sums[p] + (cons_vals[i][r] if i in path else 0) 
+                            for p, path in enumerate(cons_paths)]
+                cons_lb = self.percentile(evaluator.smooth_max([new_cons[p] + rest_cons[j+1][p] 
+                                                                for p in range(len(cons_paths))]), q) - self.bound
+                if cons_lb >= 0:
+                    continue
+                chosen[i] = r
+                if j == num_stages - 1:
+                    # The bounds are exact at a leaf
+                    d = [grids[2*s][rows[s][chosen[s], 0]] for s in range(num_stages)]
+                    k = [grids[2*s+1][rows[s][chosen[s], 1]] for s in range(num_stages)]
+                    if leaf_check is None or leaf_check(d, k):
+                        best['obj_val'], best['d'], best['k'] = obj_lbs[idx], d, k
+                else:
+                    new_obj = [obj_sums[p] + (obj_vals[i][r] if on_obj[p] else 0) 
+                               for p in range(len(obj_paths))]
+                    search(j + 1, new_obj, new_cons)
 
-        return best_d, best_k
+        search(0, [0 for _ in obj_paths], [np.zeros(self.cons_matrix.shape[1]) for _ in cons_paths])
+
+        res = {'d': best['d'], 'k': best['k'], 'nodes': num_nodes[0]}
+        res['obj_val'], res['cons_val'] = np.inf, np.inf
+        if best['d'] is not None:
+            x = np.zeros(self.num_X)
+            x[0::2], x[1::2] = best['d'], best['k']
+            objs, conss = self.eval_configs(x, q)
+            res['obj_val'], res['cons_val'] = float(objs[0]), float(conss[0] + self.bound)
+        res['gap'] = np.inf
+        if best['d'] is not None:
+            res['gap'] = 0 if lowest[0] >= res['obj_val'] else \
+                (res['obj_val'] - lowest[0]) / abs(res['obj_val'])
+        return res
 
     def get_vals(self, d, k, tile=95):
         assert len(d) == self.num_X // 2
@@ -282,142 +947,24 @@ class PCPSolver:
         x[0::2] = d
         x[1::2] = k
 
-        cons_params = np.array(self.cons_params).T
+        cons_params = self.cons_matrix
 
-        obj = self.objective(x, cons_params)
-        obj = np.percentile(obj, tile)
-        cons = self.constraint(x, cons_params, self.bound) + self.bound
-        cons = np.percentile(cons, tile)
+        if self.batch_funcs is None:
+            obj = self.objective(x, cons_params)
+            obj = self.percentile(obj, tile)
+            cons = self.constraint(x, cons_params, self.bound) + self.bound
+            cons = self.percentile(cons, tile)
+        else:
+            obj = batch_percentile(self.batch_funcs.objective(x, cons_params), tile, 
+                                   self.cons_weights, self.num_dominated)[0]
+            cons = batch_percentile(self.batch_funcs.constraint(x, cons_params, 0), tile, 
+                                    self.cons_weights, self.num_dominated)[0]
         
         if self.bound_type == 'latency':
             return cons, obj
         else:
             return obj, cons
 
-    @deprecated
-    def probe_parallel(self, d_init, k_init):
-        # assume init is within the feasible region
-        d_pos = []
-        k_pos = []
-        d_config = np.array(self.d_configs)
-        k_config = np.array(self.k_configs)
-        for d in d_init:
-            mask = (d_config == d)
-            if np.any(mask):
-                j = np.where(mask)[0][0]
-                d_pos.append(j)
-        for k in k_init:
-            mask = (k_config == k)
-            if np.any(mask):
-                j = np.where(mask)[0][0]
-                k_pos.append(j)
-        
-        d_pos = np.array(d_pos)
-        k_pos = np.array(k_pos)
-        x_pos = np.zeros(self.num_X, dtype=int)
-        x_pos[0::2] = d_pos
-        x_pos[1::2] = k_pos
-
-        cons_params = np.array(self.cons_params).T
-
-        searched = Manager().dict()
-
-        need_pos = []
-        if self.need_probe is not None:
-            need_pos = [i for i in range(self.num_X) if self.need_probe[i]]
-
-        def bfs(x_pos, max_depth=8):
-            q = MyQueue()
-            # searched.add(tuple(x_pos))
-            searched[tuple(x_pos)] = 1
-            q.push([x_pos, 0])
-
-            best_pos = x_pos.copy()
-            best_x = np.zeros(self.num_X)
-            best_x[0::2] = d_config[best_pos[0::2]]
-            best_x[1::2] = k_config[best_pos[1::2]]
-            best_obj = self.objective(best_x, self.obj_params)
-            best_cons = self.constraint(best_x, self.obj_params, self.bound)
-
-            steps = [-1, 1]
-
-            while len(q) > 0:
-                p = q.pop()
-
-                x = np.zeros(self.num_X)
-                x[0::2] = d_config[p[0][0::2]]
-                x[1::2] = k_config[p[0][1::2]]
-                cons = self.constraint(x, cons_params, self.bound)
-                cons = np.percentile(cons, 100 * (1 - self.risk))
-                obj = self.objective(x, self.obj_params)
-
-                if best_cons < 0:  # tight bound
-                    if cons < 0 and cons > best_cons and obj < best_obj:
-                        best_pos = p[0].copy()
-                        best_obj = obj
-                        best_cons = cons
-                else:  # find a feasible solution first
-                    if cons < best_cons:
-                        best_pos = p[0].copy()
-                        best_obj = obj
-                        best_cons = cons
-
-                if p[1] < max_depth:
-                    for t in range(self.num_X):
-                        if len(need_pos) > 0 and t not in need_pos:
-                            continue
-                        if t % 2 == 0:  # d
-                            config = d_config
-                        else:  # k
-                            config = k_config
-                        for s in steps:
-                            new_x_pos = p[0].copy()
-                            new_x_pos[t] += s
-                            if new_x_pos[t] < 0 or new_x_pos[t] >= len(config) or (t % 2 == 0 and new_x_pos[t] == 0):
-                                continue
-                            if tuple(new_x_pos) in searched:
-                                continue
-                            searched[tuple(new_x_pos)] = 1
-                            q.push([new_x_pos, p[1] + 1])
-
-            return best_pos, best_obj, best_cons
-
-        threads = []
-
-        pq = Queue()
-        for i in range(len(need_pos)):
-            new_x_pos = x_pos.copy()
-            new_x_pos[need_pos[i]] += 1
-            if (need_pos[i] % 2 == 0 and new_x_pos[need_pos[i]] < len(d_config)):
-                threads.append(MyProcess(target=bfs, args=new_x_pos, queue=pq))
-            if (need_pos[i] % 2 == 1 and new_x_pos[need_pos[i]] < len(k_config)):
-                threads.append(MyProcess(target=bfs, args=new_x_pos, queue=pq))
-            new_x_pos = x_pos.copy()
-            new_x_pos[need_pos[i]] -= 1
-            if new_x_pos[need_pos[i]] >= 0 or (new_x_pos[need_pos[i]] % 2 == 0 and new_x_pos[need_pos[i]] > 0):
-                threads.append(MyProcess(target=bfs, args=new_x_pos))
-        for t in threads:
-            t.start()
-        # get the results of all threads
-        best_pos = x_pos.copy()
-        best_x = np.zeros(self.num_X)
-        best_x[0::2] = d_config[best_pos[0::2]]
-        best_x[1::2] = k_config[best_pos[1::2]]
-        best_obj = self.objective(best_x, self.obj_params)
-        best_cons = self.constraint(best_x, self.obj_params, self.bound)
-        for t in threads:
-            t.join()
-        while not pq.empty():
-            pos, obj, cons = t._result
-            if cons > best_cons:
-                best_pos = pos
-                best_obj = obj
-                best_cons = cons
-        best_d = d_config[best_pos[0::2]].tolist()
-        best_k = k_config[best_pos[1::2]].tolist()
-
-        return best_d, best_k
-
     '''
     The generic constraint satisfaction is deprecated due to the nondeterministic behavior of
     existing solvers for the logical control flow in the constraint function (e.g, if-else and 
@@ -437,4 +984,4 @@ if __name__ == '__main__':
     approx_risk = 0
     confidence_error = 0.01
     sample_size = PCPSolver.sample_size(num_stages, risk, approx_risk, confidence_error)
-    print('sample size:', sample_size)
\ No newline at end of file
+    print('sample size:', sample_size)
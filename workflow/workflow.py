@@ -2,13 +2,127 @@ from multiprocessing import Pool
 import time
 import json
 import os
+import math
+import hashlib
+from collections import OrderedDict
 from deprecation import deprecated
 import numpy as np
+from scipy.cluster.vq import kmeans2
+from scipy.stats import wasserstein_distance
+from scipy.spatial import ConvexHull, QhullError
 
 from stage import Stage, Status, PerfModel
-from perf_model import StagePerfModel, config_pairs, step_names, get_config_pairs
+from perf_model import StagePerfModel, config_pairs, step_names, get_config_pairs, num_coeffs, \
+    sample_methods, qmc_uniform
 from perf_model_dist import config_pairs as dist_config_pairs, get_config_pairs_dist
-from utils import MyThread, MyProcess, PCPSolver, extract_info_from_log, clear_data, orca_extract_info_from_log
+from utils import MyThread, MyProcess, PCPSolver, extract_info_from_log, clear_data, orca_extract_info_from_log, \
+    weighted_percentile
+
+# In-process cache of the sample matrices, keyed by (workflow, model hash, num_samples, seed, method)
+sample_cache = OrderedDict()
+max_cached_samples = 8
+
+# Indices of the points whose convex hull contains all the points, i.e., where the linear 
+# functions of the points reach the minimum and maximum
+def hull_vertices(points):
+    points = points[:, np.ptp(points, axis=0) > 0]
+    if points.shape[1] == 0:
+        return np.array([0])
+    if points.shape[1] == 1:
+        return np.unique([np.argmin(points[:, 0]), np.argmax(points[:, 0])])
+    try:
+        return ConvexHull(points).vertices
+    except QhullError:  # degenerate, e.g., fewer points than dimensions
+        return np.arange(len(points))
+
+# The most dominators of a sample that may be at or above the lower interpolation point of the 
+# (1-risk)-tile of N samples, h = (N-1)(1-risk) with the arithmetic of PCPSolver.percentile, 
+# i.e., the N - 1 - floor(h) samples above it
+def prune_threshold(num_samples, risk):
+    h = (num_samples - 1) * ((100 * (1 - risk)) / 100)
+    return num_samples - 1 - math.floor(h)
+
+# Whether each row of vals has more than max_dominators rows >= it on every column (and > on one)
+def dominated_samples(vals, max_dominators):
+    num_samples = vals.shape[0]
+    # The dominators of j are among the samples >= j on every column, so the smallest 
+    # column-wise count bounds their number: only samples low on every column are checked
+    sorted_vals = np.sort(vals, axis=0)
+    num_geq = num_samples - np.stack([np.searchsorted(sorted_vals[:, c], vals[:, c], 'left') 
+                                      for c in range(vals.shape[1])], axis=1)
+    candidates = np.where(np.min(num_geq, axis=1) - 1 > max_dominators)[0]
+
+    # A dominator has a larger sum, and is >= on each column, narrow them down column by column
+    sums = np.sum(vals, axis=1)
+    pruned = np.zeros(num_samples, dtype=bool)
+    for j in candidates:
+        above = np.where(sums > sums[j])[0]
+        for c in range(vals.shape[1]):
+            if len(above) <= max_dominators:
+                break
+            above = above[vals[above, c] >= vals[j, c]]
+        pruned[j] = len(above) > max_dominators
+    return pruned
+
+'''
+Batched counterpart of the generated objective_func and constraint_func: X holds one candidate 
+config per row, (num_candidates, num_X), and p is the parameter vector (num_coeffs*num_stages, ) 
+or the sample matrix (num_coeffs*num_stages, num_samples). Each stage is the product of its basis 
+features of all the candidates with its coefficient rows, so a BFS level is a few matrix products.
+It only holds the performance models and the DAG as stage ids, so it can be pickled.
+'''
+class BatchEvaluator:
+    def __init__(self, perf_models, parent_ids, paths, cons_mode='latency', temperature=0.1, 
+                 input_size=None):
+        assert cons_mode in ['latency', 'cost'] and temperature > 0
+        assert input_size is not None and input_size > 0
+        self.perf_models = perf_models
+        self.parent_ids = parent_ids
+        self.paths = paths  # The dominant paths as lists of stage ids
+        self.cons_mode = cons_mode
+        self.obj_mode = 'cost' if cons_mode == 'latency' else 'latency'
+        self.temperature = temperature
+        self.input_size = input_size
+
+    def stage_value(self, i, X, p, mode):
+        model = self.perf_models[i]
+        d = X[:, 2*i] if model.allow_parallel else np.ones(len(X))
+        k = X[:, 2*i+1]
+        parent_d = X[:, 2*self.parent_ids[i]] if self.parent_ids[i] >= 0 else None
+        feats = model.basis_matrix(d, k, parent_d, self.input_size)
+        coeffs = p[i*num_coeffs:(i+1)*num_coeffs]
+        work = feats @ coeffs[1:]
+        samples = work.ndim == 2
+        if mode == 'latency':
+            trend = model.cold_trend_matrix(d, k)
+            return work + coeffs[0] + (trend[:, None] if samples else trend)
+        scale = k * d * 2.9225
+        return work * (scale[:, None] if samples else scale) + \
+            (0.02 * d[:, None] if samples else 0.02 * d)
+
+    def value(self, X, p, mode):
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        p = np.asarray(p, dtype=float)
+        if mode == 'cost':
+            return sum(self.stage_value(i, X, p, mode) for i in range(len(self.perf_models)))
+        stage_ids = sorted(set(i for path in self.paths for i in path))
+        vals = {i: self.stage_value(i, X, p, mode) for i in stage_ids}
+        return self.smooth_max([sum(vals[i] for i in path) for path in self.paths])
+
+    # The smooth maximum over the path values, which is non-decreasing in each of them
+    def smooth_max(self, path_vals):
+        if len(path_vals) == 1:
+            return path_vals[0]
+        path_vals = np.array(path_vals)
+        m = np.max(path_vals, axis=0)
+        return m + self.temperature * np.log(np.sum(np.exp((path_vals - m) / self.temperature), 
+                                                    axis=0))
+
+    def objective(self, X, p):
+        return self.value(X, p, self.obj_mode)
+
+    def constraint(self, X, p, b):
+        return self.value(X, p, self.cons_mode) - b
 
 class Workflow:
     def __init__(self, config_file, perf_model_type = 0, boto3_client_ = None) -> None:
@@ -20,13 +134,14 @@ class Workflow:
         self.stages = []
         self.sources = []
         self.sinks = []
-
-        self.critical_path = None
-        self.secondary_path = None
         
         self.perf_model_type = perf_model_type
+        self.trained = False
+        # Compiled objective and constraint functions, see compile_funcs
+        self.compiled_funcs = {}
         
         config = json.load(open(config_file, 'r'))
+        self.config_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
         self.parse_config(config)
     
     def parse_config(self, config) -> None:
@@ -90,12 +205,6 @@ class Workflow:
             if len(stage.children) == 0:
                 self.sinks.append(stage)
 
-        # config critical path and secondary path
-        if 'critical_path' in config:
-            self.critical_path = [self.stages[i] for i in config['critical_path']]
-        if 'secondary_path' in config:
-            self.secondary_path = [self.stages[i] for i in config['secondary_path']]
-                
         for stage in self.sources:
             stage.status = Status.READY
         
@@ -104,22 +213,7 @@ class Workflow:
         
         
     def check_dag(self):
-        queue = self.sources.copy()
-        in_degrees = [len(s.parents) for s in self.stages]
-        
-        count = 0
-        while len(queue) > 0:
-            node = queue.pop(0)
-            count += 1
-            
-            for child in node.children:
-                ids = child.stage_id
-                in_degrees[ids] -= 1
-                
-                if in_degrees[ids] == 0:
-                    queue.append(child)
-                    
-        return count >= len(self.stages)
+        return len(self.topo_order()) >= len(self.stages)
     
     def check_finished(self, threads):
         assert isinstance(threads, list)
@@ -216,7 +310,10 @@ class Workflow:
     def profile_jolteon(self, num_epochs) -> str:
         # Use different configurations to profile, 
         # profile multiple epochs under the same configuration
-        # and write the results to a storage (S3 or local) or pass to the performance model
+        # and write the results to a storage (S3 or local) or pass to the performance model.
+        # The functions always read the input of the workflow config, so the profile is of
+        # one input size; the input-size terms of the models are fitted from offline profiles
+        # gathered at real input sizes, see StagePerfModel.load_input_sizes
         assert isinstance(num_epochs, int) and num_epochs > 0 
         
         # Organize the results into an array divided according to each stage
@@ -505,6 +602,7 @@ class Workflow:
             for stage in self.stages:
                 for p in stage.parents:
                     stage.perf_model.add_up_model(p.perf_model)
+        self.trained = True
         
         t1 = time.time()
         print('Training time:', t1 - t0, 's\n')
@@ -539,41 +637,184 @@ class Workflow:
                 if path.index(stage) != len(path) - 1:
                     print(stage.stage_name, end='-->')
                 else:
-                    print(stage.stage_name)      
+                    print(stage.stage_name)
 
-    def predict(self, mode='latency'):
+    def topo_order(self):
+        queue = self.sources.copy()
+        in_degrees = [len(s.parents) for s in self.stages]
+
+        order = []
+        while len(queue) > 0:
+            node = queue.pop(0)
+            order.append(node)
+
+            for child in node.children:
+                ids = child.stage_id
+                in_degrees[ids] -= 1
+
+                if in_degrees[ids] == 0:
+                    queue.append(child)
+
+        return order
+
+    # The parent stage whose parallelism is relevant to a not allow_parallel stage, -1 for none
+    def get_parent_ids(self):
+        parent_ids = [-1 for _ in range(len(self.stages))]
+        for stage in self.stages:
+            if not stage.allow_parallel:
+                for i in range(len(stage.parents)-1, -1, -1):
+                    if stage.parents[i].allow_parallel:
+                        parent_ids[stage.stage_id] = stage.parents[i].stage_id
+                        break
+        return parent_ids
+
+    '''
+    Longest path of the DAG by dynamic programming in topological order.
+    @param stage_vals: the latency of each stage, array with shape (num_stages, ) or
+                       (num_stages, num_samples) to evaluate all samples at once
+    @return: the makespan, float or array with shape (num_samples, ), and the argmax path
+             as a list of stages; for multiple samples, it is the path that is critical
+             for the largest number of samples
+    '''
+    def longest_path(self, stage_vals):
+        stage_vals = np.asarray(stage_vals, dtype=float)
+        assert stage_vals.shape[0] == len(self.stages)
+        single = stage_vals.ndim == 1
+        if single:
+            stage_vals = stage_vals[:, None]
+        num_samples = stage_vals.shape[1]
+
+        # finish[i] is the latest finish time of stage i, prev[i] is its critical parent
+        finish = np.zeros(stage_vals.shape)
+        prev = np.full(stage_vals.shape, -1, dtype=int)
+        for stage in self.topo_order():
+            ids = stage.stage_id
+            if len(stage.parents) > 0:
+                parent_ids = np.array([p.stage_id for p in stage.parents])
+                parent_finish = finish[parent_ids]
+                arg = np.argmax(parent_finish, axis=0)
+                prev[ids] = parent_ids[arg]
+                finish[ids] = parent_finish[arg, np.arange(num_samples)]
+            finish[ids] += stage_vals[ids]
+
+        sink_ids = np.array([s.stage_id for s in self.sinks])
+        sink_finish = finish[sink_ids]
+        arg = np.argmax(sink_finish, axis=0)
+        makespan = sink_finish[arg, np.arange(num_samples)]
+
+        # Backtrack the critical path of each sample as a membership mask
+        on_path = np.zeros((num_samples, len(self.stages)), dtype=bool)
+        cur = sink_ids[arg]
+        active = np.ones(num_samples, dtype=bool)
+        while np.any(active):
+            on_path[np.where(active)[0], cur[active]] = True
+            cur = np.where(active, prev[np.where(active, cur, 0), np.arange(num_samples)], -1)
+            active = cur >= 0
+
+        masks, counts = np.unique(on_path, axis=0, return_counts=True)
+        mask = masks[np.argmax(counts)]
+        path = [stage for stage in self.topo_order() if mask[stage.stage_id]]
+
+        if single:
+            return makespan[0], path
+        return makespan, path
+
+    '''
+    Predict the latency (DAG makespan) or cost of the workflow under the current config.
+    @param samples: optional parameter samples with shape (num_samples, num_coeffs*num_stages)
+                    (see sample_online), then the distribution is returned as an array
+    @param input_size: the input size (MB), None means the default input size
+    '''
+    def predict(self, mode='latency', samples=None, return_path=False, input_size=None):
         assert mode in ['latency', 'cost']
+        stage_vals = self.stage_values(mode, samples, input_size)
+
         if mode == 'latency':
-            paths = self.find_paths()
-            latency = 0.0
-            for path in paths:
-                tmp_latency = 0.0
-                parent_d = 0
-                for stage in path:
-                    tmp_latency += stage.perf_model.predict(stage.config['memory']/1792, 
-                                                            stage.num_func, mode, 
-                                                            parent_d=parent_d,
-                                                            cold_percent=60)
-                    parent_d = stage.num_func
-                if paths.index(path) == 0:
-                    latency = tmp_latency
-                elif tmp_latency > latency:
-                    latency = tmp_latency
+            latency, path = self.longest_path(stage_vals)
+            if return_path:
+                return latency, path
             return latency
         else:
-            cost = 0.0
-            for stage in self.stages:
-                parent_d = 0
-                if not stage.allow_parallel:
-                    for i in range(len(stage.parents)-1, -1, -1):
-                        if stage.parents[i].allow_parallel:
-                            parent_d = stage.parents[i].num_func
-                            break
-                cost += stage.perf_model.predict(stage.config['memory']/1792,
-                                                 stage.num_func, mode,
-                                                 parent_d=parent_d,
-                                                 cold_percent=0)
-            return cost
+            return np.sum(stage_vals, axis=0)
+
+    # Per-stage latency or cost under the current config, with shape (num_stages, ) or 
+    # (num_stages, num_samples) if samples is given
+    def stage_values(self, mode='latency', samples=None, input_size=None):
+        parent_ids = self.get_parent_ids()
+        if samples is not None:
+            samples = np.asarray(samples)
+            assert samples.ndim == 2 and samples.shape[1] == num_coeffs * len(self.stages)
+        size_kwargs = {} if input_size is None else {'input_size': input_size}
+
+        stage_vals = []
+        for stage in self.stages:
+            parent_d = 0
+            if parent_ids[stage.stage_id] >= 0:
+                parent_d = self.stages[parent_ids[stage.stage_id]].num_func
+            if samples is None:
+                val = stage.perf_model.predict(stage.config['memory']/1792,
+                                               stage.num_func, mode,
+                                               parent_d=parent_d,
+                                               cold_percent=60 if mode == 'latency' else 0,
+                                               **size_kwargs)
+            else:
+                ids = stage.stage_id
+                val = stage.perf_model.predict_samples(samples[:, ids*num_coeffs:(ids+1)*num_coeffs],
+                                                       stage.config['memory']/1792,
+                                                       stage.num_func, mode,
+                                                       parent_d=parent_d, **size_kwargs)
+            stage_vals.append(val)
+        return np.array(stage_vals)
+
+    '''
+    Scenario reduction: replace the samples by num_scenarios weighted representatives.
+    Under the current config, the samples with the top 2*risk latency (or cost) are kept as they
+    are, since they decide the (1-risk)-tile, the others are clustered (k-means) on their 
+    per-stage latency (or cost) and each cluster is represented by the sample nearest to its 
+    center, weighted by the cluster size. The weights sum to the number of samples.
+    @return: the reduced samples, their weights and the reduction errors (the Wasserstein 
+             distance of the distributions and the error of the (1-risk)-tile)
+    '''
+    def reduce_samples(self, samples, num_scenarios, risk, mode='latency', input_size=None, 
+                       seed=0):
+        assert isinstance(num_scenarios, int) and num_scenarios > 0 and risk > 0 and risk < 1
+        samples = np.asarray(samples)
+        num_samples = samples.shape[0]
+        if num_scenarios >= num_samples:
+            return samples, np.ones(num_samples), (0, 0)
+
+        stage_vals = self.stage_values(mode, samples, input_size)
+        if mode == 'latency':
+            total = self.longest_path(stage_vals)[0]
+        else:
+            total = np.sum(stage_vals, axis=0)
+
+        order = np.argsort(total)
+        num_tail = min(num_scenarios // 2, math.ceil(2 * risk * num_samples))
+        tail = order[num_samples - num_tail:]
+        body = order[:num_samples - num_tail]
+
+        feats = stage_vals[:, body].T
+        scale = np.std(feats, axis=0)
+        scale[scale == 0] = 1
+        feats = feats / scale
+        centroids, labels = kmeans2(feats, num_scenarios - num_tail, minit='++', seed=seed)
+        reps = []
+        weights = []
+        for c in range(len(centroids)):
+            members = np.where(labels == c)[0]
+            if len(members) == 0:
+                continue
+            dists = np.sum((feats[members] - centroids[c])**2, axis=1)
+            reps.append(body[members[np.argmin(dists)]])
+            weights.append(len(members))
+
+        idx = np.concatenate([tail, np.array(reps, dtype=int)])
+        weights = np.concatenate([np.ones(num_tail), np.array(weights, dtype=float)])
+        dist_err = wasserstein_distance(total, total[idx], v_weights=weights)
+        tile_err = abs(weighted_percentile(total[idx], 100 * (1 - risk), weights) - 
+                       np.percentile(total, 100 * (1 - risk)))
+        return np.ascontiguousarray(samples[idx]), weights, (dist_err, tile_err)
 
     def store_params(self):
         res = np.concatenate([stage.perf_model.params() for stage in self.stages])
@@ -589,51 +830,143 @@ class Workflow:
         return param_path
 
     def get_params(self):
-        # calibration
-        if self.workflow_name == 'ML-Pipeline':
-            cold_percent = 60
-        elif self.workflow_name == 'Video-Analytics':
-            cold_percent = 85
-        elif self.workflow_name == 'tpcds/dsq95':
-            cold_percent = 75
-        # <<< swkim
-        elif self.workflow_name == 'MLPipeline':
-            cold_percent = 60
-        # <<< swkim
-        res = np.concatenate([stage.perf_model.params(cold_percent) for stage in self.stages])
+        res = np.concatenate([stage.perf_model.params() for stage in self.stages])
         res = res.tolist()
         return res
 
-    def sample_offline(self, num_samples):
+    # Identify the trained performance models, i.e., what the samples are drawn from
+    def model_hash(self):
+        h = hashlib.sha1()
+        for stage in self.stages:
+            h.update(stage.stage_name.encode())
+            stage.perf_model.update_hash(h)
+        return h.hexdigest()[:16]
+
+    '''
+    Samples are stored as a float64 .npy with shape (num_samples, num_coeffs*num_stages) and 
+    a header xxx_samples.meta.json recording the seed, model hash and stage order, so that 
+    load_samples can memory-map the file instead of parsing it.
+    '''
+    def sample_offline(self, num_samples, seed=0, method='mc'):
         assert isinstance(num_samples, int) and num_samples > 0
-        res = np.concatenate([stage.perf_model.sample_offline(num_samples) for stage in self.stages], axis=1)
-        res = res.tolist()
-        sample_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        sample_dir = os.path.join(sample_dir, 'samples/')
+        res = self.draw_samples(num_samples, seed, method)
+        sample_path = self.metadata_path('samples')
+        sample_dir = os.path.dirname(sample_path)
         if not os.path.exists(sample_dir):
             os.mkdir(sample_dir)
-        sample_path = self.workflow_name + '_samples.json'
-        sample_path = sample_path.replace('/', '-')  # transfer '/' in profile_path to '-'
-        sample_path = os.path.join(sample_dir, sample_path)
-        json.dump(res, open(sample_path, 'w'))
+        np.save(sample_path, res)
+        header = {'seed': seed, 'method': method, 'model_hash': self.model_hash(), 
+                  'stages': [stage.stage_name for stage in self.stages], 
+                  'num_coeffs': num_coeffs, 'shape': list(res.shape)}
+        json.dump(header, open(self.sample_header_path(sample_path), 'w'))
         return sample_path
 
-    def sample_online(self, num_samples):
+    def sample_header_path(self, sample_path):
+        assert sample_path.endswith('.npy')
+        return sample_path[:-len('.npy')] + '.meta.json'
+
+    '''
+    Samples of the current models as one read-only contiguous float64 array. With cache, the 
+    samples are reused across calls in the process and across processes through the .npy files 
+    under samples/cache/, keyed by the model hash, so retraining invalidates them.
+    '''
+    def sample_online(self, num_samples, seed=0, method='mc', cache=True):
         assert isinstance(num_samples, int) and num_samples > 0
-        res = np.concatenate([stage.perf_model.sample_offline(num_samples) for stage in self.stages], axis=1)
-        res = res.tolist()
-        return res
+        if not cache:
+            return self.draw_samples(num_samples, seed, method)
+
+        key = (self.workflow_name, self.model_hash(), num_samples, seed, method)
+        if key in sample_cache:
+            sample_cache.move_to_end(key)
+            return sample_cache[key]
+
+        cache_path = self.sample_cache_path(num_samples, seed, method)
+        res = None
+        if os.path.exists(cache_path):
+            res = np.load(cache_path)
+            if res.shape != (num_samples, num_coeffs * len(self.stages)) or res.dtype != np.float64:
+                res = None
+            else:
+                print('Samples loaded from', cache_path)
+        if res is None:
+            res = self.draw_samples(num_samples, seed, method)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Write then rename, concurrent schedulers never read a partial file
+            tmp_path = cache_path[:-len('.npy')] + '.%d.tmp.npy' % os.getpid()
+            np.save(tmp_path, res)
+            os.replace(tmp_path, cache_path)
 
-    def prune_samples(self, samples):
-        # is_greater_than_others = np.ones(samples.shape[0], dtype=bool)
-        is_less_than_another = np.zeros(samples.shape[0], dtype=bool)
-        for i in range(samples.shape[0]):
-            # is_greater_than_others[i] = np.all(np.all(samples[i] > samples[np.arange(res.shape[0]) != i], axis=1))
-            is_less_than_another[i] = np.any(np.all(samples[i] < samples[np.arange(res.shape[0]) != i], axis=1))
-        # res = samples[is_greater_than_others]
-        res = samples[is_less_than_another]
-        # print(res.shape[0])
+        res.flags.writeable = False
+        sample_cache[key] = res
+        while len(sample_cache) > max_cached_samples:
+            sample_cache.popitem(last=False)
         return res
+
+    def sample_cache_path(self, num_samples, seed=0, method='mc'):
+        cache_dir = os.path.join(os.path.dirname(self.metadata_path('samples')), 'cache')
+        file_name = '%s_%s_%s_%d_%d.npy' % (self.workflow_name.replace('/', '-'), self.model_hash(), 
+                                            method, seed, num_samples)
+        return os.path.join(cache_dir, file_name)
+
+    '''
+    Draw num_samples samples of all the stages, with shape (num_samples, num_coeffs*num_stages).
+    For QMC methods, the stages share one low-discrepancy point set (each stage takes its own 
+    coordinates), so the joint samples rather than each stage's marginal are well spread.
+    '''
+    def draw_samples(self, num_samples, seed=0, method='mc'):
+        assert method in sample_methods
+        if method == 'mc':
+            res = [stage.perf_model.sample_offline(num_samples, seed) for stage in self.stages]
+        else:
+            dims = [stage.perf_model.sample_dim() for stage in self.stages]
+            u = qmc_uniform(method, sum(dims), num_samples, seed)
+            offsets = np.cumsum([0] + dims)
+            res = [stage.perf_model.sample_offline(num_samples, seed, method, 
+                                                   u[:, offsets[i]:offsets[i+1]]) 
+                   for i, stage in enumerate(self.stages)]
+        return np.ascontiguousarray(np.concatenate(res, axis=1), dtype=np.float64)
+
+    '''
+    Dominance pruning of the parameter samples for the chance constraint.
+    At a grid config, a stage's latency (cost) is increasing in cold + params[1:] @ basis 
+    (params[1:] @ basis), and the workflow's latency (cost) is increasing in the stage ones. 
+    Sample i dominates sample j if all these stage values of i are >= those of j at every grid 
+    config (and one is >), so j violates the bound only if all its dominators do. With 
+    m = prune_threshold(N, risk) >= ceil((N-1) * risk), a sample with > m dominators is below 
+    both interpolation points of the (1-risk)-tile at any grid config, and if it is violated, 
+    at least m + 1 > risk * N kept samples are violated too, so the config is infeasible either 
+    way. Dropping such samples keeps the (1-risk)-tile exact, as long as the N - K dropped 
+    samples are still counted.
+    @return: the kept samples and the number of dropped samples
+    '''
+    def prune_samples(self, samples, risk, vcpu_configs, parallel_configs, input_size=None):
+        assert risk > 0 and risk < 1
+        samples = np.asarray(samples)
+        assert samples.ndim == 2 and samples.shape[1] == num_coeffs * len(self.stages)
+        num_samples = samples.shape[0]
+        max_dominators = prune_threshold(num_samples, risk)
+
+        stage_vals = []
+        for stage in self.stages:
+            ids = stage.stage_id
+            coeffs = samples[:, ids*num_coeffs:(ids+1)*num_coeffs]
+            grid = stage.perf_model.grid_basis(vcpu_configs, parallel_configs, input_size)
+            grid = grid[hull_vertices(grid[:, np.ptp(coeffs[:, 1:], axis=0) > 0])]
+            cost = coeffs[:, 1:] @ grid.T
+            stage_vals.append(np.concatenate([cost + coeffs[:, :1], cost], axis=1))
+        # Interleave the stages, the independent ones rule out the dominators faster
+        vals = np.concatenate(stage_vals, axis=1)
+        offsets = np.cumsum([0] + [v.shape[1] for v in stage_vals])
+        cols = sorted(range(vals.shape[1]), 
+                      key=lambda c: c - offsets[np.searchsorted(offsets, c, 'right') - 1])
+        vals = vals[:, cols]
+        # Columns without variance cannot tell the samples apart
+        vals = vals[:, np.ptp(vals, axis=0) > 0]
+        if vals.shape[1] == 0:
+            return np.ascontiguousarray(samples), 0
+
+        pruned = dominated_samples(vals, max_dominators)
+        return np.ascontiguousarray(samples[~pruned]), int(np.sum(pruned))
     
     def update_workflow_config(self, mem_list, parall_list, real=True):
         assert isinstance(parall_list, list) and isinstance(mem_list, list)
@@ -662,11 +995,19 @@ class Workflow:
         assert isinstance(file_path, str) and file_path.endswith('.json')
         return json.load(open(file_path, 'r'))
     
+    # Return a zero-copy (memory-mapped, read-only) slice of the first num_samples samples
     def load_samples(self, file_path, num_samples):
-        assert isinstance(file_path, str) and file_path.endswith('.json') and \
+        assert isinstance(file_path, str) and file_path.endswith('.npy') and \
             isinstance(num_samples, int) and num_samples > 0
         
-        samples = json.load(open(file_path, 'r'))
+        header = json.load(open(self.sample_header_path(file_path), 'r'))
+        if header['stages'] != [stage.stage_name for stage in self.stages] or \
+            header['num_coeffs'] != num_coeffs:
+            raise ValueError('Samples do not match the workflow: ' + file_path)
+        if self.trained and header['model_hash'] != self.model_hash():
+            raise ValueError('Samples are drawn from another model, please resample: ' + file_path)
+        samples = np.load(file_path, mmap_mode='r')
+        assert samples.shape[0] >= num_samples, 'Only %d samples in %s' % (samples.shape[0], file_path)
         return samples[:num_samples]
 
     def metadata_path(self, meta_type):
@@ -676,118 +1017,163 @@ class Workflow:
         if meta_type == 'profiles':
             meta_type = 'profile'
         meta_path = self.workflow_name + '_' + meta_type + '.json'
+        if meta_type == 'samples':
+            meta_path = self.workflow_name + '_' + meta_type + '.npy'
         meta_path = meta_path.replace('/', '-')
         meta_path = os.path.join(meta_dir, meta_path)
         # if not os.path.exists(meta_path):
         #     raise Exception('Path does not exist: ' + meta_path)
         return meta_path
     
+    # Source-to-sink paths that are not dominated by (i.e., a subset of) another path
+    def dominant_paths(self):
+        paths = self.find_paths()
+        path_sets = [set(path) for path in paths]
+        res = []
+        for i, path in enumerate(paths):
+            dominated = False
+            for j in range(len(paths)):
+                if j != i and path_sets[i] < path_sets[j]:
+                    dominated = True
+                    break
+            if not dominated:
+                res.append(path)
+        return res
+
     '''
         Generate the python code for the objective function and constraints used by the solver
     Currently, we use the scipy.optimize as the solver and use numpy as the matrix library. 
-    We now need users to provide the critical path and the (optional) secondary critical path 
-    in order to avoid the occurrence of the np.max() function, which may cause undefined behavior.
+    The workflow latency is the maximum latency over all the dominant source-to-sink paths,
+    which are computed from the DAG. An exact np.max() is not differentiable and breaks SLSQP,
+    so it is replaced by a smooth maximum (log-sum-exp with the given temperature), which
+    over-estimates the maximum by at most temperature * log(num_paths).
+    Both functions take the input size s (MB) as the last argument, defaulting to the input size
+    the performance models are calibrated at.
+    objective_jac and constraint_jac are their exact derivatives w.r.t. x, with shape 
+    (num_samples, num_X) for the sample parameters, where the gradient of the smooth maximum 
+    is the softmax of the paths.
     '''
-    def generate_func_code(self, file_name, critical_path, secondary_path=None, 
-                           cons_mode='latency', solver_type='scipy'):
-        assert isinstance(file_name, str) and file_name.endswith('.py')
-        assert isinstance(critical_path, list) 
-        assert secondary_path is None or isinstance(secondary_path, list)
+    def func_code(self, cons_mode='latency', solver_type='scipy', temperature=0.1) -> str:
         assert cons_mode in ['latency', 'cost']
         assert solver_type == 'scipy'
-        code_dir = os.path.dirname(os.path.abspath(__file__))
-        code_path = os.path.join(code_dir, file_name)
+        assert temperature > 0
         obj_mode = 'cost' if cons_mode == 'latency' else 'latency'
 
-        parent_ids = [-1 for _ in range(len(self.stages))]
-        for stage in self.stages:
-            if not stage.allow_parallel:
-                for i in range(len(stage.parents)-1, -1, -1):
-                    if stage.parents[i].allow_parallel:
-                        parent_ids[stage.stage_id] = stage.parents[i].stage_id
-                        break
+        parent_ids = self.get_parent_ids()
+        paths = self.dominant_paths()
+        var = 'x'
+        param = 'p'
 
+        def stage_code(stage, mode):
+            return stage.perf_model.generate_func_code(mode, var, param, 
+                                                       parent_ids[stage.stage_id], solver_type)
+
+        def jac_body(mode):
+            body = '    J = np.zeros((len(%s),) + np.shape(%s[0]))\n' % (var, param)
+            if mode == 'latency':
+                stages = [stage for stage in self.stages if any(stage in path for path in paths)]
+                weights = {stage.stage_id: '' for stage in stages}
+                if len(paths) > 1:
+                    for stage in stages:
+                        body += '    l%d = ' % stage.stage_id + stage_code(stage, mode) + '\n'
+                    path_codes = [' + '.join(['l%d' % stage.stage_id for stage in path]) 
+                                  for path in paths]
+                    body += '    w = softmax([' + ', '.join(path_codes) + '], %r)\n' % temperature
+                    for stage in stages:
+                        ids = [str(i) for i, path in enumerate(paths) if stage in path]
+                        weights[stage.stage_id] = '(' + ' + '.join(['w[%s]' % i for i in ids]) + ')*'
+            else:
+                stages = self.stages
+                weights = {stage.stage_id: '' for stage in stages}
+            for stage in stages:
+                grads = stage.perf_model.generate_grad_code(mode, var, param, 
+                                                            parent_ids[stage.stage_id], solver_type)
+                for i, grad in grads:
+                    body += '    J[%d] += %s(%s)\n' % (i, weights[stage.stage_id], grad)
+            return body
+
+        def func_body(mode):
+            body = ''
+            if mode == 'latency':
+                stages = [stage for stage in self.stages if any(stage in path for path in paths)]
+                for stage in stages:
+                    body += '    l%d = ' % stage.stage_id + stage_code(stage, mode) + '\n'
+                path_codes = [' + '.join(['l%d' % stage.stage_id for stage in path]) 
+                              for path in paths]
+                if len(path_codes) == 1:
+                    body += '    val = ' + path_codes[0] + '\n'
+                else:
+                    body += '    val = smooth_max([' + ', '.join(path_codes) + '], %r)\n' % temperature
+            else:
+                body += '    val = ' + ' + '.join([stage_code(stage, mode) for stage in self.stages]) + '\n'
+            return body
+
+        default_size = self.stages[0].perf_model.default_input_size
         s = 'import numpy as np\n\n'
-        if solver_type == 'pyomo':
-            s += 'import pyomo.environ as pyo\n'
-            s += 'from pyomo.environ import *\n\n'
+        s += 'def smooth_max(vals, t):\n'
+        s += '    vals = np.array(vals)\n'
+        s += '    m = np.max(vals, axis=0)\n'
+        s += '    return m + t * np.log(np.sum(np.exp((vals - m) / t), axis=0))\n\n'
+        s += 'def softmax(vals, t):\n'
+        s += '    vals = np.array(vals)\n'
+        s += '    e = np.exp((vals - np.max(vals, axis=0)) / t)\n'
+        s += '    return e / np.sum(e, axis=0)\n\n'
 
         # Generate objective function
-        var = 'x'
-        param = 'p'
-        if solver_type == 'scipy':
-            s += 'def objective_func(x, p):\n' + '    return '
-        else:
-            s += 'def objective_func(model):\n' + '    return '
-            var = 'model.x'
-            param = 'model.p'
-        
-        if obj_mode == 'latency':
-            for stage in critical_path:
-                s += stage.perf_model.generate_func_code(obj_mode, var, param, 
-                                                         parent_ids[stage.stage_id], solver_type) + ' + '
-        else:
-            for stage in self.stages:
-                s += stage.perf_model.generate_func_code(obj_mode, var, param, 
-                                                         parent_ids[stage.stage_id], solver_type) + ' + '
-        s = s[:-3]
-        s += '\n\n'
+        s += 'def objective_func(x, p, s=%r):\n' % default_size
+        s += func_body(obj_mode)
+        s += '    return val\n\n'
 
         # Generate constraints
-        bound = ' - b'
-        func2_def = 'def constraint_func_2(x, p, b):\n' + '    return '
-        if solver_type == 'scipy':
-            s += 'def constraint_func(x, p, b):\n' + '    return '
-            # <<< swkim
-            # if cons_mode == 'cost': # Jolteon: error
-            #     func2_def = 'def constraint_func_2(x, p):\n' + '    return '
-            # <<< swkim
-        else:
-            s += 'def constraint_func(model):\n' + '    return '
-            bound = ' - model.b <= 0'
-            func2_def = 'def constraint_func_2(model):\n' + '    return '
-
-        if cons_mode == 'latency':
-            for stage in critical_path:
-                s += stage.perf_model.generate_func_code(cons_mode, var, param, 
-                                                         parent_ids[stage.stage_id], solver_type) + ' + '
-            s = s[:-3]
-            s += bound + '\n\n'
-            if secondary_path is not None:
-                s += func2_def
-                for stage in secondary_path:
-                    s += stage.perf_model.generate_func_code(cons_mode, var, param, 
-                                                             parent_ids[stage.stage_id], solver_type) + ' + '
-                s = s[:-3]
-                s += bound + '\n\n'
-        else:
-            for stage in self.stages:
-                s += stage.perf_model.generate_func_code(cons_mode, var, param, 
-                                                         parent_ids[stage.stage_id], solver_type) + ' + '
-            s = s[:-3]
-            s += bound + '\n\n'
-            # The time of the secondary path should be less than or equal to the time of the critical path
-            if secondary_path is not None:
-                s += func2_def
-                critical_set = set(critical_path)
-                secondary_set = set(secondary_path)
-                c_s = critical_set - secondary_set
-                s_c = secondary_set - critical_set
-                assert len(c_s) > 0 and len(s_c) > 0
-                for stage in c_s:
-                    s += stage.perf_model.generate_func_code('latency', var, param, 
-                                                             parent_ids[stage.stage_id], solver_type) + ' + '
-                s = s[:-3] + ' - ('
-                for stage in s_c:
-                    s += stage.perf_model.generate_func_code('latency', var, param, 
-                                                             parent_ids[stage.stage_id], solver_type) + ' + '
-                s = s[:-3] + ')'
-                if solver_type == 'pyomo':
-                    s += ' <= 0'
-                s += '\n\n'
+        s += 'def constraint_func(x, p, b, s=%r):\n' % default_size
+        s += func_body(cons_mode)
+        s += '    return val - b\n\n'
+
+        # Generate the Jacobians
+        s += 'def objective_jac(x, p, s=%r):\n' % default_size
+        s += jac_body(obj_mode)
+        s += '    return J.T\n\n'
 
+        s += 'def constraint_jac(x, p, b, s=%r):\n' % default_size
+        s += jac_body(cons_mode)
+        s += '    return J.T\n\n'
+        return s
+
+    def batch_evaluator(self, cons_mode='latency', temperature=0.1, input_size=None):
+        # The generated functions default to the input size of the first stage's model
+        if input_size is None:
+            input_size = self.stages[0].perf_model.default_input_size
+        paths = [[stage.stage_id for stage in path] for path in self.dominant_paths()]
+        return BatchEvaluator([stage.perf_model for stage in self.stages], self.get_parent_ids(), 
+                              paths, cons_mode, temperature, input_size)
+
+    # Write the generated code to a file, e.g., for inspection
+    def generate_func_code(self, file_name, cons_mode='latency', solver_type='scipy', 
+                           temperature=0.1):
+        assert isinstance(file_name, str) and file_name.endswith('.py')
+        code_dir = os.path.dirname(os.path.abspath(__file__))
+        code_path = os.path.join(code_dir, file_name)
         with open(code_path, 'w') as f:
-            f.write(s)
+            f.write(self.func_code(cons_mode, solver_type, temperature))
+
+    '''
+    Compile the generated code in memory and return 
+    (objective_func, constraint_func, objective_jac, constraint_jac).
+    They are cached by the dominant paths, the constraint mode, the temperature and the model 
+    hash (the code embeds the cold start trend and input size of the models), so a scheduler 
+    can serve several workflows and bound types in one process without writing or importing 
+    funcs.py, whose module cache would return the functions of the first workflow.
+    '''
+    def compile_funcs(self, cons_mode='latency', solver_type='scipy', temperature=0.1):
+        paths = tuple(tuple(stage.stage_id for stage in path) for path in self.dominant_paths())
+        key = (paths, cons_mode, solver_type, temperature, self.model_hash())
+        if key not in self.compiled_funcs:
+            code = self.func_code(cons_mode, solver_type, temperature)
+            namespace = {}
+            exec(compile(code, '<%s %s funcs>' % (self.workflow_name, cons_mode), 'exec'), namespace)
+            self.compiled_funcs[key] = (namespace['objective_func'], namespace['constraint_func'], 
+                                        namespace['objective_jac'], namespace['constraint_jac'])
+        return self.compiled_funcs[key]
 
     def close_pools(self):
         for stage in self.stages:
@@ -796,6 +1182,7 @@ class Workflow:
     def __getstate__(self):
         self_dict = self.__dict__.copy()
         del self_dict['pool']
+        self_dict['compiled_funcs'] = {}  # Functions compiled in memory cannot be pickled
         return self_dict
     
     def __del__(self):